@@ -0,0 +1,185 @@
+"""
+Sync against async chat endpoints under many concurrent clients, over ASGI.
+
+    python -m benchmarks.bench_async_views [--seconds 5] [--clients 10,100,1000]
+
+Serves the project's ASGI application with Daphne in a forked process, once
+with the DRF viewset actions (ASYNC_CHAT_VIEWS off) and once with the async
+views, and drives it from ``--clients`` keep-alive connections in one
+asyncio loop. Each client cycles through history pages of its session, the
+session list and, every ``--send-every`` requests, sending a message. Besides
+throughput and latency, reports the most threads the server process had,
+which is what bounds a sync worker's concurrency.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from benchmarks.common import free_port, make_users, percentile, print_table, setup_django, wait_for
+
+
+def serve(port, async_views):
+    from daphne.server import Server
+    from django.conf import settings
+
+    # The URLconf is first imported by the server, so this picks the routes
+    settings.ASYNC_CHAT_VIEWS = async_views
+    from secure_messenger.asgi import application
+    Server(application, endpoints=[f'tcp:port={port}:interface=127.0.0.1'], verbosity=0).run()
+
+
+def thread_count(pid):
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('Threads:'):
+                return int(line.split()[1])
+    return 0
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('Connection closed')
+    status = int(status_line.split()[1])
+    length = None
+    chunked = False
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'transfer-encoding' and 'chunked' in value.lower():
+            chunked = True
+    if chunked:
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif length:
+        await reader.readexactly(length)
+    return status
+
+
+async def client(port, token, requests, deadline, results):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    i = 0
+    try:
+        while time.monotonic() < deadline:
+            method, path, body = requests[i % len(requests)]
+            i += 1
+            head = (
+                f'{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nAuthorization: Token {token}\r\n'
+                f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'
+            )
+            start = time.perf_counter()
+            writer.write(head.encode('latin-1') + body)
+            await writer.drain()
+            status = await read_response(reader)
+            results.append((time.perf_counter() - start, status))
+    finally:
+        writer.close()
+
+
+async def drive(port, seconds, clients, workload):
+    deadline = time.monotonic() + seconds
+    results = []
+    await asyncio.gather(*(
+        client(port, token, requests, deadline, results)
+        for token, requests in (workload[i % len(workload)] for i in range(clients))
+    ))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--clients', default='10,100,1000')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--history', type=int, default=200, help='Messages per session')
+    parser.add_argument('--send-every', type=int, default=10)
+    args = parser.parse_args()
+
+    setup_django()
+
+    from django.db import connections
+    from rest_framework.authtoken.models import Token
+
+    from benchmarks.common import quiet
+    from chat.models import ChatParticipant, ChatSession, Message
+    from encryption.utils import encrypt_message_for_participants
+
+    users = make_users(args.users, prefix='async')
+    workload = []
+    with quiet():
+        for i, user in enumerate(users):
+            # A two-person session per user, shared with the next one
+            peer = users[(i + 1) % len(users)]
+            chat_session = ChatSession.objects.create(session_id=f'bench-async-{i}')
+            for member in (user, peer):
+                ChatParticipant.objects.create(chat_session=chat_session, user=member)
+            keys = {user.username: user.public_key, peer.username: peer.public_key}
+            recipients = {user.username: user.id, peer.username: peer.id}
+            for n in range(args.history):
+                encrypted = encrypt_message_for_participants(f'message {n}', keys)
+                Message.objects.create_encrypted(chat_session, user, encrypted, recipients)
+            token = Token.objects.create(user=user).key
+            history = f'/api/chats/{chat_session.id}/messages/'
+            requests = [('GET', f'{history}?limit=50', b'')] * 3 + [('GET', '/api/chats/', b'')]
+            requests = (requests * args.send_every)[:args.send_every - 1]
+            requests.append(('POST', history, json.dumps({'content': 'hello'}).encode()))
+            workload.append((token, requests))
+
+    rows = []
+    context = multiprocessing.get_context('fork')
+    for clients in (int(count) for count in args.clients.split(',')):
+        for name, async_views in (('sync', False), ('async', True)):
+            # The server must open its own connections
+            connections.close_all()
+            port = free_port()
+            server = context.Process(target=serve, args=(port, async_views), daemon=True)
+            server.start()
+            peak_threads = 0
+            sampling = threading.Event()
+
+            def sample():
+                nonlocal peak_threads
+                while not sampling.is_set():
+                    peak_threads = max(peak_threads, thread_count(server.pid))
+                    time.sleep(0.05)
+
+            try:
+                wait_for(port)
+                sampler = threading.Thread(target=sample)
+                sampler.start()
+                results = asyncio.run(drive(port, args.seconds, clients, workload))
+            finally:
+                sampling.set()
+                server.terminate()
+                server.join()
+            latencies = [latency for latency, status in results if status < 400]
+            errors = sum(1 for _, status in results if status >= 400)
+            rows.append((
+                clients,
+                name,
+                f'{len(latencies) / args.seconds:,.0f}',
+                f'{percentile(latencies, 0.5) * 1000:.1f}',
+                f'{percentile(latencies, 0.99) * 1000:.1f}',
+                errors,
+                peak_threads,
+            ))
+
+    print(f"{args.users} sessions of {args.history} messages, {args.seconds:g}s per run, "
+          f"{os.cpu_count()} CPUs")
+    print_table(['clients', 'views', 'req/s', 'p50 ms', 'p99 ms', 'errors', 'server threads'], rows)
+
+
+if __name__ == '__main__':
+    main()
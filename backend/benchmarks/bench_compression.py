@@ -0,0 +1,141 @@
+"""
+Bytes on the wire and CPU per response with negotiated compression.
+
+    python -m benchmarks.bench_compression [--pages 20 50 200 1000]
+
+Takes real response bodies (history pages of each size, the session list
+and a streamed export) and compresses them with every encoding installed,
+reporting the size before and after and the CPU time per response. The
+WebSocket rows compress a run of ``message`` events the way
+permessage-deflate does, per frame with the context carried between frames,
+using the window the serve command negotiates and zlib's default.
+"""
+import argparse
+import json
+import statistics
+import time
+import zlib
+
+from benchmarks.common import api_client, make_users, print_table, setup_django
+
+
+def cpu_time(fn, repeat):
+    """Median CPU seconds of this thread over ``repeat`` calls, and the last result."""
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.thread_time()
+        result = fn()
+        durations.append(time.thread_time() - start)
+    return statistics.median(durations), result
+
+
+def websocket_frames(events, window_bits, mem_level):
+    """Compress events as successive permessage-deflate frames; returns their total size."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -window_bits, mem_level)
+    total = 0
+    for event in events:
+        # Each message ends on a sync flush, whose 4-byte tail is not sent
+        total += len(compressor.compress(event) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pages', type=int, nargs='+', default=[20, 50, 200, 1000])
+    parser.add_argument('--sessions', type=int, default=20, help='Sessions in the session list')
+    parser.add_argument('--per-session', type=int, default=10, help='Messages in each of the other sessions')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+
+    from benchmarks.common import quiet
+    from chat.models import ChatParticipant, ChatSession, Message
+    from encryption.utils import encrypt_message_for_participants
+    from secure_messenger.compression import (
+        CODECS,
+        WEBSOCKET_MEM_LEVEL,
+        WEBSOCKET_WINDOW_BITS,
+        _MeteredStream
+    )
+
+    alice, bob = make_users(2, prefix='compress')
+    client = api_client(bob)
+    keys = {alice.username: alice.public_key, bob.username: bob.public_key}
+    recipients = {alice.username: alice.id, bob.username: bob.id}
+    sessions = []
+    with quiet():
+        for i in range(args.sessions):
+            chat_session = ChatSession.objects.create(session_id=f'bench-compress-{i}')
+            for user in (alice, bob):
+                ChatParticipant.objects.create(chat_session=chat_session, user=user)
+            sessions.append(chat_session)
+        history = sessions[0]
+        # The history session holds the pages; the others a few messages each
+        placements = [history] * max(args.pages) + [
+            chat_session for chat_session in sessions[1:] for _ in range(args.per_session)
+        ]
+        for n, chat_session in enumerate(placements):
+            text = f'message {n} ' + 'lorem ipsum dolor sit amet ' * (n % 7)
+            encrypted = encrypt_message_for_participants(text, keys)
+            Message.objects.create_encrypted(chat_session, (alice, bob)[n % 2], encrypted, recipients)
+
+    bodies = []
+    for size in args.pages:
+        response = client.get(f'/api/chats/{history.id}/messages/', {'limit': size})
+        bodies.append((f'history limit={size}', response.content))
+    page = json.loads(bodies[-1][1])['results']
+    bodies.append((f'session list ({args.sessions})', client.get('/api/chats/').content))
+    export = client.get(f'/api/chats/{history.id}/export/')
+    export_chunks = [chunk for chunk in export.streaming_content]
+
+    rows = []
+    for name, body in bodies:
+        for encoding, (compress, _) in CODECS.items():
+            seconds, compressed = cpu_time(lambda: compress(body), args.repeat)
+            rows.append((
+                name, encoding, f'{len(body):,}', f'{len(compressed):,}',
+                f'{len(body) / len(compressed):.1f}x', f'{seconds * 1e6:,.0f}'
+            ))
+
+    export_size = sum(len(chunk) for chunk in export_chunks)
+    for encoding in CODECS:
+        def stream():
+            compressor = _MeteredStream(encoding)
+            return sum(len(compressor.chunk(chunk)) for chunk in export_chunks) + len(compressor.finish())
+        seconds, compressed = cpu_time(stream, args.repeat)
+        rows.append((
+            'export (streamed)', encoding, f'{export_size:,}', f'{compressed:,}',
+            f'{export_size / compressed:.1f}x', f'{seconds * 1e6:,.0f}'
+        ))
+
+    # What the consumer sends for each new message
+    events = [
+        json.dumps({
+            'type': 'message',
+            'message_id': message['id'],
+            'sender_username': message['sender']['username'],
+            'content': message['content'],
+            'encryption_key': next(iter(message['encrypted_keys'].values())),
+            'iv': message['iv'],
+            'timestamp': message['timestamp'],
+        }).encode()
+        for message in page
+    ]
+    raw = sum(len(event) for event in events)
+    for label, window_bits, mem_level in (
+        ('negotiated', WEBSOCKET_WINDOW_BITS, WEBSOCKET_MEM_LEVEL),
+        ('zlib default', 15, 8),
+    ):
+        seconds, compressed = cpu_time(lambda: websocket_frames(events, window_bits, mem_level), args.repeat)
+        rows.append((
+            'websocket, per message', f'deflate {label}', f'{raw / len(events):,.0f}',
+            f'{compressed / len(events):,.0f}', f'{raw / compressed:.1f}x', f'{seconds / len(events) * 1e6:,.1f}'
+        ))
+
+    print_table(['response', 'encoding', 'bytes', 'on the wire', 'ratio', 'CPU µs'], rows)
+
+
+if __name__ == '__main__':
+    main()
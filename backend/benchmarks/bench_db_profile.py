@@ -0,0 +1,151 @@
+"""
+Mixed read/write throughput: stock SQLite vs the tuned profile vs tuned + replica.
+
+    python -m benchmarks.bench_db_profile [--seconds 5] [--writers 2] [--readers 4]
+
+Each configuration runs in its own process, because the database settings
+are fixed once Django starts. It then forks writer processes that store
+pre-encrypted messages through ``Message.objects.create_encrypted`` and
+reader processes that fetch history pages and session lists the way the API
+views do, inside ``replica_reads()``. Processes rather than threads keep the
+GIL out of the measurement.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import make_users, print_table, quiet, setup_django
+
+CONFIGS = {
+    'stock sqlite': {'DATABASE_TUNING': 'False'},
+    'tuned profile': {'DATABASE_TUNING': 'True'},
+    'tuned + replica': {'DATABASE_TUNING': 'True', 'DATABASE_REPLICA_PATH': 'replica'},
+}
+
+
+def run_workload(args):
+    workdir = setup_django()
+
+    from django.core.management import call_command
+    from django.db import OperationalError, connections
+
+    from chat.history import history_page
+    from chat.models import ChatParticipant, ChatSession, Message
+    from encryption.utils import encrypt_message_for_participants
+    from secure_messenger.routers import replica_reads
+
+    alice, bob = make_users(2)
+    sessions = []
+    for i in range(args.sessions):
+        session = ChatSession.objects.create(session_id=f'bench-db-{i}')
+        for user in (alice, bob):
+            ChatParticipant.objects.create(chat_session=session, user=user)
+        sessions.append(session)
+    with quiet():
+        encrypted = encrypt_message_for_participants(
+            'benchmark message', {alice.username: alice.public_key, bob.username: bob.public_key}
+        )
+    recipients = {alice.username: alice.id, bob.username: bob.id}
+    for session in sessions:
+        for _ in range(args.seed_messages):
+            Message.objects.create_encrypted(session, alice, encrypted, recipients)
+    if 'replica' in connections.databases:
+        with quiet():
+            call_command('sync_replica')
+
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+    counts = {name: context.Value('i', 0) for name in ('writes', 'reads', 'errors')}
+
+    def bump(name):
+        with counts[name].get_lock():
+            counts[name].value += 1
+
+    def writer():
+        rng = random.Random()
+        while not stop.is_set():
+            try:
+                Message.objects.create_encrypted(rng.choice(sessions), alice, encrypted, recipients)
+                bump('writes')
+            except OperationalError:
+                bump('errors')
+
+    def reader():
+        rng = random.Random()
+        while not stop.is_set():
+            try:
+                with replica_reads():
+                    session = rng.choice(sessions)
+                    history_page(
+                        Message.objects.with_key_for(bob).filter(chat_session=session).select_related('sender'),
+                        limit=50
+                    )
+                    list(ChatSession.objects.filter(
+                        participants__user=bob, participants__is_active=True
+                    ).order_by('-last_message_at', '-id')[:50])
+                bump('reads')
+            except OperationalError:
+                bump('errors')
+
+    # Forked workers must open their own connections
+    connections.close_all()
+    workers = [context.Process(target=writer) for _ in range(args.writers)]
+    workers += [context.Process(target=reader) for _ in range(args.readers)]
+    for worker in workers:
+        worker.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+
+    print(json.dumps({
+        'writes_per_sec': counts['writes'].value / args.seconds,
+        'reads_per_sec': counts['reads'].value / args.seconds,
+        'errors': counts['errors'].value,
+        'workdir': workdir,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--seed-messages', type=int, default=100)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_workload(args)
+        return
+
+    rows = []
+    for name, overrides in CONFIGS.items():
+        env = dict(os.environ, **overrides)
+        if 'DATABASE_REPLICA_PATH' in overrides:
+            env['DATABASE_REPLICA_PATH'] = os.path.join(tempfile.mkdtemp(prefix='sm-bench-'), 'replica.sqlite3')
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_db_profile', '--child'] + sys.argv[1:],
+            env=env, check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        rows.append((
+            name,
+            f"{result['writes_per_sec']:,.0f}",
+            f"{result['reads_per_sec']:,.0f}",
+            result['errors'],
+        ))
+
+    print(f"{args.writers} writer and {args.readers} reader processes for {args.seconds:g}s each")
+    print_table(['configuration', 'writes/s', 'reads/s', 'lock errors'], rows)
+
+
+if __name__ == '__main__':
+    main()
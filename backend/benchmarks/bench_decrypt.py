@@ -0,0 +1,58 @@
+"""
+Messages decrypted per second: one request per message vs the batch action.
+
+    python -m benchmarks.bench_decrypt [--sizes 50 500]
+"""
+import argparse
+
+from benchmarks.common import api_client, make_users, print_table, setup_django, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 500])
+    args = parser.parse_args()
+
+    setup_django()
+
+    from chat.models import ChatParticipant, ChatSession, Message
+    from encryption.utils import encrypt_message_for_participants
+
+    alice, bob = make_users(2)
+    client = api_client(bob)
+    rows = []
+
+    for size in args.sizes:
+        session = ChatSession.objects.create(session_id=f'bench-decrypt-{size}')
+        for user in (alice, bob):
+            ChatParticipant.objects.create(chat_session=session, user=user)
+        keys = {alice.username: alice.public_key, bob.username: bob.public_key}
+        recipients = {alice.username: alice.id, bob.username: bob.id}
+        for i in range(size):
+            encrypted = encrypt_message_for_participants(f'benchmark message {i}', keys)
+            Message.objects.create_encrypted(session, alice, encrypted, recipients)
+        ids = list(Message.objects.filter(chat_session=session).values_list('id', flat=True))
+
+        def single():
+            for message_id in ids:
+                response = client.get(f'/api/messages/{message_id}/', {'chat_session_id': session.id})
+                assert response.status_code == 200, response.status_code
+
+        def batch():
+            response = client.get('/api/messages/decrypt/', {'chat_session_id': session.id, 'limit': size})
+            assert response.status_code == 200, response.status_code
+
+        single_seconds, _ = timed(single)
+        batch_seconds, _ = timed(batch, repeat=3)
+        rows.append((
+            size,
+            f'{size / single_seconds:,.0f}',
+            f'{size / batch_seconds:,.0f}',
+            f'{single_seconds / batch_seconds:.1f}x'
+        ))
+
+    print_table(['messages', 'single msg/s', 'batch msg/s', 'speedup'], rows)
+
+
+if __name__ == '__main__':
+    main()
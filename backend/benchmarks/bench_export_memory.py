@@ -0,0 +1,122 @@
+"""
+Peak Python memory of the streaming NDJSON export vs a buffered serializer.
+
+    python -m benchmarks.bench_export_memory [--messages 1000000] [--ceiling-mb 64]
+
+Seeds one session with ``--messages`` messages, streams the export action
+through the test client while tracemalloc records the peak, and exits with
+status 1 if that peak exceeds ``--ceiling-mb``. For comparison the same
+history is serialized the old way, ``MessageSerializer(many=True)``, for the
+first ``--buffered-sample`` messages.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from benchmarks.common import api_client, make_users, print_table, setup_django
+
+SEED_BATCH = 10000
+
+
+def seed(session, sender, recipient, count):
+    from django.utils import timezone
+
+    from chat.models import Message, MessageKey
+
+    content = os.urandom(96)
+    wrapped_key = os.urandom(256)
+    iv = os.urandom(16)
+    now = timezone.now()
+    for start in range(0, count, SEED_BATCH):
+        size = min(SEED_BATCH, count - start)
+        messages = Message.objects.bulk_create(
+            Message(chat_session=session, sender=sender, content=content,
+                    encryption_key=wrapped_key, iv=iv, timestamp=now)
+            for _ in range(size)
+        )
+        MessageKey.objects.bulk_create(
+            MessageKey(message=message, recipient=recipient, chat_session=session, wrapped_key=wrapped_key)
+            for message in messages
+        )
+
+
+def measure(fn):
+    """Return (seconds, peak traced MiB, result) for one call."""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak / (1024 * 1024), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--buffered-sample', type=int, default=50000)
+    parser.add_argument('--ceiling-mb', type=float, default=64.0)
+    args = parser.parse_args()
+
+    setup_django()
+
+    from django.test.utils import override_settings
+
+    from chat.models import ChatParticipant, ChatSession, Message
+    from chat.serializers import MessageSerializer
+
+    alice, bob = make_users(2)
+    session = ChatSession.objects.create(session_id='bench-export')
+    for user in (alice, bob):
+        ChatParticipant.objects.create(chat_session=session, user=user)
+
+    start = time.perf_counter()
+    seed(session, alice, bob, args.messages)
+    print(f"Seeded {args.messages:,} messages in {time.perf_counter() - start:.1f}s")
+
+    client = api_client(bob)
+
+    def stream():
+        response = client.get(f'/api/chats/{session.id}/export/')
+        assert response.status_code == 200, response.status_code
+        lines = total = 0
+        for chunk in response.streaming_content:
+            lines += chunk.count(b'\n')
+            total += len(chunk)
+        return lines, total
+
+    def buffered():
+        # The serializer only reads the requesting user from its context
+        request = SimpleNamespace(user=bob)
+        messages = Message.objects.with_key_for(bob).filter(
+            chat_session=session
+        ).select_related('sender').order_by('id')[:args.buffered_sample]
+        return len(MessageSerializer(messages, many=True, context={'request': request}).data)
+
+    with override_settings(DEBUG=False):
+        stream_seconds, stream_peak, (lines, size) = measure(stream)
+        buffered_seconds, buffered_peak, buffered_count = measure(buffered)
+
+    print_table(
+        ['mode', 'messages', 'seconds', 'msg/s', 'peak MiB'],
+        [
+            ('streaming NDJSON', f'{lines - 1:,}', f'{stream_seconds:.1f}',
+             f'{(lines - 1) / stream_seconds:,.0f}', f'{stream_peak:.1f}'),
+            ('buffered serializer', f'{buffered_count:,}', f'{buffered_seconds:.1f}',
+             f'{buffered_count / buffered_seconds:,.0f}', f'{buffered_peak:.1f}'),
+        ]
+    )
+    print(f"Export size: {size / (1024 * 1024):.1f} MiB")
+
+    if stream_peak > args.ceiling_mb:
+        print(f"FAIL: streaming export peaked at {stream_peak:.1f} MiB, ceiling is {args.ceiling_mb} MiB")
+        sys.exit(1)
+    print(f"OK: streaming export stayed under {args.ceiling_mb} MiB")
+
+
+if __name__ == '__main__':
+    main()
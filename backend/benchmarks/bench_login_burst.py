@@ -0,0 +1,141 @@
+"""
+Logins per second and chat endpoint latency during a login burst, over ASGI.
+
+    python -m benchmarks.bench_login_burst [--seconds 5] [--login-clients 16] [--chat-clients 4]
+
+Serves the project's ASGI application with Daphne in a forked process and
+measures ``GET /api/chats/`` from ``--chat-clients`` threads, first on its
+own and then while ``--login-clients`` threads post logins back to back.
+The burst runs twice: with one hashing thread per login client and no queue
+limit, and with the configured ``--workers`` and ``--queue-limit``. Logins
+turned away with 503 are counted separately from successful ones.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import threading
+import time
+
+from benchmarks.common import free_port, make_users, percentile, print_table, setup_django, wait_for
+
+PASSWORD = 'bench-password'
+
+
+def serve(port, workers, queue_limit):
+    from daphne.server import Server
+
+    from secure_messenger.asgi import application
+    from users.hashers import hashing_pool
+
+    hashing_pool.workers = workers
+    hashing_pool.queue_limit = queue_limit
+    Server(application, endpoints=[f'tcp:port={port}:interface=127.0.0.1'], verbosity=0).run()
+
+
+def run_phase(port, seconds, chat_token, usernames, chat_clients, login_clients):
+    stop = threading.Event()
+    latencies = []
+    logins = {'ok': 0, 'rejected': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def chat_client():
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        while not stop.is_set():
+            start = time.perf_counter()
+            connection.request('GET', '/api/chats/', headers={'Authorization': f'Token {chat_token}'})
+            response = connection.getresponse()
+            response.read()
+            elapsed = time.perf_counter() - start
+            assert response.status == 200, response.status
+            with lock:
+                latencies.append(elapsed)
+
+    def login_client(username):
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        body = json.dumps({'username': username, 'password': PASSWORD})
+        while not stop.is_set():
+            connection.request('POST', '/api/auth/login/', body=body, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            outcome = {200: 'ok', 503: 'rejected'}.get(response.status, 'failed')
+            with lock:
+                logins[outcome] += 1
+
+    threads = [threading.Thread(target=chat_client) for _ in range(chat_clients)]
+    threads += [
+        threading.Thread(target=login_client, args=(usernames[i % len(usernames)],))
+        for i in range(login_clients)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return latencies, logins
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--login-clients', type=int, default=16)
+    parser.add_argument('--chat-clients', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=2, help='AUTH_HASH_WORKERS for the capped run')
+    parser.add_argument('--queue-limit', type=int, default=8, help='AUTH_HASH_QUEUE_LIMIT for the capped run')
+    parser.add_argument('--sessions', type=int, default=5)
+    args = parser.parse_args()
+
+    setup_django()
+
+    from django.db import connections
+    from rest_framework.authtoken.models import Token
+
+    from chat.models import ChatParticipant, ChatSession
+
+    users = make_users(max(args.login_clients, 2))
+    chat_user = users[0]
+    for i in range(args.sessions):
+        session = ChatSession.objects.create(session_id=f'bench-login-{i}')
+        for user in users[:2]:
+            ChatParticipant.objects.create(chat_session=session, user=user)
+    chat_token = Token.objects.create(user=chat_user).key
+    usernames = [user.username for user in users]
+
+    runs = [
+        ('chat only', args.login_clients, 10 ** 6, 0),
+        ('login burst, uncapped', args.login_clients, 10 ** 6, args.login_clients),
+        (f'login burst, {args.workers} workers, limit {args.queue_limit}',
+         args.workers, args.queue_limit, args.login_clients),
+    ]
+    context = multiprocessing.get_context('fork')
+    rows = []
+    for name, workers, queue_limit, login_clients in runs:
+        # The server must open its own connections
+        connections.close_all()
+        port = free_port()
+        server = context.Process(target=serve, args=(port, workers, queue_limit), daemon=True)
+        server.start()
+        try:
+            wait_for(port)
+            latencies, logins = run_phase(
+                port, args.seconds, chat_token, usernames, args.chat_clients, login_clients
+            )
+        finally:
+            server.terminate()
+            server.join()
+        rows.append((
+            name,
+            f"{logins['ok'] / args.seconds:,.1f}" if login_clients else '-',
+            logins['rejected'] if login_clients else '-',
+            f"{len(latencies) / args.seconds:,.0f}",
+            f"{percentile(latencies, 0.5) * 1000:.1f}",
+            f"{percentile(latencies, 0.99) * 1000:.1f}",
+        ))
+
+    print(f"{args.chat_clients} chat clients, {args.login_clients} login clients, {args.seconds:g}s per run")
+    print_table(['run', 'logins/s', '503s', 'chat req/s', 'chat p50 ms', 'chat p99 ms'], rows)
+
+
+if __name__ == '__main__':
+    main()
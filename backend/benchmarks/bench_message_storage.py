@@ -0,0 +1,91 @@
+"""
+Storage per 1M messages: base64 text + JSON keys vs binary columns + packed keys.
+
+    python -m benchmarks.bench_message_storage [--rows 20000] [--participants 2 5 20]
+
+Rows are written to scratch SQLite files with the old and new Message column
+layouts; the reported size is the file size scaled to one million rows.
+"""
+import argparse
+import base64
+import json
+import os
+import sqlite3
+import struct
+import tempfile
+
+from benchmarks.common import print_table
+
+OLD_SCHEMA = (
+    'CREATE TABLE chat_message (id INTEGER PRIMARY KEY, chat_session_id INTEGER, sender_id INTEGER, '
+    'content TEXT, encryption_key TEXT, encrypted_keys TEXT, iv TEXT, timestamp TEXT, change_seq INTEGER)'
+)
+NEW_SCHEMA = (
+    'CREATE TABLE chat_message (id INTEGER PRIMARY KEY, chat_session_id INTEGER, sender_id INTEGER, '
+    'content BLOB, encryption_key BLOB, wrapped_keys BLOB, iv BLOB, timestamp TEXT, change_seq INTEGER)'
+)
+
+# Packed (user id, length, key) records, the compact per-row key layout
+_WRAPPED_KEY_HEADER = struct.Struct('>QH')
+
+# A typical chat line padded to the AES block size, and a 2048-bit RSA-OAEP output
+CIPHERTEXT_BYTES = 64
+WRAPPED_KEY_BYTES = 256
+
+
+def pack_wrapped_keys(keys_by_user_id):
+    return b''.join(
+        _WRAPPED_KEY_HEADER.pack(user_id, len(key)) + key
+        for user_id, key in sorted(keys_by_user_id.items())
+    )
+
+
+def file_size(schema, rows):
+    path = os.path.join(tempfile.mkdtemp(prefix='sm-storage-'), 'messages.sqlite3')
+    db = sqlite3.connect(path)
+    db.execute(schema)
+    db.executemany('INSERT INTO chat_message VALUES (NULL, 1, 1, ?, ?, ?, ?, ?, ?)', rows)
+    db.commit()
+    db.execute('VACUUM')
+    db.close()
+    return os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--participants', type=int, nargs='+', default=[2, 5, 20])
+    args = parser.parse_args()
+
+    results = []
+    for participants in args.participants:
+        old_rows, new_rows = [], []
+        for i in range(args.rows):
+            content, iv = os.urandom(CIPHERTEXT_BYTES), os.urandom(16)
+            keys = {user_id: os.urandom(WRAPPED_KEY_BYTES) for user_id in range(1, participants + 1)}
+            timestamp = '2025-01-01 00:00:00.000000'
+            old_rows.append((
+                base64.b64encode(content).decode(),
+                base64.b64encode(keys[1]).decode(),
+                json.dumps({f'user{user_id}': base64.b64encode(key).decode() for user_id, key in keys.items()}),
+                base64.b64encode(iv).decode(),
+                timestamp,
+                i
+            ))
+            new_rows.append((content, keys[1], pack_wrapped_keys(keys), iv, timestamp, i))
+
+        old_size = file_size(OLD_SCHEMA, old_rows)
+        new_size = file_size(NEW_SCHEMA, new_rows)
+        scale = 1_000_000 / args.rows
+        results.append((
+            participants,
+            f'{old_size * scale / 2 ** 20:,.0f} MiB',
+            f'{new_size * scale / 2 ** 20:,.0f} MiB',
+            f'{(1 - new_size / old_size) * 100:.0f}%'
+        ))
+
+    print_table(['participants', 'text + JSON / 1M', 'binary / 1M', 'saved'], results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Rows serialized per second: the DRF serializers against the values() fast path.
+
+    python -m benchmarks.bench_serializers [--sizes 100 1000 10000]
+
+For each size, times a session's full history (``MessageSerializer`` over
+model instances against ``serialize_messages`` over values rows) and a
+session list holding that many messages in sessions of ``--per-session``
+(``ChatSessionSerializer`` with prefetched messages against
+``serialize_sessions``). Times include the queries, which are counted too.
+"""
+import argparse
+
+from benchmarks.common import make_users, print_table, setup_django, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--per-session', type=int, default=50, help='Messages per session in the session list')
+    args = parser.parse_args()
+
+    setup_django()
+
+    from django.db import connection
+    from django.db.models import Prefetch, prefetch_related_objects
+    from django.test.utils import CaptureQueriesContext
+    from rest_framework.request import Request
+    from rest_framework.test import APIRequestFactory
+
+    from benchmarks.common import quiet
+    from chat.models import ChatParticipant, ChatSession, Message
+    from chat.receipts import attach_unread_counts, with_read_state
+    from chat.serializers import (
+        ChatSessionSerializer,
+        MessageSerializer,
+        message_rows,
+        serialize_messages,
+        serialize_sessions
+    )
+    from encryption.utils import encrypt_message_for_participants
+
+    alice, bob = make_users(2, prefix='serialize')
+    request = Request(APIRequestFactory().get('/'))
+    request.user = bob
+    keys = {alice.username: alice.public_key, bob.username: bob.public_key}
+    recipients = {alice.username: alice.id, bob.username: bob.id}
+    with quiet():
+        # The cost measured is per row, so every message can carry one payload
+        encrypted = encrypt_message_for_participants('benchmark message', keys)
+
+    def create_session(name, size):
+        chat_session = ChatSession.objects.create(session_id=name)
+        for user in (alice, bob):
+            ChatParticipant.objects.create(chat_session=chat_session, user=user)
+        for _ in range(size):
+            Message.objects.create_encrypted(chat_session, alice, encrypted, recipients)
+        return chat_session
+
+    def measure(fn):
+        # The log is capped, so a full one would count nothing
+        connection.queries_log.clear()
+        with CaptureQueriesContext(connection) as queries:
+            fn()
+        seconds, _ = timed(fn, repeat=3)
+        return seconds, len(queries)
+
+    rows = []
+    for size in args.sizes:
+        chat_session = create_session(f'bench-serialize-{size}', size)
+        history = Message.objects.with_key_for(bob).filter(chat_session=chat_session).order_by('timestamp', 'id')
+
+        def drf_history():
+            return MessageSerializer(history.prefetch_related('sender'), many=True, context={'request': request}).data
+
+        def fast_history():
+            return serialize_messages(list(message_rows(history)), bob)
+
+        sessions = ChatSession.objects.filter(session_id__startswith=f'bench-list-{size}-')
+        for i in range(max(1, size // args.per_session)):
+            create_session(f'bench-list-{size}-{i}', min(size, args.per_session))
+        listed = with_read_state(sessions.filter(participants__user=bob)).order_by('-last_message_at', '-id')
+
+        def drf_list():
+            # What the session list did before the fast path
+            chat_sessions = list(listed)
+            prefetch_related_objects(chat_sessions, Prefetch(
+                'messages', queryset=Message.objects.with_key_for(bob).prefetch_related('sender')
+            ))
+            attach_unread_counts(chat_sessions)
+            return ChatSessionSerializer(chat_sessions, many=True, context={'request': request}).data
+
+        def fast_list():
+            return serialize_sessions(listed, bob)
+
+        for name, drf, fast in (('history', drf_history, fast_history), ('session list', drf_list, fast_list)):
+            drf_seconds, drf_queries = measure(drf)
+            fast_seconds, fast_queries = measure(fast)
+            rows.append((
+                name,
+                size,
+                f'{size / drf_seconds:,.0f}',
+                f'{size / fast_seconds:,.0f}',
+                f'{drf_seconds / fast_seconds:.1f}x',
+                f'{drf_queries} / {fast_queries}',
+            ))
+
+    print_table(['endpoint', 'rows', 'DRF rows/s', 'fast rows/s', 'speedup', 'queries DRF / fast'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Message write throughput as the number of message shards grows.
+
+    python -m benchmarks.bench_sharding [--shards 1,2,4] [--seconds 5] [--writers 4]
+
+Each shard count runs in its own process with ``DATABASE_SHARDS`` set, since
+the database settings are fixed once Django starts. It creates ``--sessions``
+sessions, which spread over the shards by the hash of their id, then forks
+writer processes that store pre-encrypted messages into random sessions
+through ``Message.objects.create_encrypted``, the path the API and the chat
+consumer use. Messages and their wrapped keys go to the session's shard; only
+the session counters are written to the default database.
+
+Shards only add throughput when writers wait on each other's database lock,
+so run it with at least as many cores as writers; on a single core the
+writers are CPU-bound and every shard count scores about the same.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from benchmarks.common import make_users, print_table, quiet, setup_django
+
+
+def run_workload(args):
+    workdir = setup_django()
+
+    from django.db import OperationalError, connections
+
+    from chat.models import ChatParticipant, ChatSession, Message
+    from encryption.utils import encrypt_message_for_participants
+
+    alice, bob = make_users(2)
+    sessions = []
+    for i in range(args.sessions):
+        session = ChatSession.objects.create(session_id=f'bench-shard-{i}')
+        for user in (alice, bob):
+            ChatParticipant.objects.create(chat_session=session, user=user)
+        sessions.append(session)
+    with quiet():
+        encrypted = encrypt_message_for_participants(
+            'benchmark message', {alice.username: alice.public_key, bob.username: bob.public_key}
+        )
+    recipients = {alice.username: alice.id, bob.username: bob.id}
+
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+    writes = context.Value('i', 0)
+    errors = context.Value('i', 0)
+
+    def bump(counter):
+        with counter.get_lock():
+            counter.value += 1
+
+    def writer():
+        rng = random.Random()
+        while not stop.is_set():
+            try:
+                Message.objects.create_encrypted(rng.choice(sessions), alice, encrypted, recipients)
+                bump(writes)
+            except OperationalError:
+                bump(errors)
+
+    # Forked workers must open their own connections
+    connections.close_all()
+    workers = [context.Process(target=writer) for _ in range(args.writers)]
+    for worker in workers:
+        worker.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+
+    print(json.dumps({
+        'writes_per_sec': writes.value / args.seconds,
+        'errors': errors.value,
+        'sessions_per_shard': sorted(Counter(session.shard for session in sessions).values()),
+        'workdir': workdir,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--shards', default='1,2,4', help='Comma-separated shard counts to compare')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--sessions', type=int, default=64)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_workload(args)
+        return
+
+    rows = []
+    baseline = None
+    for count in (int(value) for value in args.shards.split(',')):
+        env = dict(os.environ, DATABASE_SHARDS=str(count))
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_sharding', '--child'] + sys.argv[1:],
+            env=env, check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        baseline = baseline or result['writes_per_sec']
+        rows.append((
+            count,
+            '/'.join(str(sessions) for sessions in result['sessions_per_shard']),
+            f"{result['writes_per_sec']:,.0f}",
+            f"{result['writes_per_sec'] / baseline:.2f}x",
+            result['errors'],
+        ))
+
+    print(f"{args.writers} writer processes over {args.sessions} sessions for {args.seconds:g}s each")
+    print_table(['shards', 'sessions per shard', 'writes/s', 'vs first', 'lock errors'], rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Authenticated requests per second with DRF's TokenAuthentication vs the cached one.
+
+    python -m benchmarks.bench_token_auth [--requests 5000] [--users 200]
+
+Each authentication class runs in its own process, because DRF binds the
+authentication classes when the views are imported. The process creates
+``--users`` users with tokens and sends ``--requests`` token-authenticated
+GETs to ``/api/auth/user/``, a cheap endpoint where authentication is most of
+the work, rotating through the tokens the way concurrent clients would.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+from benchmarks.common import api_client, make_users, print_table, setup_django
+
+CLASSES = {
+    'TokenAuthentication': 'rest_framework.authentication.TokenAuthentication',
+    'CachedTokenAuthentication': 'users.authentication.CachedTokenAuthentication',
+}
+
+
+def run_workload(args):
+    setup_django()
+
+    from django.conf import settings
+    settings.REST_FRAMEWORK['DEFAULT_AUTHENTICATION_CLASSES'] = [CLASSES[args.child]]
+
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from rest_framework.authtoken.models import Token
+
+    users = make_users(args.users)
+    clients = []
+    for user in users:
+        client = api_client(user)
+        client.force_authenticate(None)
+        client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=user).key}')
+        clients.append(client)
+
+    # Warm up, which also fills the cache
+    for client in clients:
+        assert client.get('/api/auth/user/').status_code == 200
+
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        for i in range(args.requests):
+            clients[i % len(clients)].get('/api/auth/user/')
+        seconds = time.perf_counter() - start
+
+    print(json.dumps({
+        'requests_per_sec': args.requests / seconds,
+        'queries_per_request': len(queries.captured_queries) / args.requests,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--child', choices=CLASSES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_workload(args)
+        return
+
+    rows = []
+    for name in CLASSES:
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_token_auth', '--child', name] + sys.argv[1:],
+            check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        rows.append((name, f"{result['requests_per_sec']:,.0f}", f"{result['queries_per_request']:.2f}"))
+
+    print(f"{args.requests:,} requests over {args.users} tokens")
+    print_table(['authentication', 'requests/s', 'queries/request'], rows)
+
+
+if __name__ == '__main__':
+    main()
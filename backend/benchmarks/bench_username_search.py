@@ -0,0 +1,92 @@
+"""
+Username prefix search: the in-memory index against the database.
+
+    python -m benchmarks.bench_username_search [--sizes 10000,100000,1000000] [--limit 10]
+
+For each table size, inserts users with random lowercase names, builds the
+username index and times ``--queries`` two- and three-letter prefix
+lookups through it, through the range-scan fallback, and through a naive
+``icontains`` query. The naive query walks the username index and stops at
+the ``--limit``th match, so it is only quick when matches are common; the
+last column times it for a substring no user has. Sizes are cumulative: the
+table grows between rows.
+"""
+import argparse
+import random
+import string
+import time
+
+from benchmarks.common import percentile, print_table, setup_django
+
+
+def time_queries(fn, prefixes):
+    durations = []
+    for prefix in prefixes:
+        start = time.perf_counter()
+        fn(prefix)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--naive-queries', type=int, default=20)
+    args = parser.parse_args()
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+
+    setup_django()
+
+    from users.models import CustomUser
+    from users.search import username_index, usernames_with_prefix
+
+    rng = random.Random(42)
+    letters = string.ascii_lowercase
+    rows = []
+    created = 0
+    for size in sizes:
+        while created < size:
+            batch = min(10000, size - created)
+            # bulk_create sends no signals; the index is rebuilt below
+            CustomUser.objects.bulk_create([
+                CustomUser(username=f"{''.join(rng.choices(letters, k=8))}{created + i}", password='!')
+                for i in range(batch)
+            ])
+            created += batch
+
+        start = time.perf_counter()
+        username_index.build()
+        build_seconds = time.perf_counter() - start
+
+        prefixes = [''.join(rng.choices(letters, k=rng.choice((2, 3)))) for _ in range(args.queries)]
+        indexed = time_queries(lambda prefix: username_index.search(prefix, args.limit), prefixes)
+        ranged = time_queries(lambda prefix: list(usernames_with_prefix(prefix)[:args.limit]), prefixes)
+
+        def contains(prefix):
+            return list(CustomUser.objects.filter(
+                username__icontains=prefix, is_active=True
+            ).order_by('username').values_list('username', flat=True)[:args.limit])
+        naive = time_queries(contains, prefixes[:args.naive_queries])
+        naive_miss = time_queries(contains, ['#'] * 3)
+        rows.append((
+            f'{size:,}',
+            f'{build_seconds:.2f}',
+            f'{percentile(indexed, 0.5) * 1e6:.1f}',
+            f'{percentile(indexed, 0.99) * 1e6:.1f}',
+            f'{percentile(ranged, 0.5) * 1e3:.2f}',
+            f'{percentile(naive, 0.5) * 1e3:.1f}',
+            f'{percentile(naive_miss, 0.5) * 1e3:.1f}',
+        ))
+
+    print(f"top {args.limit} matches, {args.queries} prefixes per size")
+    print_table(
+        ['users', 'index build s', 'index p50 us', 'index p99 us', 'range scan p50 ms', 'icontains p50 ms',
+         'icontains miss ms'],
+        rows
+    )
+
+
+if __name__ == '__main__':
+    main()
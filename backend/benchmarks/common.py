@@ -0,0 +1,118 @@
+"""
+Shared setup for the backend benchmarks.
+
+Benchmarks run against a throwaway SQLite database and are started from the
+backend directory, e.g. ``python -m benchmarks.bench_decrypt``.
+"""
+import contextlib
+import io
+import os
+import socket
+import statistics
+import tempfile
+import time
+
+
+def setup_django(db_name='bench.sqlite3'):
+    """Configure Django against fresh SQLite files and apply migrations to every shard."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'secure_messenger.settings')
+
+    from django.conf import settings
+    workdir = tempfile.mkdtemp(prefix='sm-bench-')
+    settings.DATABASES['default']['NAME'] = os.path.join(workdir, db_name)
+    for alias in settings.MESSAGE_SHARDS[1:]:
+        settings.DATABASES[alias]['NAME'] = os.path.join(workdir, f'{alias}.{db_name}')
+    settings.STATICFILES_DIRS = []
+
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    for alias in settings.MESSAGE_SHARDS:
+        call_command('migrate', database=alias, verbosity=0)
+    return workdir
+
+
+@contextlib.contextmanager
+def quiet():
+    """Swallow stdout from code paths that still print diagnostics."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def make_users(count, prefix='bench'):
+    """Create users that share one generated RSA key pair."""
+    from encryption.utils import generate_key_pair
+    from users.models import CustomUser
+
+    with quiet():
+        key_pair = generate_key_pair()
+    return [
+        CustomUser.objects.create_user(
+            f'{prefix}{i}',
+            'bench-password',
+            email=f'{prefix}{i}@example.com',
+            public_key=key_pair['public_key'],
+            private_key=key_pair['private_key']
+        )
+        for i in range(count)
+    ]
+
+
+def api_client(user):
+    """Return a DRF test client authenticated as ``user``."""
+    from rest_framework.test import APIClient
+
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+def timed(fn, repeat=1):
+    """Run ``fn`` ``repeat`` times and return (median seconds, last result)."""
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations), result
+
+
+def print_table(headers, rows):
+    """Print rows as a fixed-width text table."""
+    widths = [
+        max(len(str(header)), *(len(str(row[i])) for row in rows)) if rows else len(str(header))
+        for i, header in enumerate(headers)
+    ]
+    line = '  '.join(str(header).ljust(width) for header, width in zip(headers, widths))
+    print(line)
+    print('-' * len(line))
+    for row in rows:
+        print('  '.join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+
+def percentile(values, fraction):
+    """The value at ``fraction`` (0 to 1) of the sorted values; 0 for none."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    """Wait until a server accepts connections on ``port``."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server did not start on port {port}')
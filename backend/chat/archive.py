@@ -0,0 +1,226 @@
+"""
+Archival of old messages into compressed per-session segments.
+
+``archive_chunk`` moves a session's oldest hot messages (and their wrapped
+keys) into one ``ArchivedSegment`` and deletes them from the hot tables in a
+single short transaction. Because messages are archived oldest first, each
+session's archive is an id prefix of its history and segments never overlap.
+
+``SessionArchive`` reads them back as ``ArchivedMessage`` objects, which
+serialize exactly like ``Message``; ``chat.history.history_page`` uses it to
+continue a page into the archive once the hot rows run out. Archived messages
+no longer appear in delta sync, which only carries recent changes, and no
+longer count as unread (see chat.receipts.unread_count): a reader who has
+not opened a session since before the archive cutoff sees only its hot
+messages counted.
+
+Segments are stored on their session's shard, next to its hot messages.
+"""
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import msgpack
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from secure_messenger.metrics import record_cache
+
+from .models import ArchivedSegment, ChatSession, Message, MessageKey
+
+FORMAT_VERSION = 1
+DEFAULT_CHUNK_SIZE = 500
+COMPRESSION_LEVEL = 6
+
+# Decoded segments kept in memory; segments are immutable once written
+SEGMENT_CACHE_SIZE = 64
+
+
+def _to_micros(value):
+    return int(value.timestamp() * 1_000_000)
+
+
+def _from_micros(value):
+    return datetime.fromtimestamp(value / 1_000_000, tz=timezone.utc)
+
+
+def encode_segment(messages, keys):
+    """Pack messages and their wrapped keys ({message_id: {user_id: key}}) into a payload."""
+    rows = [
+        [
+            message.id,
+            message.sender_id,
+            _to_micros(message.timestamp),
+            message.change_seq,
+            bytes(message.content),
+            bytes(message.encryption_key),
+            bytes(message.iv),
+            list(keys.get(message.id, {}).items()),
+        ]
+        for message in messages
+    ]
+    return encode_rows(rows)
+
+
+def encode_rows(rows):
+    """Pack message rows, as returned by ``decode_segment``, into a payload."""
+    packed = msgpack.packb([FORMAT_VERSION, rows], use_bin_type=True)
+    return zlib.compress(packed, COMPRESSION_LEVEL)
+
+
+def decode_segment(payload):
+    """Unpack a segment payload into its message rows in id order."""
+    version, rows = msgpack.unpackb(zlib.decompress(bytes(payload)), raw=False, strict_map_key=False)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported archive segment format {version}")
+    return rows
+
+
+class ArchivedMessage:
+    """A message read back from an archive segment; duck-types ``Message``."""
+
+    __slots__ = ('id', 'sender_id', 'timestamp', 'change_seq', 'content',
+                 'encryption_key', 'iv', 'keys', 'sender')
+
+    def __init__(self, id, sender_id, timestamp, change_seq, content, encryption_key, iv, keys, sender=None):
+        self.id = id
+        self.sender_id = sender_id
+        self.timestamp = _from_micros(timestamp)
+        self.change_seq = change_seq
+        self.content = content
+        self.encryption_key = encryption_key
+        self.iv = iv
+        self.keys = dict(keys)
+        self.sender = sender
+
+    def wrapped_key_for(self, user_id):
+        """Return the AES key wrapped for a user, or None if they have no key."""
+        wrapped_key = self.keys.get(user_id)
+        return bytes(wrapped_key) if wrapped_key else None
+
+
+class _SegmentCache:
+    """A small thread-safe LRU of decoded segment rows keyed by database and primary key."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, db, pk):
+        key = (db, pk)
+        with self._lock:
+            rows = self._entries.get(key)
+            if rows is not None:
+                self._entries.move_to_end(key)
+        record_cache('archive_segment', rows is not None)
+        if rows is None:
+            payload = ArchivedSegment.objects.using(db).values_list('payload', flat=True).get(pk=pk)
+            rows = decode_segment(payload)
+            with self._lock:
+                self._entries[key] = rows
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return rows
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+segment_cache = _SegmentCache(SEGMENT_CACHE_SIZE)
+
+
+class SessionArchive:
+    """Reads a session's archived messages through the segment range index."""
+
+    def __init__(self, chat_session):
+        # A ChatSession, or its id
+        self.chat_session = chat_session
+
+    def _segments(self):
+        return ArchivedSegment.objects.for_session(self.chat_session)
+
+    def before(self, before_id, count):
+        """Up to ``count`` archived messages with id below ``before_id``, newest first."""
+        segments = self._segments()
+        if before_id is not None:
+            segments = segments.filter(first_message_id__lt=before_id)
+        rows = []
+        for pk in segments.order_by('-first_message_id').values_list('id', flat=True).iterator():
+            for row in reversed(segment_cache.get(segments.db, pk)):
+                if before_id is None or row[0] < before_id:
+                    rows.append(row)
+                    if len(rows) >= count:
+                        return self._messages(rows)
+        return self._messages(rows)
+
+    def after(self, after_id, count):
+        """Up to ``count`` archived messages with id above ``after_id``, oldest first."""
+        segments = self._segments().filter(last_message_id__gt=after_id)
+        rows = []
+        # Segment ranges are disjoint, so this is also first_message_id order
+        for pk in segments.order_by('last_message_id').values_list('id', flat=True).iterator():
+            for row in segment_cache.get(segments.db, pk):
+                if row[0] > after_id:
+                    rows.append(row)
+                    if len(rows) >= count:
+                        return self._messages(rows)
+        return self._messages(rows)
+
+    def all(self):
+        """Every archived message of the session in id order."""
+        return self.after(0, float('inf'))
+
+    def iter_messages(self):
+        """Yield every archived message in id order, decoding one segment at a time."""
+        segments = self._segments().order_by('last_message_id').values_list('payload', flat=True)
+        for payload in segments.iterator(chunk_size=1):
+            yield from self._messages(decode_segment(payload))
+
+    @staticmethod
+    def _messages(rows):
+        senders = get_user_model().objects.in_bulk({row[1] for row in rows})
+        return [ArchivedMessage(*row, sender=senders.get(row[1])) for row in rows]
+
+
+def archive_chunk(chat_session_id, cutoff, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Move up to ``chunk_size`` of a session's messages older than ``cutoff``
+    into a new segment. The session's newest message always stays hot so
+    the last-message pointer remains valid. Returns the number archived.
+    """
+    row = ChatSession.objects.filter(pk=chat_session_id).values_list('last_message_id', 'shard').first()
+    if row is None:
+        return 0
+    last_message_id, db = row[0], row[1] or DEFAULT_DB_ALIAS
+    with transaction.atomic(using=db):
+        messages = Message.objects.using(db).filter(chat_session_id=chat_session_id, timestamp__lt=cutoff)
+        if last_message_id is not None:
+            messages = messages.filter(id__lt=last_message_id)
+        messages = list(messages.order_by('id')[:chunk_size])
+        if not messages:
+            return 0
+
+        message_ids = [message.id for message in messages]
+        keys = {}
+        for message_id, recipient_id, wrapped_key in MessageKey.objects.using(db).filter(
+            message_id__in=message_ids
+        ).values_list('message_id', 'recipient_id', 'wrapped_key'):
+            keys.setdefault(message_id, {})[recipient_id] = bytes(wrapped_key)
+
+        ArchivedSegment.objects.using(db).create(
+            chat_session_id=chat_session_id,
+            first_message_id=messages[0].id,
+            last_message_id=messages[-1].id,
+            first_timestamp=messages[0].timestamp,
+            last_timestamp=messages[-1].timestamp,
+            message_count=len(messages),
+            payload=encode_segment(messages, keys)
+        )
+        MessageKey.objects.using(db).filter(message_id__in=message_ids).delete()
+        Message.objects.using(db).filter(id__in=message_ids).delete()
+        # Cached history and unread counts change with the move
+        ChatSession.bump_version(chat_session_id, using=db)
+    return len(messages)
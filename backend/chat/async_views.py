@@ -0,0 +1,244 @@
+"""
+ASGI-native versions of the hot chat endpoints: the session list, a
+session's history and sending a message.
+
+Under ASGI, Django runs each sync view on a thread of its own for the whole
+request, so the number of requests in flight is bounded by threads. These
+views await instead. Database work goes to ``db_executor``, a fixed set of
+ASYNC_DB_WORKERS threads, and message encryption to ``crypto_executor``
+(ASYNC_CRYPTO_WORKERS), so encrypting never holds a database thread. A
+waiting request costs a coroutine rather than a thread, and one worker
+process can hold thousands of them.
+
+Django 4.2's async ORM methods (``aget()``, ``aexists()``...) wrap the sync
+ORM in ``sync_to_async`` and run on that same per-request thread, so these
+views hand whole units of database work to the pool instead, e.g. the
+participant check together with the key lookup. A token found in the token
+cache is resolved on the event loop without any hop at all.
+
+Responses match the ChatSessionViewSet actions they stand in for,
+including the history ETags. The routes are mounted in place of those
+actions unless ASYNC_CHAT_VIEWS is off; requests these views do not handle
+(creating a session) are passed on to the viewset.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import HttpResponseNotAllowed, HttpResponseNotModified, JsonResponse
+from rest_framework import exceptions, status
+from rest_framework.authentication import get_authorization_header
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+from encryption.utils import encrypt_message_for_participants
+from secure_messenger.instrumentation import log_sampled, phase
+from secure_messenger.metrics import MESSAGES_SENT, count_request_queries, record_cache
+from secure_messenger.parsers import request_data
+from secure_messenger.routers import replica_reads
+from users.authentication import CachedTokenAuthentication
+
+from .conditional import etag_matches, stats as conditional_stats, view_etag
+from .history import parse_page_params, wants_page
+from .models import ChatSession, Message
+from .receipts import coalescer as read_coalescer
+from .serializers import MessageSerializer, serialize_sessions
+from .views import (
+    ChatSessionViewSet,
+    message_recipients,
+    session_history,
+    user_sessions
+)
+
+logger = logging.getLogger(__name__)
+
+db_executor = ThreadPoolExecutor(getattr(settings, 'ASYNC_DB_WORKERS', 8), thread_name_prefix='async-db')
+crypto_executor = ThreadPoolExecutor(getattr(settings, 'ASYNC_CRYPTO_WORKERS', 2), thread_name_prefix='async-crypto')
+
+# Requests the async views leave to the viewset
+_session_viewset = ChatSessionViewSet.as_view({'get': 'list', 'post': 'create'})
+
+
+def _database_work(fn):
+    def run(*args):
+        try:
+            with count_request_queries():
+                return fn(*args)
+        finally:
+            # What request_finished does for a sync view's thread
+            close_old_connections()
+    return run
+
+
+async def in_database(fn, *args):
+    """Run ``fn`` on the database pool."""
+    return await sync_to_async(_database_work(fn), thread_sensitive=False, executor=db_executor)(*args)
+
+
+async def in_crypto(fn, *args):
+    """Run ``fn`` on the encryption pool."""
+    return await sync_to_async(fn, thread_sensitive=False, executor=crypto_executor)(*args)
+
+
+def _json(data, status_code=status.HTTP_200_OK):
+    return JsonResponse(data, status=status_code, safe=False, encoder=JSONEncoder)
+
+
+def _api_error(exc):
+    """Render a DRF exception as DRF's exception handler would."""
+    response = _json({'detail': exc.detail}, exc.status_code)
+    auth_header = getattr(exc, 'auth_header', None)
+    if auth_header:
+        response['WWW-Authenticate'] = auth_header
+    return response
+
+
+def _drf_authenticate(request):
+    """Run the configured DRF authenticators, including session auth and its CSRF check."""
+    authenticators = [auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    user = Request(request, authenticators=authenticators).user
+    if not user.is_authenticated:
+        exc = exceptions.NotAuthenticated()
+        exc.auth_header = authenticators[0].authenticate_header(request) if authenticators else None
+        raise exc
+    return user
+
+
+async def authenticate(request):
+    """
+    Authenticate the request as the DRF views do and set ``request.user``.
+    Returns an error response to send instead, or None.
+    """
+    auth = get_authorization_header(request).split()
+    if len(auth) == 2 and auth[0].lower() == b'token':
+        try:
+            credentials = CachedTokenAuthentication().cached_credentials(auth[1].decode())
+        except UnicodeError:
+            credentials = None
+        if credentials is not None:
+            request.user = credentials[0]
+            return None
+    try:
+        request.user = await in_database(_drf_authenticate, request)
+    except exceptions.APIException as e:
+        return _api_error(e)
+    return None
+
+
+def _participating_session(request, pk):
+    """The session, if the requester is an active participant, as the viewset's get_object finds it."""
+    return ChatSession.objects.filter(
+        id=pk,
+        participants__user=request.user,
+        participants__is_active=True
+    ).first()
+
+
+def _not_found():
+    return _json({'detail': exceptions.NotFound.default_detail}, status.HTTP_404_NOT_FOUND)
+
+
+def _session_list(request):
+    with replica_reads():
+        with phase('serialize'):
+            return serialize_sessions(user_sessions(request.user), request.user)
+
+
+def _history(request, pk):
+    """The history GET of the messages action, with its ETag and 304 answer."""
+    start = time.perf_counter()
+    with replica_reads():
+        chat_session = _participating_session(request, pk)
+        if chat_session is None:
+            return _not_found()
+        etag = view_etag('messages', request.GET, pk, chat_session.version, chat_session.change_seq, request.user.id)
+        if etag_matches(request, etag):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            conditional_stats.record(True, time.perf_counter() - start)
+            record_cache('conditional_get', True)
+            return response
+
+        page_params = None
+        if wants_page(request.GET):
+            try:
+                page_params = parse_page_params(request.GET)
+            except ValueError:
+                return _json({'error': 'Invalid page parameters'}, status.HTTP_400_BAD_REQUEST)
+        response = _json(session_history(chat_session, request, page_params))
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    conditional_stats.record(False, time.perf_counter() - start)
+    record_cache('conditional_get', False)
+    return response
+
+
+def _recipients(request, pk):
+    chat_session = _participating_session(request, pk)
+    if chat_session is None:
+        return None, None, None
+    public_keys, recipients = message_recipients(chat_session)
+    return chat_session, public_keys, recipients
+
+
+def _encrypt(content, public_keys):
+    with phase('encrypt'):
+        return encrypt_message_for_participants(content, public_keys)
+
+
+def _store(request, chat_session, encrypted_data, recipients):
+    with phase('persist'):
+        message = Message.objects.create_encrypted(chat_session, request.user, encrypted_data, recipients)
+    # A sender has read everything up to their own message
+    read_coalescer.mark_read(chat_session.id, request.user.id, message.id)
+    with phase('serialize'):
+        return message, MessageSerializer(message, context={'request': request}).data
+
+
+async def _send(request, pk):
+    data = request_data(request)
+    if data is None:
+        return _json({'error': 'Malformed request body'}, status.HTTP_400_BAD_REQUEST)
+
+    chat_session, public_keys, recipients = await in_database(_recipients, request, pk)
+    if chat_session is None:
+        return _not_found()
+    encrypted_data = await in_crypto(_encrypt, data.get('content', ''), public_keys)
+    message, response_data = await in_database(_store, request, chat_session, encrypted_data, recipients)
+
+    MESSAGES_SENT.labels('rest').inc()
+    log_sampled(logger, logging.DEBUG, "Message %s created in chat %s for %d recipients",
+                message.id, chat_session.id, len(public_keys))
+    return _json(response_data, status.HTTP_201_CREATED)
+
+
+async def session_list_view(request):
+    """GET /api/chats/: the user's sessions, most recently active first."""
+    if request.method not in ('GET', 'HEAD'):
+        return await sync_to_async(_session_viewset)(request)
+    error = await authenticate(request)
+    if error is not None:
+        return error
+    return _json(await in_database(_session_list, request))
+
+
+async def session_messages_view(request, pk):
+    """GET and POST /api/chats/<pk>/messages/: a session's history, or send a message to it."""
+    if request.method not in ('GET', 'HEAD', 'POST'):
+        return HttpResponseNotAllowed(['GET', 'HEAD', 'POST'])
+    error = await authenticate(request)
+    if error is not None:
+        return error
+    if request.method == 'POST':
+        return await _send(request, pk)
+    return await in_database(_history, request, pk)
+
+
+# Like DRF's views, exempt from Django's CSRF check; session-authenticated
+# requests are checked by DRF's SessionAuthentication in authenticate()
+session_list_view.csrf_exempt = True
+session_messages_view.csrf_exempt = True
@@ -0,0 +1,133 @@
+import functools
+import threading
+import time
+import zlib
+from urllib.parse import urlencode
+
+from rest_framework import status
+from rest_framework.response import Response
+
+from secure_messenger.metrics import record_cache
+
+from .models import ChatSession
+
+
+class ConditionalGetStats:
+    """Counts conditional GET outcomes and the time spent on each path."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.not_modified = 0
+            self.full = 0
+            self.not_modified_seconds = 0.0
+            self.full_seconds = 0.0
+
+    def record(self, not_modified, seconds):
+        with self._lock:
+            if not_modified:
+                self.not_modified += 1
+                self.not_modified_seconds += seconds
+            else:
+                self.full += 1
+                self.full_seconds += seconds
+
+    def snapshot(self):
+        """Return the counters plus the 304 ratio and estimated time saved."""
+        with self._lock:
+            total = self.not_modified + self.full
+            avg_full = self.full_seconds / self.full if self.full else 0.0
+            avg_not_modified = self.not_modified_seconds / self.not_modified if self.not_modified else 0.0
+            return {
+                'requests': total,
+                'not_modified': self.not_modified,
+                'full': self.full,
+                'not_modified_ratio': self.not_modified / total if total else 0.0,
+                'avg_full_ms': avg_full * 1000,
+                'avg_not_modified_ms': avg_not_modified * 1000,
+                'estimated_ms_saved': max(avg_full - avg_not_modified, 0.0) * self.not_modified * 1000,
+            }
+
+
+stats = ConditionalGetStats()
+
+
+def session_etag(session_id, version, change_seq, user_id, variant=''):
+    """Build a weak validator for a view of a chat session."""
+    tag = f"s{session_id}-v{version}-c{change_seq}-u{user_id}"
+    if variant:
+        tag = f"{tag}-{variant}"
+    return f'W/"{tag}"'
+
+
+def view_etag(view_name, query_params, session_id, version, change_seq, user_id):
+    """The validator for one view of a session, with its query parameters folded in."""
+    variant = view_name
+    if query_params:
+        query = urlencode(sorted(query_params.items())).encode('utf-8')
+        variant = f"{variant}-{zlib.crc32(query):08x}"
+    return session_etag(session_id, version, change_seq, user_id, variant)
+
+
+def etag_matches(request, etag):
+    """Weakly compare an ETag against the request's If-None-Match header."""
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def conditional_session_get(view_method):
+    """
+    Answer GETs on a chat session view with 304 when the client is current.
+
+    The validator comes from a single indexed lookup of the session's change
+    version, so an unchanged session is answered without reading messages or
+    running serializers. Query parameters are folded into the tag so each
+    history page validates independently.
+    """
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view_method(self, request, *args, **kwargs)
+
+        start = time.perf_counter()
+        row = ChatSession.objects.filter(
+            id=kwargs.get('pk'),
+            participants__user=request.user,
+            participants__is_active=True
+        ).values_list('version', 'change_seq').first()
+        if row is None:
+            # Let the view produce its usual 404
+            return view_method(self, request, *args, **kwargs)
+
+        etag = view_etag(view_method.__name__, request.query_params, kwargs.get('pk'), row[0], row[1], request.user.id)
+
+        if etag_matches(request, etag):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            response['ETag'] = etag
+            stats.record(True, time.perf_counter() - start)
+            record_cache('conditional_get', True)
+            return response
+
+        response = view_method(self, request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            response['ETag'] = etag
+            response['Cache-Control'] = 'private, no-cache'
+            stats.record(False, time.perf_counter() - start)
+            record_cache('conditional_get', False)
+        return response
+
+    return wrapper
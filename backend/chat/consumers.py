@@ -3,13 +3,11 @@ from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 from .models import ChatSession, ChatParticipant, Message
-from encryption.utils import (
-    encrypt_message_for_participants,
-    decrypt_with_private_key,
-    decrypt_with_aes
-)
+from .receipts import advance_read, coalescer as read_coalescer, fanout as read_fanout
+from secure_messenger.instrumentation import event_timings, log_sampled, phase
+from secure_messenger.metrics import GROUP_SEND_SECONDS, MESSAGES_SENT, WEBSOCKET_CONNECTIONS
+from encryption.utils import encrypt_message_for_participants
 import logging
-import base64
 
 User = get_user_model()
 
@@ -39,9 +37,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
         
         await self.accept()
+        self.connection_counted = True
+        WEBSOCKET_CONNECTIONS.inc()
         
         # Notify other participants that this user has joined
-        await self.channel_layer.group_send(
+        await self.group_send(
             self.room_group_name,
             {
                 'type': 'user_join',
@@ -50,6 +50,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
     
     async def disconnect(self, close_code):
+        if getattr(self, 'connection_counted', False):
+            WEBSOCKET_CONNECTIONS.dec()
+            self.connection_counted = False
+        
         # Leave room group
         if hasattr(self, 'room_group_name'):
             await self.channel_layer.group_discard(
@@ -58,7 +62,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             )
             
             # Notify other participants that this user has left
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.room_group_name,
                 {
                     'type': 'user_leave',
@@ -71,43 +75,51 @@ class ChatConsumer(AsyncWebsocketConsumer):
         message_type = data.get('type', 'message')
         
         if message_type == 'message':
-            content = data.get('content', '')
-            
-            # Get all active participants and their public keys
-            participants = await self.get_participants(self.chat_session_id)
-            participants_public_keys = {
-                participant.user.username: participant.user.public_key
-                for participant in participants
-            }
-            
-            # Encrypt the message for all participants
-            encrypted_data = encrypt_message_for_participants(content, participants_public_keys)
-            
-            # Log encryption details
-            logger.info(f"WebSocket message encryption details:")
-            logger.info(f"Original content: {content}")
-            logger.info(f"Encrypted content: {encrypted_data['encrypted_content']}")
-            logger.info(f"IV: {encrypted_data['iv']}")
-            logger.info(f"Encrypted keys: {json.dumps(encrypted_data['encrypted_keys'], indent=2)}")
-            
-            # Save message to database
-            message = await self.save_message(
-                self.scope['user'],
-                self.chat_session_id,
-                encrypted_data['encrypted_content'],
-                encrypted_data['encrypted_keys'][self.scope['user'].username],
-                encrypted_data['iv']
+            with event_timings('ws.message'):
+                await self.receive_message(data.get('content', ''))
+        
+        elif message_type == 'read':
+            await self.receive_read(data.get('message_id'))
+        
+        elif message_type == 'typing':
+            # Send typing notification to room group
+            await self.group_send(
+                self.room_group_name,
+                {
+                    'type': 'user_typing',
+                    'username': self.scope['user'].username,
+                    'is_typing': data.get('is_typing', False)
+                }
             )
-            
-            # Log message details
-            logger.info(f"WebSocket message created:")
-            logger.info(f"Message ID: {message.id}")
-            logger.info(f"Chat Session: {self.chat_session_id}")
-            logger.info(f"Sender: {self.scope['user'].username}")
-            logger.info(f"Content: {encrypted_data['encrypted_content']}")
-            
-            # Send message to room group
-            await self.channel_layer.group_send(
+    
+    async def receive_message(self, content):
+        # Get all active participants and their public keys
+        participants = await self.get_participants(self.chat_session_id)
+        participants_public_keys = {
+            participant.user.username: participant.user.public_key
+            for participant in participants
+        }
+        recipients = {participant.user.username: participant.user.id for participant in participants}
+        
+        # Encrypt the message for all participants
+        with phase('encrypt'):
+            encrypted_data = encrypt_message_for_participants(content, participants_public_keys)
+        
+        # Save message to database
+        message = await self.save_message(
+            self.scope['user'],
+            self.chat_session_id,
+            encrypted_data,
+            recipients
+        )
+        
+        MESSAGES_SENT.labels('websocket').inc()
+        log_sampled(logger, logging.DEBUG, "WebSocket message %s created in chat %s by %s",
+                    message.id, self.chat_session_id, self.scope['user'].username)
+        
+        # Send message to room group
+        with phase('group_send'):
+            await self.group_send(
                 self.room_group_name,
                 {
                     'type': 'chat_message',
@@ -119,23 +131,30 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     'timestamp': message.timestamp.isoformat()
                 }
             )
-        
-        elif message_type == 'typing':
-            # Send typing notification to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_typing',
-                    'username': self.scope['user'].username,
-                    'is_typing': data.get('is_typing', False)
-                }
-            )
+    
+    async def receive_read(self, message_id):
+        try:
+            message_id = int(message_id)
+        except (TypeError, ValueError):
+            return
+        result = await self.advance_read(self.scope['user'], self.chat_session_id, message_id)
+        if result is None:
+            return
+        position, advanced = result
+        if advanced:
+            # Receipts are batched per session before they are broadcast
+            read_fanout.publish(self.channel_layer, self.room_group_name, self.scope['user'].username, position)
+    
+    async def group_send(self, group, event):
+        """Send an event to a group, recording channel layer latency."""
+        with GROUP_SEND_SECONDS.labels(event['type']).time():
+            await self.channel_layer.group_send(group, event)
     
     async def chat_message(self, event):
         # Get the encrypted key for the current user
         user_key = event['encryption_key'].get(self.scope['user'].username)
         if not user_key:
-            logger.error(f"No encryption key found for user {self.scope['user'].username}")
+            logger.error("No encryption key found for user %s", self.scope['user'].username)
             return
         
         # Send message to WebSocket
@@ -157,6 +176,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'is_typing': event['is_typing']
         }))
     
+    async def read_receipts(self, event):
+        # Forward other participants' read positions to WebSocket
+        receipts = [
+            receipt for receipt in event['receipts']
+            if receipt['username'] != self.scope['user'].username
+        ]
+        if receipts:
+            await self.send(text_data=json.dumps({
+                'type': 'read',
+                'receipts': receipts
+            }))
+    
     async def user_join(self, event):
         # Send user join notification to WebSocket
         await self.send(text_data=json.dumps({
@@ -185,20 +216,21 @@ class ChatConsumer(AsyncWebsocketConsumer):
     
     @database_sync_to_async
     def get_participants(self, chat_session_id):
-        chat_session = ChatSession.objects.get(id=chat_session_id)
-        return list(ChatParticipant.objects.filter(
-            chat_session=chat_session,
-            is_active=True
-        ).select_related('user'))
+        with phase('db.participants'):
+            chat_session = ChatSession.objects.get(id=chat_session_id)
+            return list(ChatParticipant.objects.filter(
+                chat_session=chat_session,
+                is_active=True
+            ).select_related('user'))
     
     @database_sync_to_async
-    def save_message(self, user, chat_session_id, encrypted_content, encryption_key, iv):
-        chat_session = ChatSession.objects.get(id=chat_session_id)
-        message = Message.objects.create(
-            chat_session=chat_session,
-            sender=user,
-            content=encrypted_content,
-            encryption_key=encryption_key,
-            iv=iv
-        )
-        return message
\ No newline at end of file
+    def save_message(self, user, chat_session_id, encrypted_data, recipients):
+        with phase('persist'):
+            chat_session = ChatSession.objects.get(id=chat_session_id)
+            message = Message.objects.create_encrypted(chat_session, user, encrypted_data, recipients)
+        read_coalescer.mark_read(chat_session.id, user.id, message.id)
+        return message
+    
+    @database_sync_to_async
+    def advance_read(self, user, chat_session_id, message_id):
+        return advance_read(int(chat_session_id), user, message_id)
\ No newline at end of file
@@ -0,0 +1,80 @@
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, Max, Sum
+
+from .models import ArchivedSegment, ChatParticipant, ChatSession, Message
+
+DEFAULT_CHUNK_SIZE = 500
+
+
+def shard_counters(db, session_ids):
+    """
+    Recompute ``{session id: (message_count, last_message_id, last_message_at)}``
+    for sessions stored on one shard, with one grouped query over the hot
+    messages, one over the archive segments and one lookup. Archived
+    messages count too, as they do in record_message's running total.
+    """
+    archived = ArchivedSegment.objects.using(db).filter(
+        chat_session_id__in=session_ids
+    ).order_by().values('chat_session_id').annotate(
+        total=Sum('message_count'), latest=Max('last_message_id'), latest_at=Max('last_timestamp')
+    )
+    counters = {
+        row['chat_session_id']: (row['total'], row['latest'], row['latest_at']) for row in archived
+    }
+    totals = Message.objects.using(db).filter(
+        chat_session_id__in=session_ids
+    ).order_by().values('chat_session_id').annotate(total=Count('id'), latest=Max('id'))
+    totals = {row['chat_session_id']: (row['total'], row['latest']) for row in totals}
+    timestamps = dict(Message.objects.using(db).filter(
+        id__in=[latest for _, latest in totals.values()]
+    ).values_list('id', 'timestamp'))
+    for chat_session_id, (total, latest) in totals.items():
+        # The archive holds a prefix of the history, so the newest message is hot
+        archived_total = counters.get(chat_session_id, (0,))[0]
+        counters[chat_session_id] = (archived_total + total, latest, timestamps.get(latest))
+    return counters
+
+
+def rebuild_session_counters(chunk_size=DEFAULT_CHUNK_SIZE, progress=None, session_ids=None):
+    """
+    Recompute message_count and the last-message pointer for every session,
+    or only for ``session_ids``, and the participants' copy of last_message_at.
+
+    Sessions are walked in primary key order; each chunk's messages are
+    counted on their shards and the chunk is rewritten in its own short
+    transaction, so the rebuild never holds a long lock.
+    Returns the number of sessions processed.
+    """
+    sessions = ChatSession.objects.all()
+    if session_ids is not None:
+        sessions = sessions.filter(id__in=session_ids)
+    last_id = 0
+    processed = 0
+    while True:
+        chunk = list(
+            sessions.filter(id__gt=last_id).order_by('id').values_list('id', 'shard')[:chunk_size]
+        )
+        if not chunk:
+            return processed
+        by_shard = {}
+        for chat_session_id, shard in chunk:
+            by_shard.setdefault(shard or DEFAULT_DB_ALIAS, []).append(chat_session_id)
+        counters = {}
+        for db, ids in by_shard.items():
+            counters.update(shard_counters(db, ids))
+        updates = []
+        for chat_session_id, _ in chunk:
+            count, last_message_id, last_message_at = counters.get(chat_session_id, (0, None, None))
+            updates.append(ChatSession(
+                id=chat_session_id,
+                message_count=count,
+                last_message_id=last_message_id,
+                last_message_at=last_message_at
+            ))
+        with transaction.atomic():
+            ChatSession.objects.bulk_update(updates, ['message_count', 'last_message', 'last_message_at'])
+            ChatParticipant.copy_last_message_at(chat_session_id__in=[update.id for update in updates])
+        processed += len(chunk)
+        last_id = chunk[-1][0]
+        if progress:
+            progress(processed, last_id)
@@ -0,0 +1,224 @@
+"""
+Streaming NDJSON export and import of a chat session's history.
+
+An export is one JSON object per line: a ``session`` record followed by a
+``message`` record per message in id order, archived messages first. Message
+records have the same shape as ``MessageSerializer`` output, except that
+``encrypted_keys`` holds the key wrapped for every participant rather than
+only the exporter's, so an import restores the history for all of them. Rows
+are read in chunks and written line by line, so memory stays flat however
+long the history is.
+
+An import only goes into a session without messages: imported messages take
+new ids, which would otherwise interleave with the existing ones out of
+timestamp order. Within a session record, message records must come in
+ascending original id order, as an export writes them; a record that does
+not is a duplicate and is skipped.
+"""
+import base64
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+from rest_framework.utils.encoders import JSONEncoder
+
+from .archive import SessionArchive
+from .models import ArchivedSegment, ChangeCounter, ChatParticipant, ChatSession, Message, MessageKey
+from .serializers import MessageSerializer
+from .sharding import bulk_create_messages
+
+FORMAT_VERSION = 1
+CONTENT_TYPE = 'application/x-ndjson'
+
+# Rows fetched per database round trip while exporting
+EXPORT_CHUNK_SIZE = 1000
+# Lines handed to the ASGI server per hop to the worker thread
+ASYNC_BATCH_LINES = 500
+
+
+def _hot_messages(chat_session, user):
+    """Yield ``(message, {recipient id: wrapped key})`` for the session's hot messages in id order."""
+    # Senders are on the default database, so they cannot be joined on a shard
+    messages = Message.objects.with_key_for(user).for_session(
+        chat_session
+    ).prefetch_related('sender').order_by('id')
+    last_id = 0
+    while True:
+        chunk = list(messages.filter(id__gt=last_id)[:EXPORT_CHUNK_SIZE])
+        if not chunk:
+            return
+        keys = {}
+        for message_id, recipient_id, wrapped_key in MessageKey.objects.using(messages.db).filter(
+            message_id__in=[message.id for message in chunk]
+        ).values_list('message_id', 'recipient_id', 'wrapped_key'):
+            keys.setdefault(message_id, {})[recipient_id] = bytes(wrapped_key)
+        for message in chunk:
+            yield message, keys.get(message.id, {})
+        last_id = chunk[-1].id
+
+
+def export_records(chat_session, request):
+    """Yield the session header and then every message as a plain dict."""
+    participants = ChatParticipant.objects.filter(
+        chat_session=chat_session
+    ).order_by('id').values_list('user_id', 'user__username')
+    usernames = dict(participants)
+    yield {
+        'type': 'session',
+        'version': FORMAT_VERSION,
+        'id': chat_session.id,
+        'session_id': chat_session.session_id,
+        'created_at': chat_session.created_at,
+        'participants': [username for _, username in participants],
+    }
+
+    serializer = MessageSerializer(context={'request': request})
+    archived = ((message, message.keys) for message in SessionArchive(chat_session).iter_messages())
+    for source in (archived, _hot_messages(chat_session, request.user)):
+        for message, keys in source:
+            record = serializer.to_representation(message)
+            record['type'] = 'message'
+            record['encrypted_keys'] = {
+                usernames[user_id]: base64.b64encode(wrapped_key).decode('ascii')
+                for user_id, wrapped_key in keys.items()
+                if user_id in usernames
+            }
+            yield record
+
+
+def ndjson_lines(records):
+    """Encode records as newline-delimited JSON."""
+    encoder = JSONEncoder()
+    for record in records:
+        yield encoder.encode(record) + '\n'
+
+
+def streaming_body(lines, request):
+    """
+    Adapt a synchronous line iterator to the server interface.
+
+    Under ASGI a sync iterator would be drained into memory before sending,
+    so it is wrapped in an async generator that pulls batches of lines on
+    Django's sync thread, keeping the database cursor on one connection.
+    """
+    if not isinstance(request, ASGIRequest):
+        return lines
+
+    def next_batch():
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= ASYNC_BATCH_LINES:
+                break
+        return ''.join(batch)
+
+    async def body():
+        while True:
+            chunk = await sync_to_async(next_batch)()
+            if not chunk:
+                return
+            yield chunk
+
+    return body()
+
+
+class ImportStats:
+    """Counts of what an import wrote or skipped."""
+
+    def __init__(self):
+        self.session_ids = []
+        self.messages = 0
+        self.keys = 0
+        self.skipped = 0
+        self.duplicates = 0
+
+
+def has_history(chat_session):
+    """Whether a session holds any messages, hot or archived, and so cannot take an import."""
+    db = ChatSession.shard_of(chat_session)
+    return (
+        Message.objects.using(db).filter(chat_session=chat_session).exists()
+        or ArchivedSegment.objects.using(db).filter(chat_session=chat_session).exists()
+    )
+
+
+def import_records(lines, get_session, batch_size=1000, stats=None):
+    """
+    Bulk-insert message records read from NDJSON ``lines``.
+
+    ``get_session(header)`` returns the target ChatSession for a session
+    record, which must have no history (see has_history), and a
+    ``{username: user}`` map of its participants. Messages are
+    buffered and written ``batch_size`` at a time, each batch in one
+    transaction on the session's shard with a reserved block of message ids
+    and sync sequence numbers.
+    """
+    stats = stats or ImportStats()
+    chat_session = None
+    users_by_name = {}
+    pending = []
+    last_id = 0
+
+    def flush():
+        if not pending:
+            return
+        db = ChatSession.shard_of(chat_session)
+        with transaction.atomic(using=db):
+            first_seq = ChangeCounter.reserve(len(pending), using=db)
+            ids = Message.objects.allocate_ids(db, len(pending))
+            messages = []
+            for offset, (record, sender) in enumerate(pending):
+                messages.append(Message(
+                    id=ids[offset],
+                    chat_session=chat_session,
+                    sender=sender,
+                    content=base64.b64decode(record['content']),
+                    encryption_key=base64.b64decode(record['encryption_key']),
+                    iv=base64.b64decode(record['iv']),
+                    timestamp=parse_datetime(record['timestamp']),
+                    change_seq=first_seq + offset
+                ))
+            bulk_create_messages(db, messages)
+            keys = [
+                MessageKey(
+                    message=message,
+                    recipient=users_by_name[username],
+                    chat_session=chat_session,
+                    wrapped_key=base64.b64decode(wrapped_key)
+                )
+                for message, (record, _) in zip(messages, pending)
+                for username, wrapped_key in record.get('encrypted_keys', {}).items()
+                if username in users_by_name
+            ]
+            MessageKey.objects.using(db).bulk_create(keys, ignore_conflicts=True)
+        stats.messages += len(messages)
+        stats.keys += len(keys)
+        pending.clear()
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        if record.get('type') == 'session':
+            flush()
+            chat_session, users_by_name = get_session(record)
+            stats.session_ids.append(chat_session.id)
+            last_id = 0
+        elif record.get('type') == 'message':
+            sender = users_by_name.get(record['sender']['username'])
+            if chat_session is None or sender is None:
+                stats.skipped += 1
+                continue
+            if record['id'] <= last_id:
+                stats.duplicates += 1
+                continue
+            last_id = record['id']
+            pending.append((record, sender))
+            if len(pending) >= batch_size:
+                flush()
+    flush()
+    return stats
+
@@ -0,0 +1,62 @@
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+HISTORY_PARAMS = ('after', 'before', 'limit')
+
+
+def wants_page(query_params):
+    """Whether the request asked for a cursor-bounded page of history."""
+    return any(name in query_params for name in HISTORY_PARAMS)
+
+
+def parse_page_params(query_params):
+    """
+    Read the ``after``/``before`` message id cursors and ``limit``.
+
+    Raises ValueError for non-numeric values.
+    """
+    after = query_params.get('after')
+    before = query_params.get('before')
+    limit = query_params.get('limit')
+
+    after = int(after) if after not in (None, '') else None
+    before = int(before) if before not in (None, '') else None
+    limit = int(limit) if limit not in (None, '') else DEFAULT_PAGE_SIZE
+    return after, before, max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def history_page(queryset, after=None, before=None, limit=DEFAULT_PAGE_SIZE, archive=None):
+    """
+    Slice a message queryset to one page ordered by id.
+
+    With ``after`` the page walks forward from that id; otherwise it holds the
+    newest ``limit`` messages below ``before`` (or overall). Returns the
+    messages in ascending order and whether more exist in the walk direction.
+
+    ``archive`` is an optional ``chat.archive.SessionArchive``. Archived
+    messages all have lower ids than the hot ones, so a page that runs past
+    the oldest hot row continues into the archive (and a forward walk starts
+    there).
+    """
+    if after is not None:
+        messages = archive.after(after, limit + 1) if archive is not None else []
+        if len(messages) <= limit:
+            hot = queryset.filter(id__gt=after)
+            if before is not None:
+                hot = hot.filter(id__lt=before)
+            messages += list(hot.order_by('id')[:limit + 1 - len(messages)])
+        if before is not None:
+            messages = [message for message in messages if message.id < before]
+        has_more = len(messages) > limit
+        return messages[:limit], has_more
+
+    if before is not None:
+        queryset = queryset.filter(id__lt=before)
+    messages = list(queryset.order_by('-id')[:limit + 1])
+    if archive is not None and len(messages) <= limit:
+        boundary = messages[-1].id if messages else before
+        messages += archive.before(boundary, limit + 1 - len(messages))
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+    return messages, has_more
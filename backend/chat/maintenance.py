@@ -0,0 +1,113 @@
+"""
+Resumable batch jobs for maintenance commands.
+
+A ``BatchJob`` repeatedly calls a step function that handles one bounded,
+index-driven batch in its own short transaction, sleeps between batches so
+request traffic can take the SQLite write lock, and reports progress with a
+rows/sec rate. Progress is kept in a ``MaintenanceCheckpoint`` row so an
+interrupted run continues where it stopped, with the same cutoff.
+"""
+import contextlib
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from .models import MaintenanceCheckpoint
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_PAUSE = 0.1
+
+
+class BatchJob:
+    """A named, checkpointed loop over bounded batches."""
+
+    def __init__(self, name, stdout=None, pause=DEFAULT_PAUSE, restart=False, atomic=True):
+        self.name = name
+        self.stdout = stdout
+        self.pause = pause
+        # Steps that commit on several databases manage their own transactions
+        self.atomic = atomic
+        if restart:
+            MaintenanceCheckpoint.objects.filter(name=name).delete()
+        self.checkpoint, created = MaintenanceCheckpoint.objects.get_or_create(name=name)
+        self.resumed = not created
+
+    def as_of(self):
+        """Return the run's reference time, fixed on first use so resumes agree."""
+        if self.checkpoint.as_of is None:
+            self.checkpoint.as_of = timezone.now()
+            self.checkpoint.save(update_fields=['as_of', 'updated_at'])
+        return self.checkpoint.as_of
+
+    def write(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    def run(self, step):
+        """
+        Call ``step(checkpoint)`` until it returns None.
+
+        Each call handles one batch, may advance ``checkpoint.position`` and
+        returns the number of rows it affected. The checkpoint is saved after
+        every batch and deleted once the job finishes. Returns the number of
+        rows affected in this invocation.
+        """
+        if self.resumed:
+            self.write(f"{self.name}: resuming at position {self.checkpoint.position} "
+                       f"({self.checkpoint.processed} rows done earlier)")
+        start = time.perf_counter()
+        affected = 0
+        batches = 0
+        while True:
+            with transaction.atomic() if self.atomic else contextlib.nullcontext():
+                count = step(self.checkpoint)
+                if count is None:
+                    break
+                self.checkpoint.processed += count
+                self.checkpoint.save()
+            affected += count
+            batches += 1
+            elapsed = time.perf_counter() - start
+            self.write(f"{self.name}: batch {batches}, {affected} rows "
+                       f"({affected / elapsed if elapsed else 0.0:.0f} rows/s)")
+            time.sleep(self.pause)
+
+        elapsed = time.perf_counter() - start
+        total = self.checkpoint.processed
+        self.checkpoint.delete()
+        self.write(f"{self.name}: finished, {affected} rows in {elapsed:.1f}s "
+                   f"({affected / elapsed if elapsed else 0.0:.0f} rows/s), {total} in total")
+        return affected
+
+
+def delete_batch(queryset, limit):
+    """Delete at most ``limit`` rows matching ``queryset``; returns the count."""
+    ids = list(queryset.order_by().values_list('pk', flat=True)[:limit])
+    if ids:
+        queryset.model._base_manager.using(queryset.db).filter(pk__in=ids).delete()
+    return len(ids)
+
+
+class BatchJobCommand(BaseCommand):
+    """Base for maintenance commands built on ``BatchJob``."""
+    job_name = None
+    atomic_steps = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help='Rows per batch and per write transaction')
+        parser.add_argument('--pause', type=float, default=DEFAULT_PAUSE,
+                            help='Seconds to sleep between batches')
+        parser.add_argument('--restart', action='store_true',
+                            help='Discard a saved checkpoint instead of resuming from it')
+
+    def create_job(self, options):
+        return BatchJob(
+            self.job_name,
+            stdout=self.stdout if options['verbosity'] > 0 else None,
+            pause=options['pause'],
+            restart=options['restart'],
+            atomic=self.atomic_steps
+        )
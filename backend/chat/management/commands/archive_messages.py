@@ -0,0 +1,48 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.archive import DEFAULT_CHUNK_SIZE, archive_chunk
+from chat.models import ChatSession
+
+
+class Command(BaseCommand):
+    help = 'Move old messages into compressed per-session archive segments, one bounded chunk at a time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int,
+                            default=getattr(settings, 'MESSAGE_ARCHIVE_AFTER_DAYS', 90))
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help='Messages per segment and per write transaction')
+        parser.add_argument('--pause', type=float, default=0.05,
+                            help='Seconds to sleep between chunks so writers are not starved')
+        parser.add_argument('--session', type=int, help='Only archive this chat session')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['older_than_days'])
+        sessions = ChatSession.objects.order_by('id')
+        if options['session']:
+            sessions = sessions.filter(id=options['session'])
+
+        start = time.perf_counter()
+        archived = 0
+        segments = 0
+        for chat_session_id in list(sessions.values_list('id', flat=True)):
+            while True:
+                count = archive_chunk(chat_session_id, cutoff, options['chunk_size'])
+                if not count:
+                    break
+                archived += count
+                segments += 1
+                if options['verbosity'] > 1:
+                    self.stdout.write(f"  session {chat_session_id}: archived {count} messages")
+                time.sleep(options['pause'])
+
+        elapsed = time.perf_counter() - start
+        rate = archived / elapsed if elapsed else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {archived} messages into {segments} segments in {elapsed:.1f}s ({rate:.0f} msg/s)"
+        ))
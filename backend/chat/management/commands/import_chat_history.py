@@ -0,0 +1,57 @@
+import contextlib
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.counters import rebuild_session_counters
+from chat.export import ImportStats, has_history, import_records
+from chat.models import ChatParticipant, ChatSession
+
+
+class Command(BaseCommand):
+    help = 'Import chat history from an NDJSON export, streaming it in bulk-inserted batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="NDJSON file produced by the export action, or '-' for stdin")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--session-id', help='Import into this session_id instead of the exported one')
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+
+        def get_session(header):
+            session_id = options['session_id'] or header['session_id']
+            chat_session, created = ChatSession.objects.get_or_create(session_id=session_id)
+            if not created and has_history(chat_session):
+                raise CommandError(
+                    f"Session {session_id} already has messages; import into a new --session-id"
+                )
+            users = User.objects.filter(username__in=header['participants'])
+            users_by_name = {user.username: user for user in users}
+            missing = set(header['participants']) - set(users_by_name)
+            if missing:
+                self.stderr.write(f"Skipping unknown participants: {', '.join(sorted(missing))}")
+            for user in users_by_name.values():
+                ChatParticipant.objects.get_or_create(chat_session=chat_session, user=user)
+            return chat_session, users_by_name
+
+        try:
+            if options['path'] == '-':
+                handle = contextlib.nullcontext(sys.stdin)
+            else:
+                handle = open(options['path'], encoding='utf-8')
+        except OSError as e:
+            raise CommandError(str(e))
+        stats = ImportStats()
+        try:
+            with handle as lines:
+                import_records(lines, get_session, options['batch_size'], stats)
+        finally:
+            # bulk_create bypasses Message.save, so recompute the session counters
+            rebuild_session_counters(session_ids=stats.session_ids)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats.messages} messages and {stats.keys} wrapped keys into "
+            f"{len(stats.session_ids)} sessions ({stats.skipped} skipped, {stats.duplicates} duplicates)"
+        ))
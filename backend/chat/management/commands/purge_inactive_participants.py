@@ -0,0 +1,52 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import F
+
+from chat.maintenance import BatchJobCommand, delete_batch
+from chat.models import ChatParticipant, ChatSession, MessageKey
+
+
+class Command(BatchJobCommand):
+    help = 'Delete participants that left their chat session longer ago than the retention period.'
+    job_name = 'purge_inactive_participants'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--days', type=int,
+                            default=getattr(settings, 'PARTICIPANT_RETENTION_DAYS', 30))
+
+    def handle(self, *args, **options):
+        job = self.create_job(options)
+        cutoff = job.as_of() - timedelta(days=options['days'])
+        batch_size = options['batch_size']
+
+        def step(checkpoint):
+            # Oldest departures first, straight off the deactivated_at index
+            participants = list(ChatParticipant.objects.filter(
+                is_active=False,
+                deactivated_at__lt=cutoff
+            ).order_by('deactivated_at').values_list('id', 'chat_session_id', 'user_id', 'chat_session__shard')[:batch_size])
+            if not participants:
+                return None
+
+            # Leftover wrapped keys go first, a bounded batch at a time, on the
+            # shard holding the session
+            for _, chat_session_id, user_id, shard in participants:
+                deleted = delete_batch(
+                    MessageKey.objects.using(shard or DEFAULT_DB_ALIAS).filter(
+                        recipient_id=user_id, chat_session_id=chat_session_id
+                    ),
+                    batch_size
+                )
+                if deleted:
+                    return deleted
+
+            ChatParticipant.objects.filter(id__in=[pk for pk, _, _, _ in participants]).delete()
+            ChatSession.objects.filter(
+                id__in={chat_session_id for _, chat_session_id, _, _ in participants}
+            ).update(version=F('version') + 1)
+            return len(participants)
+
+        job.run(step)
@@ -0,0 +1,66 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Exists, OuterRef, Q
+
+from chat.maintenance import BatchJobCommand, delete_batch
+from chat.models import ArchivedSegment, ChatParticipant, ChatSession, Message, MessageKey
+
+
+class Command(BatchJobCommand):
+    help = ('Delete chat sessions that are inactive or have no active participants and have '
+            'seen no messages within the retention period, together with their history.')
+    job_name = 'purge_inactive_sessions'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--days', type=int,
+                            default=getattr(settings, 'SESSION_RETENTION_DAYS', 180))
+
+    def handle(self, *args, **options):
+        job = self.create_job(options)
+        cutoff = job.as_of() - timedelta(days=options['days'])
+        batch_size = options['batch_size']
+
+        def purgeable(ids):
+            active_participants = ChatParticipant.objects.filter(chat_session=OuterRef('pk'), is_active=True)
+            return ChatSession.objects.filter(id__in=ids).filter(
+                Q(is_active=False) | ~Exists(active_participants)
+            ).filter(
+                Q(last_message_at__lt=cutoff) | Q(last_message_at__isnull=True, created_at__lt=cutoff)
+            ).order_by('id').values_list('id', 'shard')
+
+        def step(checkpoint):
+            # Walk sessions in primary key order; the position is the last id
+            # whose purge has completed
+            ids = list(ChatSession.objects.filter(
+                id__gt=checkpoint.position
+            ).order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return None
+
+            deleted = 0
+            for chat_session_id, shard in purgeable(ids):
+                ChatSession.objects.filter(id=chat_session_id).update(last_message=None)
+                # Children are removed in bounded batches, history from the
+                # session's shard; the session row goes last so an interrupted
+                # purge is picked up again
+                db = shard or DEFAULT_DB_ALIAS
+                for queryset in (
+                    MessageKey.objects.using(db).filter(chat_session_id=chat_session_id),
+                    Message.objects.using(db).filter(chat_session_id=chat_session_id),
+                    ArchivedSegment.objects.using(db).filter(chat_session_id=chat_session_id),
+                    ChatParticipant.objects.filter(chat_session_id=chat_session_id),
+                ):
+                    deleted += delete_batch(queryset, batch_size - deleted)
+                    if deleted >= batch_size:
+                        checkpoint.position = chat_session_id - 1
+                        return deleted
+                ChatSession.objects.filter(id=chat_session_id).delete()
+                deleted += 1
+
+            checkpoint.position = ids[-1]
+            return deleted
+
+        job.run(step)
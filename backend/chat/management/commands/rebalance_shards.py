@@ -0,0 +1,82 @@
+from django.core.management.base import CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from chat.maintenance import BatchJobCommand
+from chat.models import ChatSession
+from chat.sharding import DEFAULT_MOVE_CHUNK_SIZE, move_session
+from secure_messenger.routers import home_shard, message_shards
+
+
+class Command(BatchJobCommand):
+    help = ('Move chat sessions onto the shard their id hashes to under the current MESSAGE_SHARDS, '
+            'or move one session to a chosen shard.')
+    job_name = 'rebalance_shards'
+    # Each move commits on two databases, in its own transactions
+    atomic_steps = False
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.set_defaults(batch_size=100)
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_MOVE_CHUNK_SIZE,
+                            help='Messages copied per write transaction')
+        parser.add_argument('--session', type=int, help='Only move this chat session')
+        parser.add_argument('--to', help='Shard alias to move --session to instead of its hashed shard')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report how many sessions each shard holds and would give up')
+
+    def handle(self, *args, **options):
+        shards = message_shards()
+        if options['to'] and not options['session']:
+            raise CommandError('--to needs --session')
+        if options['to'] and options['to'] not in shards:
+            raise CommandError(f"Unknown shard {options['to']!r}; configured shards: {', '.join(shards)}")
+
+        if options['dry_run']:
+            return self.report(shards)
+
+        if options['session']:
+            chat_session = ChatSession.objects.filter(pk=options['session']).first()
+            if chat_session is None:
+                raise CommandError(f"Chat session {options['session']} not found")
+            source = chat_session.shard or DEFAULT_DB_ALIAS
+            target = options['to'] or home_shard(chat_session.pk)
+            moved = move_session(chat_session, target, options['chunk_size'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Session {chat_session.pk}: moved {moved} messages from {source} to {target}"
+                if source != target else f"Session {chat_session.pk} is already on {target}"
+            ))
+            return
+
+        job = self.create_job(options)
+        batch_size = options['batch_size']
+
+        def step(checkpoint):
+            sessions = list(ChatSession.objects.filter(
+                id__gt=checkpoint.position
+            ).order_by('id').only('id', 'shard')[:batch_size])
+            if not sessions:
+                return None
+            moved = 0
+            for chat_session in sessions:
+                target = home_shard(chat_session.pk)
+                if (chat_session.shard or DEFAULT_DB_ALIAS) != target:
+                    moved += move_session(chat_session, target, options['chunk_size'])
+                    # Resume after the last session that has fully moved
+                    checkpoint.position = chat_session.pk
+                    checkpoint.save()
+            checkpoint.position = sessions[-1].pk
+            return moved
+
+        job.run(step)
+
+    def report(self, shards):
+        held = {alias: 0 for alias in shards}
+        leaving = {alias: 0 for alias in shards}
+        for chat_session_id, shard in ChatSession.objects.values_list('id', 'shard').iterator():
+            shard = shard or DEFAULT_DB_ALIAS
+            held[shard] = held.get(shard, 0) + 1
+            if shard != home_shard(chat_session_id):
+                leaving[shard] = leaving.get(shard, 0) + 1
+        for alias, count in held.items():
+            note = '' if alias in shards else ' (not in MESSAGE_SHARDS)'
+            self.stdout.write(f"{alias}: {count} sessions, {leaving.get(alias, 0)} to move{note}")
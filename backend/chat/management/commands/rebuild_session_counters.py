@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from chat.counters import DEFAULT_CHUNK_SIZE, rebuild_session_counters
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized message counters and last-message pointers of chat sessions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        def progress(processed, last_id):
+            if options['verbosity'] > 1:
+                self.stdout.write(f"  {processed} sessions (up to id {last_id})")
+
+        processed = rebuild_session_counters(options['chunk_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt counters for {processed} sessions"))
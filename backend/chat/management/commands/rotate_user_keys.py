@@ -0,0 +1,76 @@
+import os
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import CommandError
+
+from chat.maintenance import BatchJobCommand
+from chat.rotation import DEFAULT_CHUNK_SIZE, KeyRotation
+
+
+def read_key(path):
+    try:
+        with open(path, encoding='utf-8') as handle:
+            return handle.read()
+    except OSError as e:
+        raise CommandError(str(e))
+
+
+class Command(BatchJobCommand):
+    help = ("Move a user to a new RSA key pair, re-wrapping the message keys of their whole history, "
+            "hot and archived, on a process pool. An interrupted run resumes at the session it stopped in.")
+    # Each chunk commits on its session's shard
+    atomic_steps = False
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.set_defaults(pause=0.0)
+        parser.add_argument('username')
+        parser.add_argument('--old-private-key', required=True, help='PEM file with the private key being retired')
+        parser.add_argument('--new-private-key', required=True, help='PEM file with the replacement private key')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Processes unwrapping and re-wrapping keys')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help='Keys read and written back per transaction')
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get(username=options['username'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f"User {options['username']!r} not found")
+        try:
+            rotation = KeyRotation(
+                user,
+                read_key(options['old_private_key']),
+                read_key(options['new_private_key']),
+                options['workers'],
+                options['chunk_size']
+            )
+            switched = rotation.switch_keys()
+        except ValueError as e:
+            raise CommandError(str(e))
+        if switched:
+            self.stdout.write(f"{user.username} now uses the new key pair")
+
+        self.job_name = f'rotate_user_keys:{user.pk}'
+        job = self.create_job(options)
+        start = time.perf_counter()
+        with rotation:
+            def step(checkpoint):
+                row = rotation.sessions(checkpoint.position).first()
+                if row is None:
+                    return None
+                rewrapped = rotation.rotate_session(*row)
+                checkpoint.position = row[0]
+                return rewrapped
+
+            job.run(step)
+        elapsed = time.perf_counter() - start
+
+        rate = rotation.rewrapped / elapsed / options['workers'] if elapsed else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            f"Re-wrapped {rotation.rewrapped} keys in {elapsed:.1f}s ({rate:.0f} keys/s per core); "
+            f"{rotation.already_done} were already done"
+        ))
+        if rotation.unreadable:
+            self.stderr.write(f"{rotation.unreadable} keys open with neither private key and were left as they are")
@@ -0,0 +1,35 @@
+from daphne.server import Server
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from secure_messenger.compression import accept_websocket_compression
+
+
+class CompressingServer(Server):
+    """Daphne, negotiating permessage-deflate on WebSocket handshakes."""
+
+    def listen_success(self, port):
+        # run() builds the factory and then listens; this runs before the
+        # reactor starts accepting connections
+        self.ws_factory.setProtocolOptions(perMessageCompressionAccept=accept_websocket_compression)
+        super().listen_success(port)
+
+
+class Command(BaseCommand):
+    help = ('Serve the ASGI application (HTTP and WebSockets) with Daphne. WebSocket messages are '
+            'compressed with permessage-deflate for clients that offer it, unless WEBSOCKET_COMPRESSION is off.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bind', default='127.0.0.1', help='Interface to listen on')
+        parser.add_argument('--port', type=int, default=8000)
+
+    def handle(self, *args, **options):
+        from secure_messenger.asgi import application
+
+        server_class = CompressingServer if getattr(settings, 'WEBSOCKET_COMPRESSION', False) else Server
+        self.stdout.write(f"Serving on http://{options['bind']}:{options['port']}/")
+        server_class(
+            application,
+            endpoints=[f"tcp:port={options['port']}:interface={options['bind']}"],
+            verbosity=options['verbosity']
+        ).run()
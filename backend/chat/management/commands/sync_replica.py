@@ -0,0 +1,40 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from secure_messenger.routers import REPLICA_ALIAS
+
+
+class Command(BaseCommand):
+    help = 'Copy the primary SQLite database into the read replica with the online backup API.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running and refresh the replica every INTERVAL seconds')
+        parser.add_argument('--pages', type=int, default=-1,
+                            help='Pages copied per backup step; -1 copies everything in one step')
+
+    def handle(self, *args, **options):
+        if REPLICA_ALIAS not in settings.DATABASES:
+            raise CommandError('No replica configured; set DATABASE_REPLICA_PATH')
+        primary = str(settings.DATABASES['default']['NAME'])
+        replica = str(settings.DATABASES[REPLICA_ALIAS]['NAME'])
+
+        while True:
+            start = time.perf_counter()
+            source = sqlite3.connect(primary)
+            target = sqlite3.connect(replica)
+            try:
+                # The backup is a consistent snapshot even while the primary
+                # is being written, and readers of the replica see either the
+                # old or the new copy
+                source.backup(target, pages=options['pages'])
+            finally:
+                target.close()
+                source.close()
+            self.stdout.write(f"Replica synced in {(time.perf_counter() - start) * 1000:.0f} ms")
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
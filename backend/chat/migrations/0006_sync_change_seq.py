@@ -0,0 +1,67 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:09
+
+from django.db import migrations, models
+
+
+def backfill_change_seq(apps, schema_editor):
+    """Give existing rows distinct sequence numbers so a first sync sees them."""
+    ChangeCounter = apps.get_model('chat', 'ChangeCounter')
+    seq = 0
+    for model_name in ('ChatSession', 'ChatParticipant', 'Message'):
+        model = apps.get_model('chat', model_name)
+        batch = []
+        for obj in model.objects.order_by('id').only('id').iterator(chunk_size=1000):
+            seq += 1
+            obj.change_seq = seq
+            batch.append(obj)
+            if len(batch) >= 1000:
+                model.objects.bulk_update(batch, ['change_seq'])
+                batch = []
+        if batch:
+            model.objects.bulk_update(batch, ['change_seq'])
+    ChangeCounter.objects.update_or_create(name='sync', defaults={'value': seq})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_encrypted_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeCounter',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='change_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='change_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='change_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='chatparticipant',
+            index=models.Index(fields=['chat_session', 'change_seq'], name='chat_participant_change_seq'),
+        ),
+        migrations.AddIndex(
+            model_name='chatsession',
+            index=models.Index(fields=['change_seq'], name='chat_session_change_seq'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat_session', 'change_seq'], name='chat_message_change_seq'),
+        ),
+        migrations.RunPython(backfill_change_seq, migrations.RunPython.noop),
+    ]
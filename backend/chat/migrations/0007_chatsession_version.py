@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_sync_change_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_chatsession_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatparticipant',
+            index=models.Index(fields=['user', 'is_active'], name='chat_participant_user_active'),
+        ),
+        migrations.AddIndex(
+            model_name='chatparticipant',
+            index=models.Index(fields=['chat_session', 'is_active'], name='chat_participant_sess_active'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat_session', 'timestamp', 'id'], name='chat_message_session_time'),
+        ),
+    ]
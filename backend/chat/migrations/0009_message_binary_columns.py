@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='content_bin',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='encryption_key_bin',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='iv_bin',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='wrapped_keys',
+            field=models.BinaryField(default=b''),
+        ),
+    ]
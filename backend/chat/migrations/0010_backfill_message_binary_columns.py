@@ -0,0 +1,78 @@
+import base64
+import binascii
+import struct
+
+from django.db import migrations, transaction
+
+CHUNK_SIZE = 1000
+
+_WRAPPED_KEY_HEADER = struct.Struct('>QH')
+
+
+def _decode(value):
+    try:
+        return base64.b64decode(value or '')
+    except (binascii.Error, ValueError):
+        return (value or '').encode('utf-8')
+
+
+def _pack(keys_by_user_id):
+    # Frozen copy of chat.models.pack_wrapped_keys
+    parts = []
+    for user_id, wrapped_key in sorted(keys_by_user_id.items()):
+        parts.append(_WRAPPED_KEY_HEADER.pack(user_id, len(wrapped_key)))
+        parts.append(wrapped_key)
+    return b''.join(parts)
+
+
+def backfill_binary_columns(apps, schema_editor):
+    """Decode the base64 text columns into the binary ones, one chunk per transaction."""
+    Message = apps.get_model('chat', 'Message')
+    User = apps.get_model('users', 'CustomUser')
+    db_alias = schema_editor.connection.alias
+
+    last_id = 0
+    while True:
+        with transaction.atomic(using=db_alias):
+            chunk = list(
+                Message.objects.using(db_alias)
+                .filter(id__gt=last_id)
+                .order_by('id')
+                .only('id', 'content', 'encryption_key', 'encrypted_keys', 'iv')[:CHUNK_SIZE]
+            )
+            if not chunk:
+                break
+
+            usernames = {name for message in chunk for name in (message.encrypted_keys or {})}
+            user_ids = dict(
+                User.objects.using(db_alias).filter(username__in=usernames).values_list('username', 'id')
+            )
+
+            for message in chunk:
+                message.content_bin = _decode(message.content)
+                message.encryption_key_bin = _decode(message.encryption_key)
+                message.iv_bin = _decode(message.iv)
+                message.wrapped_keys = _pack({
+                    user_ids[name]: _decode(key)
+                    for name, key in (message.encrypted_keys or {}).items()
+                    if name in user_ids
+                })
+            Message.objects.using(db_alias).bulk_update(
+                chunk, ['content_bin', 'encryption_key_bin', 'iv_bin', 'wrapped_keys']
+            )
+            last_id = chunk[-1].id
+
+
+class Migration(migrations.Migration):
+
+    # Each chunk commits on its own so the write lock is never held for long
+    atomic = False
+
+    dependencies = [
+        ('chat', '0009_message_binary_columns'),
+        ('users', '0002_customuser_private_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_binary_columns, migrations.RunPython.noop),
+    ]
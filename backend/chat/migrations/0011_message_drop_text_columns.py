@@ -0,0 +1,57 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_backfill_message_binary_columns'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='message',
+            name='content',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='encryption_key',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='encrypted_keys',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='iv',
+        ),
+        migrations.RenameField(
+            model_name='message',
+            old_name='content_bin',
+            new_name='content',
+        ),
+        migrations.RenameField(
+            model_name='message',
+            old_name='encryption_key_bin',
+            new_name='encryption_key',
+        ),
+        migrations.RenameField(
+            model_name='message',
+            old_name='iv_bin',
+            new_name='iv',
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='content',
+            field=models.BinaryField(),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='encryption_key',
+            field=models.BinaryField(),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='iv',
+            field=models.BinaryField(),
+        ),
+    ]
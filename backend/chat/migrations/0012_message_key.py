@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:19
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0011_message_drop_text_columns'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wrapped_key', models.BinaryField()),
+                ('chat_session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatsession')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='keys', to='chat.message')),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['recipient', 'chat_session'], name='chat_msgkey_recipient_sess')],
+                'unique_together': {('message', 'recipient')},
+            },
+        ),
+    ]
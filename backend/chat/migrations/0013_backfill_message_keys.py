@@ -0,0 +1,75 @@
+import struct
+
+from django.db import migrations, transaction
+
+CHUNK_SIZE = 1000
+
+_WRAPPED_KEY_HEADER = struct.Struct('>QH')
+
+
+def _unpack(blob):
+    # Frozen copy of the packed wrapped-key format from 0010
+    blob = bytes(blob or b'')
+    keys = {}
+    offset = 0
+    while offset < len(blob):
+        user_id, length = _WRAPPED_KEY_HEADER.unpack_from(blob, offset)
+        offset += _WRAPPED_KEY_HEADER.size
+        keys[user_id] = blob[offset:offset + length]
+        offset += length
+    return keys
+
+
+def backfill_message_keys(apps, schema_editor):
+    """Split every packed wrapped_keys blob into MessageKey rows, one chunk per transaction."""
+    Message = apps.get_model('chat', 'Message')
+    MessageKey = apps.get_model('chat', 'MessageKey')
+    User = apps.get_model('users', 'CustomUser')
+    db_alias = schema_editor.connection.alias
+
+    last_id = 0
+    while True:
+        with transaction.atomic(using=db_alias):
+            chunk = list(
+                Message.objects.using(db_alias)
+                .filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', 'chat_session_id', 'wrapped_keys')[:CHUNK_SIZE]
+            )
+            if not chunk:
+                break
+
+            unpacked = [(message_id, session_id, _unpack(blob)) for message_id, session_id, blob in chunk]
+            recipient_ids = {user_id for _, _, keys in unpacked for user_id in keys}
+            existing = set(User.objects.using(db_alias).filter(id__in=recipient_ids).values_list('id', flat=True))
+
+            MessageKey.objects.using(db_alias).bulk_create(
+                [
+                    MessageKey(
+                        message_id=message_id,
+                        recipient_id=user_id,
+                        chat_session_id=session_id,
+                        wrapped_key=wrapped_key
+                    )
+                    for message_id, session_id, keys in unpacked
+                    for user_id, wrapped_key in keys.items()
+                    if user_id in existing
+                ],
+                ignore_conflicts=True
+            )
+            last_id = chunk[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    # Each chunk commits on its own so the write lock is never held for long
+    atomic = False
+
+    dependencies = [
+        ('chat', '0012_message_key'),
+        ('users', '0002_customuser_private_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_message_keys, migrations.RunPython.noop),
+    ]
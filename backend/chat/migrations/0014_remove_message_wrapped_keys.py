@@ -0,0 +1,15 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_backfill_message_keys'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='message',
+            name='wrapped_keys',
+        ),
+    ]
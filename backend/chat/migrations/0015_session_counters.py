@@ -0,0 +1,74 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:21
+
+from django.db import migrations, models, transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+CHUNK_SIZE = 500
+
+
+def backfill_session_counters(apps, schema_editor):
+    """Compute the new counters for existing sessions, one chunk per transaction."""
+    ChatSession = apps.get_model('chat', 'ChatSession')
+    Message = apps.get_model('chat', 'Message')
+    db_alias = schema_editor.connection.alias
+
+    messages = Message.objects.using(db_alias).filter(chat_session=OuterRef('pk'))
+    latest = messages.order_by('-id')
+    expressions = {
+        'message_count': Coalesce(
+            Subquery(
+                messages.order_by().values('chat_session').annotate(total=Count('id')).values('total')[:1],
+                output_field=IntegerField()
+            ),
+            Value(0)
+        ),
+        'last_message_id': Subquery(latest.values('id')[:1]),
+        'last_message_at': Subquery(latest.values('timestamp')[:1]),
+    }
+
+    last_id = 0
+    while True:
+        ids = list(
+            ChatSession.objects.using(db_alias)
+            .filter(id__gt=last_id)
+            .order_by('id')
+            .values_list('id', flat=True)[:CHUNK_SIZE]
+        )
+        if not ids:
+            break
+        with transaction.atomic(using=db_alias):
+            ChatSession.objects.using(db_alias).filter(id__in=ids).update(**expressions)
+        last_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chat', '0014_remove_message_wrapped_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='message_count',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='chatsession',
+            index=models.Index(fields=['last_message_at', 'id'], name='chat_session_last_message'),
+        ),
+        migrations.RunPython(backfill_session_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_session_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='last_read_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0016_participant_last_read'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_message_id', models.BigIntegerField()),
+                ('last_message_id', models.BigIntegerField()),
+                ('first_timestamp', models.DateTimeField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('payload', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('chat_session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_segments', to='chat.chatsession')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['chat_session', 'first_message_id'], name='chat_segment_first_id'), models.Index(fields=['chat_session', 'last_message_id'], name='chat_segment_last_id')],
+            },
+        ),
+    ]
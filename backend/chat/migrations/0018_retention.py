@@ -0,0 +1,43 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:28
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def stamp_inactive_participants(apps, schema_editor):
+    """Start the retention clock for participants that left before it existed."""
+    ChatParticipant = apps.get_model('chat', 'ChatParticipant')
+    ChatParticipant.objects.using(schema_editor.connection.alias).filter(
+        is_active=False, deactivated_at__isnull=True
+    ).update(deactivated_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0017_archived_segment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaintenanceCheckpoint',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('as_of', models.DateTimeField(blank=True, null=True)),
+                ('position', models.BigIntegerField(default=0)),
+                ('processed', models.BigIntegerField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='deactivated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='chatparticipant',
+            index=models.Index(fields=['deactivated_at'], name='chat_participant_deactivated'),
+        ),
+        migrations.RunPython(stamp_inactive_participants, migrations.RunPython.noop),
+    ]
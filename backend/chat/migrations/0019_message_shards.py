@@ -0,0 +1,53 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:45
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0018_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='shard',
+            # Every existing session's messages are on the default database
+            field=models.CharField(blank=True, default='default', editable=False, max_length=30),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='archivedsegment',
+            name='chat_session',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_segments', to='chat.chatsession'),
+        ),
+        migrations.AlterField(
+            model_name='chatsession',
+            name='last_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='chat.message'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='chat_session',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.chatsession'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='sender',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='messagekey',
+            name='chat_session',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatsession'),
+        ),
+        migrations.AlterField(
+            model_name='messagekey',
+            name='recipient',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
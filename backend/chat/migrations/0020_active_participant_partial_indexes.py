@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-19 16:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0019_message_shards'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='chatparticipant',
+            name='chat_participant_user_active',
+        ),
+        migrations.RemoveIndex(
+            model_name='chatparticipant',
+            name='chat_participant_sess_active',
+        ),
+        migrations.AddIndex(
+            model_name='chatparticipant',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', 'chat_session'], name='chat_participant_user_active'),
+        ),
+        migrations.AddIndex(
+            model_name='chatparticipant',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['chat_session', 'user'], name='chat_participant_sess_active'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.2.7 on 2026-10-19 16:31
+
+from django.db import migrations, models, transaction
+from django.db.models import OuterRef, Subquery
+
+CHUNK_SIZE = 1000
+
+
+def backfill_last_message_at(apps, schema_editor):
+    """Copy each session's last_message_at onto its participants, one chunk per transaction."""
+    ChatSession = apps.get_model('chat', 'ChatSession')
+    ChatParticipant = apps.get_model('chat', 'ChatParticipant')
+    db_alias = schema_editor.connection.alias
+
+    last_message_at = Subquery(
+        ChatSession.objects.using(db_alias).filter(pk=OuterRef('chat_session_id')).values('last_message_at')[:1]
+    )
+    last_id = 0
+    while True:
+        ids = list(
+            ChatParticipant.objects.using(db_alias)
+            .filter(id__gt=last_id)
+            .order_by('id')
+            .values_list('id', flat=True)[:CHUNK_SIZE]
+        )
+        if not ids:
+            break
+        with transaction.atomic(using=db_alias):
+            ChatParticipant.objects.using(db_alias).filter(id__in=ids).update(last_message_at=last_message_at)
+        last_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('chat', '0020_active_participant_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='chatparticipant',
+            name='chat_participant_user_active',
+        ),
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_last_message_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatparticipant',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['user', 'last_message_at', 'chat_session'], name='chat_participant_user_active'),
+        ),
+    ]
@@ -1,40 +1,395 @@
-from django.db import models
+import base64
+import functools
+
+from django.db import DEFAULT_DB_ALIAS, models, router, transaction
+from django.db.models import Case, F, FilteredRelation, Max, OuterRef, Q, Subquery, Value, When
 from django.conf import settings
+from django.utils import timezone
+
+from secure_messenger.routers import home_shard, id_stride, message_shards, read_alias, shard_index
+
+
+class ChangeCounter(models.Model):
+    """A named monotonic counter used to stamp rows for delta sync."""
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    SYNC = 'sync'
+    MESSAGE_IDS = 'message_id'
+
+    @classmethod
+    def next_value(cls, name=SYNC, using=None):
+        """Allocate the next value of the counter (call inside a transaction)."""
+        return cls.reserve(1, name, using)
+
+    @classmethod
+    def reserve(cls, count, name=SYNC, using=None, initial=0):
+        """
+        Allocate ``count`` consecutive values and return the first (call inside
+        a transaction). Every shard has its own counters; ``initial`` (a value
+        or a callable) seeds a counter that does not exist yet.
+        """
+        counters = cls.objects.db_manager(using)
+        if not counters.filter(name=name).update(value=F('value') + count):
+            counters.get_or_create(name=name, defaults={'value': initial() if callable(initial) else initial})
+            counters.filter(name=name).update(value=F('value') + count)
+        return counters.values_list('value', flat=True).get(name=name) - count + 1
+
+    def __str__(self):
+        return f"{self.name}={self.value}"
+
+
+class MaintenanceCheckpoint(models.Model):
+    """Progress of a resumable batch job, see chat.maintenance."""
+    name = models.CharField(max_length=100, primary_key=True)
+    as_of = models.DateTimeField(null=True, blank=True)  # Reference time, fixed for the whole run
+    position = models.BigIntegerField(default=0)  # Job-defined resume key, e.g. the last id visited
+    processed = models.BigIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} at {self.position}"
+
 
+class ChangeTrackedModel(models.Model):
+    """Stamps every save with the next value of the global sync sequence."""
+    change_seq = models.BigIntegerField(default=0, editable=False)
+
+    class Meta:
+        abstract = True
 
-class ChatSession(models.Model):
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'change_seq'}
+        # Allocate the sequence and write the row in one transaction on the
+        # row's database so a reader never sees a higher sequence committed
+        # before a lower one.
+        using = kwargs['using'] = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            self.change_seq = ChangeCounter.next_value(using=using)
+            super().save(*args, **kwargs)
+
+
+class ChatSession(ChangeTrackedModel):
     """A chat session between users."""
     session_id = models.CharField(max_length=255, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
-    
+    version = models.PositiveBigIntegerField(default=0)  # Bumped on new messages and membership changes
+    # Maintained on message insert, see record_message; rebuild with rebuild_session_counters
+    message_count = models.PositiveBigIntegerField(default=0)
+    last_message = models.ForeignKey(
+        'Message', null=True, blank=True, on_delete=models.DO_NOTHING, related_name='+', db_constraint=False
+    )
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    # Database alias holding the session's messages, see secure_messenger.routers
+    shard = models.CharField(max_length=30, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['change_seq'], name='chat_session_change_seq'),
+            models.Index(fields=['last_message_at', 'id'], name='chat_session_last_message'),
+        ]
+
     def __str__(self):
         return f"Chat Session {self.session_id}"
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding and not self.shard:
+                # Placement hashes the id, so it is only known after the insert
+                self.shard = home_shard(self.pk)
+                ChatSession.objects.filter(pk=self.pk).update(shard=self.shard)
+
+    @classmethod
+    def shard_of(cls, chat_session):
+        """Return the database alias holding a session's messages; takes a session or its id."""
+        if isinstance(chat_session, cls):
+            shard = chat_session.shard
+        else:
+            shard = cls.objects.filter(pk=chat_session).values_list('shard', flat=True).first()
+        return shard or DEFAULT_DB_ALIAS
+
+    @classmethod
+    def bump_version(cls, pk, using=DEFAULT_DB_ALIAS):
+        """
+        Invalidate cached views of a session after its content changed. Called
+        inside a transaction on a shard (``using``), it waits for that commit.
+        """
+        if using != DEFAULT_DB_ALIAS:
+            transaction.on_commit(functools.partial(cls.bump_version, pk), using=using)
+            return
+        cls.objects.filter(pk=pk).update(version=F('version') + 1)
+
+    @classmethod
+    def record_message(cls, message):
+        """Advance the counters and last-message pointer for a new message."""
+        # Messages on other shards are recorded after their own commit, so a
+        # late update must not move the pointer back
+        newer = Q(last_message_id__isnull=True) | Q(last_message_id__lt=message.id)
+        cls.objects.filter(pk=message.chat_session_id).update(
+            message_count=F('message_count') + 1,
+            last_message_id=Case(
+                When(newer, then=Value(message.id)), default=F('last_message_id'), output_field=models.BigIntegerField()
+            ),
+            last_message_at=Case(When(newer, then=Value(message.timestamp)), default=F('last_message_at')),
+            version=F('version') + 1
+        )
+        ChatParticipant.copy_last_message_at(chat_session_id=message.chat_session_id)
 
-class ChatParticipant(models.Model):
+
+class ChatParticipant(ChangeTrackedModel):
     """A participant in a chat session."""
     chat_session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='participants')
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     joined_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
-    
+    # Highest message id this participant has read; written by chat.receipts
+    last_read_message_id = models.BigIntegerField(default=0)
+    # When the participant left; drives the retention purge
+    deactivated_at = models.DateTimeField(null=True, blank=True)
+    # Copy of the session's last_message_at, so a user's session list is read
+    # in order from chat_participant_user_active; see copy_last_message_at
+    last_message_at = models.DateTimeField(null=True, blank=True, editable=False)
+
     class Meta:
         unique_together = ('chat_session', 'user')
-    
+        indexes = [
+            models.Index(fields=['chat_session', 'change_seq'], name='chat_participant_change_seq'),
+            # Partial rather than on is_active: Django compiles is_active=True to
+            # a bare column test on SQLite, which a composite index cannot match
+            models.Index(
+                fields=['user', 'last_message_at', 'chat_session'],
+                condition=Q(is_active=True),
+                name='chat_participant_user_active'
+            ),
+            models.Index(
+                fields=['chat_session', 'user'], condition=Q(is_active=True), name='chat_participant_sess_active'
+            ),
+            models.Index(fields=['deactivated_at'], name='chat_participant_deactivated'),
+        ]
+
     def __str__(self):
         return f"{self.user.username} in {self.chat_session}"
 
+    @classmethod
+    def copy_last_message_at(cls, **filters):
+        """Copy their sessions' last_message_at onto the participants matching ``filters``."""
+        cls.objects.filter(**filters).update(last_message_at=Subquery(
+            ChatSession.objects.filter(pk=OuterRef('chat_session_id')).values('last_message_at')[:1]
+        ))
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.last_message_at is None:
+            self.last_message_at = ChatSession.objects.filter(
+                pk=self.chat_session_id
+            ).values_list('last_message_at', flat=True).first()
+        if self.is_active:
+            self.deactivated_at = None
+        elif self.deactivated_at is None:
+            self.deactivated_at = timezone.now()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'deactivated_at'}
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            ChatSession.bump_version(self.chat_session_id)
+
+
+class ShardedQuerySet(models.QuerySet):
+    def for_session(self, chat_session):
+        """
+        Restrict to one chat session's rows, read from the shard that stores
+        them. Takes a ChatSession, or its id at the cost of one lookup.
+        """
+        alias = read_alias(ChatSession.shard_of(chat_session))
+        return self.using(alias).filter(chat_session_id=getattr(chat_session, 'pk', chat_session))
+
 
-class Message(models.Model):
-    """A message in a chat session."""
-    chat_session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='messages')
-    sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    content = models.TextField()  # Encrypted message content
-    encryption_key = models.TextField()  # Encrypted AES key
-    encrypted_keys = models.JSONField(default=dict)  # Encrypted AES keys for each participant
-    iv = models.TextField()  # Initialization vector
+class MessageQuerySet(ShardedQuerySet):
+    def with_key_for(self, user):
+        """
+        Join only the AES key wrapped for ``user``, exposed as ``recipient_key``.
+
+        Readers never load the other participants' wrapped keys.
+        """
+        return self.annotate(
+            own_key=FilteredRelation('keys', condition=Q(keys__recipient=user))
+        ).annotate(recipient_key=F('own_key__wrapped_key'))
+
+
+def highest_message_id():
+    """Return the largest message id stored on any shard, hot or archived."""
+    highest = 0
+    for alias in message_shards():
+        highest = max(
+            highest,
+            Message.objects.using(alias).aggregate(highest=Max('id'))['highest'] or 0,
+            ArchivedSegment.objects.using(alias).aggregate(highest=Max('last_message_id'))['highest'] or 0
+        )
+    return highest
+
+
+class MessageManager(models.Manager.from_queryset(MessageQuerySet)):
+    def allocate_ids(self, using, count=1):
+        """
+        Reserve ``count`` new message ids on a shard (call inside a transaction
+        on it). With several shards, ids step by SHARD_ID_STRIDE from an
+        offset unique to the shard, so they never collide with ids allocated
+        elsewhere; a single shard allocates consecutive ids. A shard's counter
+        starts above every id that existed when it was first used.
+        """
+        stride = id_stride()
+        first = ChangeCounter.reserve(
+            count, ChangeCounter.MESSAGE_IDS, using,
+            initial=lambda: highest_message_id() // stride
+        )
+        offset = shard_index(using)
+        return range(first * stride + offset, (first + count) * stride + offset, stride)
+
+    def create_encrypted(self, chat_session, sender, encrypted_data, recipients):
+        """
+        Store the output of ``encrypt_message_for_participants``.
+
+        ``recipients`` maps each username in ``encrypted_data['encrypted_keys']``
+        to its user id; each wrapped key is stored as a ``MessageKey`` row.
+        """
+        wrapped_keys = {
+            recipients[username]: base64.b64decode(wrapped_key)
+            for username, wrapped_key in encrypted_data['encrypted_keys'].items()
+        }
+        while True:
+            db = ChatSession.shard_of(chat_session)
+            with transaction.atomic(using=db):
+                message = self.db_manager(db).create(
+                    chat_session=chat_session,
+                    sender=sender,
+                    content=base64.b64decode(encrypted_data['encrypted_content']),
+                    encryption_key=wrapped_keys.get(sender.id, b''),
+                    iv=base64.b64decode(encrypted_data['iv'])
+                )
+                MessageKey.objects.using(db).bulk_create(
+                    MessageKey(
+                        message=message,
+                        recipient_id=user_id,
+                        chat_session_id=message.chat_session_id,
+                        wrapped_key=wrapped_key
+                    )
+                    for user_id, wrapped_key in wrapped_keys.items()
+                )
+                # The insert holds the shard's write lock, which move_session
+                # also holds while it switches placement: if the session is
+                # still here now, the move will copy this message
+                shard = db if len(message_shards()) == 1 else ChatSession.shard_of(chat_session.pk)
+                if shard == db:
+                    return message
+                transaction.set_rollback(True, using=db)
+            chat_session.shard = shard
+
+
+class Message(ChangeTrackedModel):
+    """A message in a chat session, stored on the session's shard."""
+    # Sessions and users live on the default database, so relations from
+    # sharded tables carry no database constraint
+    chat_session = models.ForeignKey(
+        ChatSession, on_delete=models.CASCADE, related_name='messages', db_constraint=False
+    )
+    sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_constraint=False)
+    content = models.BinaryField()  # Encrypted message content
+    encryption_key = models.BinaryField()  # Sender's wrapped AES key
+    iv = models.BinaryField()  # Initialization vector
     timestamp = models.DateTimeField(auto_now_add=True)
-    
+
+    objects = MessageManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat_session', 'change_seq'], name='chat_message_change_seq'),
+            models.Index(fields=['chat_session', 'timestamp', 'id'], name='chat_message_session_time'),
+        ]
+
+    def __str__(self):
+        return f"Message from {self.sender.username} at {self.timestamp}"
+
+    def wrapped_key_for(self, user_id):
+        """Return the AES key wrapped for a user, or None if they have no key row."""
+        if hasattr(self, 'recipient_key'):
+            wrapped_key = self.recipient_key
+        else:
+            wrapped_key = MessageKey.objects.filter(
+                message=self, recipient_id=user_id
+            ).values_list('wrapped_key', flat=True).first()
+        return bytes(wrapped_key) if wrapped_key else None
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        using = kwargs['using'] = kwargs.get('using') or router.db_for_write(Message, instance=self)
+        with transaction.atomic(using=using):
+            if adding and self.id is None:
+                self.id = Message.objects.allocate_ids(using)[0]
+                kwargs.setdefault('force_insert', True)
+            super().save(*args, **kwargs)
+            if adding:
+                if using == DEFAULT_DB_ALIAS:
+                    ChatSession.record_message(self)
+                else:
+                    # The session row is on default: update it once the
+                    # message is committed on its shard
+                    transaction.on_commit(functools.partial(ChatSession.record_message, self), using=using)
+
+
+class MessageKey(models.Model):
+    """A message's AES key wrapped with one recipient's public key."""
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='keys')
+    recipient = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+', db_constraint=False
+    )
+    # Denormalized so a recipient's keys for a session drop with one indexed delete
+    chat_session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='+', db_constraint=False)
+    wrapped_key = models.BinaryField()
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('message', 'recipient')
+        indexes = [
+            models.Index(fields=['recipient', 'chat_session'], name='chat_msgkey_recipient_sess'),
+        ]
+
+    def __str__(self):
+        return f"Key for message {self.message_id} to user {self.recipient_id}"
+
+
+class ArchivedSegment(models.Model):
+    """
+    A compressed, append-only block of a session's oldest messages.
+
+    Segments cover disjoint, increasing message id ranges of one session; the
+    range columns act as a sparse index so a history read decodes only the
+    segments it needs. See chat.archive.
+    """
+    chat_session = models.ForeignKey(
+        ChatSession, on_delete=models.CASCADE, related_name='archived_segments', db_constraint=False
+    )
+    first_message_id = models.BigIntegerField()
+    last_message_id = models.BigIntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    payload = models.BinaryField()  # zlib-compressed msgpack, see chat.archive
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat_session', 'first_message_id'], name='chat_segment_first_id'),
+            models.Index(fields=['chat_session', 'last_message_id'], name='chat_segment_last_id'),
+        ]
+
     def __str__(self):
-        return f"Message from {self.sender.username} at {self.timestamp}"
\ No newline at end of file
+        return f"Archived messages {self.first_message_id}-{self.last_message_id} of {self.chat_session}"
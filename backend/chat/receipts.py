@@ -0,0 +1,257 @@
+"""
+Read receipts with coalesced persistence and batched fan-out.
+
+Clients report how far they have read as often as they like (every scroll
+step). ``ReadStateCoalescer`` keeps only the highest message id per
+participant in memory and a background thread writes the pending positions
+at most once per READ_RECEIPT_FLUSH_INTERVAL, so a burst of updates from one
+reader costs a single UPDATE. ``ReadReceiptFanout`` does the same for the
+WebSocket notifications sent to the other participants of a session.
+"""
+import asyncio
+import atexit
+import functools
+import logging
+import operator
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, F, Q
+
+from secure_messenger.metrics import GROUP_SEND_SECONDS
+from secure_messenger.routers import read_alias
+
+from .models import ChatParticipant, ChatSession, Message
+from .sharding import group_by_shard
+
+logger = logging.getLogger(__name__)
+
+# Sessions per grouped unread count query
+UNREAD_COUNT_BATCH = 100
+
+
+def flush_interval():
+    return getattr(settings, 'READ_RECEIPT_FLUSH_INTERVAL', 2.0)
+
+
+def fanout_interval():
+    return getattr(settings, 'READ_RECEIPT_FANOUT_INTERVAL', 0.5)
+
+
+def unread_count(chat_session, last_read_message_id):
+    """
+    Count messages after a read position with one indexed range count.
+    Only hot messages are counted; archived ones are never unread.
+    """
+    return Message.objects.for_session(chat_session).filter(id__gt=last_read_message_id).count()
+
+
+def with_read_state(sessions):
+    """
+    Annotate sessions filtered on the requesting user's participant row with
+    that user's read position; see attach_unread_counts for the counts.
+    """
+    return sessions.annotate(own_last_read=F('participants__last_read_message_id'))
+
+
+def attach_unread_counts(sessions):
+    """
+    Set ``own_unread`` on sessions annotated by with_read_state. Messages live
+    on the sessions' shards, so this is one grouped range count per shard.
+    Like unread_count, it counts hot messages only.
+    """
+    for db, group in group_by_shard(sessions).items():
+        # Bounded so the OR stays well within SQLite's expression depth limit
+        for start in range(0, len(group), UNREAD_COUNT_BATCH):
+            batch = group[start:start + UNREAD_COUNT_BATCH]
+            after_read = functools.reduce(operator.or_, (
+                Q(chat_session_id=chat_session.id, id__gt=chat_session.own_last_read or 0)
+                for chat_session in batch
+            ))
+            counts = dict(Message.objects.using(read_alias(db)).filter(after_read).order_by().values(
+                'chat_session_id'
+            ).annotate(total=Count('id')).values_list('chat_session_id', 'total'))
+            for chat_session in batch:
+                chat_session.own_unread = counts.get(chat_session.id, 0)
+    return sessions
+
+
+def read_position(chat_session_id, user_id, persisted):
+    """Combine a persisted read position with any buffered, unflushed one."""
+    return max(persisted or 0, coalescer.pending_for(chat_session_id, user_id))
+
+
+def advance_read(chat_session_id, user, message_id):
+    """
+    Move a participant's read position forward to ``message_id``.
+
+    The position is clamped to the session's newest message. Returns
+    ``(position, advanced)``, or None when the user is not an active
+    participant of the session.
+    """
+    row = ChatParticipant.objects.filter(
+        chat_session_id=chat_session_id,
+        user=user,
+        is_active=True
+    ).values_list('last_read_message_id', 'chat_session__last_message_id').first()
+    if row is None:
+        return None
+    persisted, last_message_id = row
+    previous = read_position(chat_session_id, user.id, persisted)
+    position = coalescer.mark_read(
+        chat_session_id, user.id, min(message_id, last_message_id or 0), known=persisted
+    )
+    return position, position > previous
+
+
+class ReadStateCoalescer:
+    """Buffers read positions and writes each participant at most once per interval."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flusher_started = False
+        self.writes = 0
+
+    def mark_read(self, chat_session_id, user_id, message_id, known=0):
+        """
+        Record that a user has read up to ``message_id``.
+
+        ``known`` is the persisted position, if the caller has it. Returns the
+        effective position, which never moves backwards.
+        """
+        key = (chat_session_id, user_id)
+        with self._lock:
+            current = max(self._pending.get(key, 0), known)
+            if message_id > current:
+                self._pending[key] = message_id
+                current = message_id
+        self._ensure_flusher()
+        return current
+
+    def pending_for(self, chat_session_id, user_id):
+        """Return the buffered position for a participant, or 0."""
+        with self._lock:
+            return self._pending.get((chat_session_id, user_id), 0)
+
+    def flush(self):
+        """Write every buffered position; returns the number of participants updated."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        updated = 0
+        try:
+            with transaction.atomic():
+                for (chat_session_id, user_id), message_id in pending.items():
+                    # The guard keeps a stale flush from moving a position backwards
+                    updated += ChatParticipant.objects.filter(
+                        chat_session_id=chat_session_id,
+                        user_id=user_id,
+                        last_read_message_id__lt=message_id
+                    ).update(last_read_message_id=message_id)
+                # Unread counts are part of the session views, so revalidate them
+                ChatSession.objects.filter(
+                    id__in={chat_session_id for chat_session_id, _ in pending}
+                ).update(version=F('version') + 1)
+        except Exception:
+            # Nothing was written; requeue the positions for the next flush,
+            # keeping any newer one marked in the meantime
+            with self._lock:
+                for key, message_id in pending.items():
+                    self._pending[key] = max(self._pending.get(key, 0), message_id)
+            raise
+        self.writes += updated
+        return updated
+
+    def _ensure_flusher(self):
+        if self._flusher_started:
+            return
+        with self._lock:
+            if self._flusher_started:
+                return
+            threading.Thread(target=self._flush_loop, name='read-receipt-flusher', daemon=True).start()
+            atexit.register(self.flush)
+            self._flusher_started = True
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(flush_interval())
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush read receipts")
+            finally:
+                close_old_connections()
+
+
+class ReadReceiptFanout:
+    """
+    Collects read positions per WebSocket group and sends them as one
+    ``read_receipts`` event per group per interval.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._scheduled = set()
+
+    def publish(self, channel_layer, group, username, message_id):
+        """Queue a receipt; must be called from the event loop."""
+        if self._queue(group, username, message_id):
+            asyncio.get_running_loop().create_task(self._send_later(channel_layer, group))
+
+    def publish_sync(self, group, username, message_id):
+        """
+        Queue a receipt from synchronous code such as the REST views. Under
+        ASGI it joins the batch on the server's event loop; without one the
+        temporary loop sends the batch as it shuts down.
+        """
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        async_to_sync(self._publish)(channel_layer, group, username, message_id)
+
+    async def _publish(self, channel_layer, group, username, message_id):
+        self.publish(channel_layer, group, username, message_id)
+
+    def _queue(self, group, username, message_id):
+        """Add a receipt to the group's batch; True if the batch still needs a send scheduled."""
+        with self._lock:
+            receipts = self._pending.setdefault(group, {})
+            receipts[username] = max(receipts.get(username, 0), message_id)
+            if group in self._scheduled:
+                return False
+            self._scheduled.add(group)
+            return True
+
+    async def _send_later(self, channel_layer, group):
+        try:
+            await asyncio.sleep(fanout_interval())
+        except asyncio.CancelledError:
+            # The loop is shutting down; send what is batched rather than drop it
+            pass
+        await self._send(channel_layer, group)
+
+    async def _send(self, channel_layer, group):
+        with self._lock:
+            self._scheduled.discard(group)
+            receipts = self._pending.pop(group, {})
+        if not receipts:
+            return
+        with GROUP_SEND_SECONDS.labels('read_receipts').time():
+            await channel_layer.group_send(group, {
+                'type': 'read_receipts',
+                'receipts': [
+                    {'username': username, 'message_id': message_id}
+                    for username, message_id in receipts.items()
+                ]
+            })
+
+
+coalescer = ReadStateCoalescer()
+fanout = ReadReceiptFanout()
@@ -0,0 +1,200 @@
+"""
+Rotation of a user's RSA key pair without losing their history.
+
+Every message a user can read carries its AES key wrapped with their public
+key: in a ``MessageKey`` row while the message is hot (and, for messages
+they sent, in ``Message.encryption_key`` too), and in its archive segment
+once archived. ``KeyRotation`` first switches the user to the new key pair,
+so messages sent from then on are wrapped for it, and then visits the user's
+sessions in id order. In each one it re-wraps the user's hot keys on the
+session's shard in chunks, spread over a process pool and written back one
+transaction per chunk, and then rewrites any archive segment that holds one
+of their keys. Segments are immutable (readers cache them by primary key), so
+a rewritten segment replaces the old row with a new one. Every write also
+bumps the session's version, so no cached view keeps serving the old keys,
+and re-wrapped hot messages take new change sequence numbers for delta sync.
+
+A key that only the new private key opens is already done. A resumed run
+therefore skips the keys it re-wrapped before, as well as messages that
+arrived under the new key. Until the job reaches a session, that session's
+older messages open only with the old key. Sessions must not move between
+shards while a rotation runs.
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from encryption.utils import KeyRewrapper, public_key_fingerprint, public_key_of
+
+from .archive import decode_segment, encode_rows
+from .models import ArchivedSegment, ChangeCounter, ChatParticipant, ChatSession, Message, MessageKey
+
+DEFAULT_CHUNK_SIZE = 500
+
+# Set in each pool worker by _init_worker
+_rewrapper = None
+
+
+def _init_worker(old_private_key_pem, new_private_key_pem):
+    global _rewrapper
+    # Spawned rather than forked workers must set Django up themselves
+    django.setup()
+    _rewrapper = KeyRewrapper(old_private_key_pem, new_private_key_pem)
+
+
+def _rewrap_keys(wrapped_keys):
+    """Pool task: re-wrap keys, giving None for done ones and False for unreadable ones."""
+    results = []
+    for wrapped_key in wrapped_keys:
+        try:
+            results.append(_rewrapper.rewrap(wrapped_key))
+        except ValueError:
+            results.append(False)
+    return results
+
+
+class KeyRotation:
+    """Re-wraps one user's message keys from an old key pair to a new one."""
+
+    def __init__(self, user, old_private_key_pem, new_private_key_pem, workers, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.user = user
+        self.old_private_key_pem = old_private_key_pem
+        self.new_private_key_pem = new_private_key_pem
+        self.new_public_key_pem = public_key_of(new_private_key_pem)
+        self.old_fingerprint = public_key_fingerprint(public_key_of(old_private_key_pem))
+        self.new_fingerprint = public_key_fingerprint(self.new_public_key_pem)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.rewrapped = 0
+        self.already_done = 0
+        self.unreadable = 0
+        self._pool = None
+
+    def __enter__(self):
+        self._pool = ProcessPoolExecutor(
+            self.workers, initializer=_init_worker,
+            initargs=(self.old_private_key_pem, self.new_private_key_pem)
+        )
+        return self
+
+    def __exit__(self, *exc_info):
+        self._pool.shutdown(cancel_futures=True)
+
+    def switch_keys(self):
+        """
+        Give the user the new key pair. Returns False if they already have it
+        (a resumed rotation); raises ValueError if they have neither.
+        """
+        if self.user.key_fingerprint == self.new_fingerprint:
+            return False
+        if self.user.key_fingerprint != self.old_fingerprint:
+            raise ValueError(f"{self.user.username}'s public key matches neither key pair")
+        self.user.public_key = self.new_public_key_pem
+        self.user.private_key = self.new_private_key_pem
+        self.user.save(update_fields=['public_key', 'private_key'])
+        return True
+
+    def sessions(self, after_id):
+        """The user's chat sessions with an id above ``after_id``, as ``(id, shard)`` in id order."""
+        return ChatSession.objects.filter(
+            id__gt=after_id,
+            id__in=ChatParticipant.objects.filter(user=self.user).values('chat_session_id')
+        ).order_by('id').values_list('id', 'shard')
+
+    def _rewrap(self, wrapped_keys):
+        """Re-wrap keys on the pool, one piece per worker, and tally the outcomes."""
+        size = -(-len(wrapped_keys) // self.workers)
+        pieces = [wrapped_keys[start:start + size] for start in range(0, len(wrapped_keys), size)]
+        results = [result for piece in self._pool.map(_rewrap_keys, pieces) for result in piece]
+        for result in results:
+            if result is None:
+                self.already_done += 1
+            elif result is False:
+                self.unreadable += 1
+            else:
+                self.rewrapped += 1
+        return results
+
+    def rotate_session(self, chat_session_id, shard):
+        """Re-wrap the user's keys in one session, hot then archived; returns how many were."""
+        db = shard or DEFAULT_DB_ALIAS
+        rewrapped = 0
+        last_id = 0
+        while True:
+            rows = list(MessageKey.objects.using(db).filter(
+                recipient=self.user, chat_session_id=chat_session_id, id__gt=last_id
+            ).order_by('id').values_list('id', 'message_id', 'wrapped_key')[:self.chunk_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            results = self._rewrap([bytes(row[2]) for row in rows])
+            new_keys = {message_id: new_key for (_, message_id, _), new_key in zip(rows, results) if new_key}
+            if not new_keys:
+                continue
+            with transaction.atomic(using=db):
+                # Rows archived since the read are missed here and handled with the segments
+                MessageKey.objects.using(db).bulk_update([
+                    MessageKey(id=key_id, wrapped_key=new_keys[message_id])
+                    for key_id, message_id, _ in rows if message_id in new_keys
+                ], ['wrapped_key'])
+                sent = set(Message.objects.using(db).filter(
+                    id__in=list(new_keys), sender=self.user
+                ).values_list('id', flat=True))
+                first_seq = ChangeCounter.reserve(len(new_keys), using=db)
+                Message.objects.using(db).bulk_update([
+                    Message(id=message_id, change_seq=first_seq + offset)
+                    for offset, message_id in enumerate(sorted(new_keys))
+                ], ['change_seq'])
+                Message.objects.using(db).bulk_update([
+                    Message(id=message_id, encryption_key=new_keys[message_id]) for message_id in sent
+                ], ['encryption_key'])
+                ChatSession.bump_version(chat_session_id, using=db)
+            rewrapped += len(new_keys)
+
+        segment_ids = ArchivedSegment.objects.using(db).filter(
+            chat_session_id=chat_session_id
+        ).order_by('first_message_id').values_list('id', flat=True)
+        for segment_id in list(segment_ids):
+            rewrapped += self._rotate_segment(db, segment_id)
+        return rewrapped
+
+    def _rotate_segment(self, db, segment_id):
+        segment = ArchivedSegment.objects.using(db).filter(pk=segment_id).first()
+        if segment is None:
+            return 0
+        rows = decode_segment(segment.payload)
+        # (row, key entry) positions of the user's keys; entries are [user id, key]
+        positions = [
+            (i, j)
+            for i, row in enumerate(rows)
+            for j, (user_id, _) in enumerate(row[7])
+            if user_id == self.user.id
+        ]
+        if not positions:
+            return 0
+        results = self._rewrap([bytes(rows[i][7][j][1]) for i, j in positions])
+        rewrapped = 0
+        for (i, j), new_key in zip(positions, results):
+            if new_key:
+                rows[i][7][j][1] = new_key
+                if rows[i][1] == self.user.id:
+                    rows[i][5] = new_key
+                rewrapped += 1
+        if not rewrapped:
+            return 0
+        with transaction.atomic(using=db):
+            if not ArchivedSegment.objects.using(db).filter(pk=segment_id).delete()[0]:
+                # Purged meanwhile
+                return 0
+            ArchivedSegment.objects.using(db).create(
+                chat_session_id=segment.chat_session_id,
+                first_message_id=segment.first_message_id,
+                last_message_id=segment.last_message_id,
+                first_timestamp=segment.first_timestamp,
+                last_timestamp=segment.last_timestamp,
+                message_count=segment.message_count,
+                payload=encode_rows(rows)
+            )
+            ChatSession.bump_version(segment.chat_session_id, using=db)
+        return rewrapped
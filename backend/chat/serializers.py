@@ -1,10 +1,31 @@
-from rest_framework import serializers
+import base64
+import binascii
+
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+from .archive import ArchivedMessage
 from .models import ChatSession, ChatParticipant, Message
+from .receipts import attach_unread_counts, read_position, unread_count
+from .sharding import group_by_shard
 from django.contrib.auth import get_user_model
+from secure_messenger.routers import read_alias
 
 User = get_user_model()
 
 
+class Base64BinaryField(serializers.Field):
+    """Exposes a binary model field as a base64 string."""
+
+    def to_representation(self, value):
+        return base64.b64encode(bytes(value)).decode('ascii')
+
+    def to_internal_value(self, data):
+        try:
+            return base64.b64decode(data, validate=True)
+        except (TypeError, binascii.Error):
+            raise serializers.ValidationError('Invalid base64 data')
+
+
 class ChatParticipantSerializer(serializers.ModelSerializer):
     username = serializers.CharField(source='user.username', read_only=True)
     
@@ -16,6 +37,10 @@ class ChatParticipantSerializer(serializers.ModelSerializer):
 
 class MessageSerializer(serializers.ModelSerializer):
     sender = serializers.SerializerMethodField()
+    content = Base64BinaryField(read_only=True)
+    encryption_key = Base64BinaryField(read_only=True)
+    encrypted_keys = serializers.SerializerMethodField()
+    iv = Base64BinaryField(read_only=True)
     
     class Meta:
         model = Message
@@ -28,16 +53,71 @@ class MessageSerializer(serializers.ModelSerializer):
             'username': obj.sender.username,
             'email': obj.sender.email
         }
+    
+    def get_encrypted_keys(self, obj):
+        """Return only the requesting user's wrapped key, keyed by username."""
+        request = self.context.get('request')
+        if request is None or not request.user.is_authenticated:
+            return {}
+        wrapped_key = obj.wrapped_key_for(request.user.id)
+        if not wrapped_key:
+            return {}
+        return {request.user.username: base64.b64encode(wrapped_key).decode('ascii')}
 
 
 class ChatSessionSerializer(serializers.ModelSerializer):
     participants = ChatParticipantSerializer(many=True, read_only=True)
     messages = MessageSerializer(many=True, read_only=True)
+    last_read_message_id = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
     
     class Meta:
         model = ChatSession
-        fields = ['id', 'session_id', 'created_at', 'is_active', 'participants', 'messages']
-        read_only_fields = ['created_at']
+        fields = [
+            'id', 'session_id', 'created_at', 'is_active', 'message_count',
+            'last_message_id', 'last_message_at', 'last_read_message_id', 'unread_count',
+            'participants', 'messages'
+        ]
+        read_only_fields = ['created_at', 'message_count', 'last_message_id', 'last_message_at']
+    
+    def _persisted_read(self, obj):
+        # Annotated by ChatSessionViewSet.get_queryset; looked up otherwise
+        if hasattr(obj, 'own_last_read'):
+            return obj.own_last_read
+        request = self.context.get('request')
+        return ChatParticipant.objects.filter(
+            chat_session=obj, user=request.user
+        ).values_list('last_read_message_id', flat=True).first() or 0
+    
+    def get_last_read_message_id(self, obj):
+        request = self.context.get('request')
+        if request is None or not request.user.is_authenticated:
+            return None
+        return read_position(obj.id, request.user.id, self._persisted_read(obj))
+    
+    def get_unread_count(self, obj):
+        position = self.get_last_read_message_id(obj)
+        if position is None:
+            return None
+        if getattr(obj, 'own_unread', None) is not None and position == obj.own_last_read:
+            return obj.own_unread
+        return unread_count(obj, position)
+
+
+class SyncChatSessionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ChatSession
+        fields = ['id', 'session_id', 'created_at', 'is_active', 'change_seq']
+
+
+class SyncParticipantSerializer(ChatParticipantSerializer):
+    class Meta(ChatParticipantSerializer.Meta):
+        fields = ChatParticipantSerializer.Meta.fields + ['chat_session', 'change_seq']
+
+
+class SyncMessageSerializer(MessageSerializer):
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ['chat_session', 'change_seq']
 
 
 class CreateChatSessionSerializer(serializers.ModelSerializer):
@@ -65,4 +145,136 @@ class CreateChatSessionSerializer(serializers.ModelSerializer):
             except User.DoesNotExist:
                 pass
         
-        return chat_session 
\ No newline at end of file
+        return chat_session 
+
+# Read-only fast paths for the list and history endpoints. They return what
+# MessageSerializer and ChatSessionSerializer return for a requesting user,
+# built straight from values_list() rows instead of model instances and a
+# serializer field per value.
+
+# Columns of a message row; recipient_key comes from with_key_for()
+MESSAGE_ROW_FIELDS = (
+    'id', 'sender_id', 'content', 'encryption_key', 'iv', 'timestamp', 'recipient_key', 'chat_session_id'
+)
+
+
+def _datetime_formatter():
+    """
+    DateTimeField's output, with the time zone and format looked up once
+    rather than per value. Rows come back from the database time zone aware.
+    """
+    field = serializers.DateTimeField()
+    zone = field.default_timezone()
+    if zone is None or (api_settings.DATETIME_FORMAT or '').lower() != ISO_8601:
+        return field.to_representation
+
+    def to_representation(value):
+        if value.tzinfo is None:
+            return field.to_representation(value)
+        value = value.astimezone(zone).isoformat()
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+    return to_representation
+
+
+def _b64(value):
+    return binascii.b2a_base64(value, newline=False).decode('ascii')
+
+
+def message_rows(messages):
+    """Named message rows for serialize_messages from a with_key_for() queryset."""
+    return messages.values_list(*MESSAGE_ROW_FIELDS, named=True)
+
+
+def sender_fields(user_ids):
+    """MessageSerializer's ``sender`` value for each of a set of user ids, in one query."""
+    return {
+        user_id: {'id': str(user_id), 'username': username, 'email': email}
+        for user_id, username, email in User.objects.filter(id__in=user_ids).values_list('id', 'username', 'email')
+    }
+
+
+def serialize_messages(messages, user, senders=None):
+    """
+    MessageSerializer's output for ``messages`` as read by ``user``: rows
+    from message_rows(), ArchivedMessage objects, or a mix of both.
+    ``senders`` is a sender_fields() result to reuse.
+    """
+    # Users live on default, so senders are fetched rather than joined
+    if senders is None:
+        senders = sender_fields({message.sender_id for message in messages})
+    username = user.username
+    to_datetime = _datetime_formatter()
+    b64 = _b64
+    data = []
+    for message in messages:
+        if isinstance(message, ArchivedMessage):
+            message_id, sender_id, content, encryption_key, iv, timestamp = (
+                message.id, message.sender_id, message.content, message.encryption_key, message.iv, message.timestamp
+            )
+            wrapped_key = message.keys.get(user.id)
+        else:
+            message_id, sender_id, content, encryption_key, iv, timestamp, wrapped_key, _ = message
+        data.append({
+            'id': message_id,
+            'sender': senders.get(sender_id) or {'id': str(sender_id), 'username': None, 'email': None},
+            'content': b64(content),
+            'encryption_key': b64(encryption_key),
+            'encrypted_keys': {username: b64(wrapped_key)} if wrapped_key else {},
+            'iv': b64(iv),
+            'timestamp': to_datetime(timestamp),
+        })
+    return data
+
+
+def serialize_sessions(sessions, user):
+    """
+    ChatSessionSerializer's output for sessions annotated by with_read_state,
+    with their participants and hot messages. Loads those with one query for
+    the participants, one per shard for the messages and the unread counts,
+    and one for the senders, however many sessions there are.
+    """
+    sessions = list(sessions)
+    to_datetime = _datetime_formatter()
+    participants = {}
+    for chat_session_id, participant_id, username, joined_at, is_active in ChatParticipant.objects.filter(
+        chat_session_id__in=[chat_session.id for chat_session in sessions]
+    ).order_by('id').values_list('chat_session_id', 'id', 'user__username', 'joined_at', 'is_active'):
+        participants.setdefault(chat_session_id, []).append({
+            'id': participant_id,
+            'username': username,
+            'joined_at': to_datetime(joined_at),
+            'is_active': is_active,
+        })
+
+    rows = []
+    for db, group in group_by_shard(sessions).items():
+        rows += message_rows(Message.objects.with_key_for(user).using(read_alias(db)).filter(
+            chat_session_id__in=[chat_session.id for chat_session in group]
+        ).order_by('id'))
+    senders = sender_fields({row.sender_id for row in rows})
+    messages = {}
+    for row in rows:
+        messages.setdefault(row.chat_session_id, []).append(row)
+
+    attach_unread_counts(sessions)
+    data = []
+    for chat_session in sessions:
+        position = read_position(chat_session.id, user.id, chat_session.own_last_read)
+        if position == chat_session.own_last_read:
+            unread = chat_session.own_unread
+        else:
+            unread = unread_count(chat_session, position)
+        data.append({
+            'id': chat_session.id,
+            'session_id': chat_session.session_id,
+            'created_at': to_datetime(chat_session.created_at),
+            'is_active': chat_session.is_active,
+            'message_count': chat_session.message_count,
+            'last_message_id': chat_session.last_message_id,
+            'last_message_at': to_datetime(chat_session.last_message_at) if chat_session.last_message_at else None,
+            'last_read_message_id': position,
+            'unread_count': unread,
+            'participants': participants.get(chat_session.id, []),
+            'messages': serialize_messages(messages.get(chat_session.id, []), user, senders),
+        })
+    return data
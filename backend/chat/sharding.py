@@ -0,0 +1,131 @@
+"""
+Placement of chat sessions on message shards, and moving them between shards.
+
+A session's messages, wrapped keys and archive segments all live on the shard
+named by ``ChatSession.shard`` (see secure_messenger.routers). ``move_session``
+relocates them without downtime: rows are copied to the target in bounded
+transactions, the session is switched over, anything written to the old
+shard during the copy is copied too, and only then are the originals deleted.
+Message ids move unchanged, so cursors and read positions stay valid.
+
+The switch happens while holding the old shard's write lock, and
+``Message.objects.create_encrypted`` checks the placement while holding it
+too, retrying on the new shard if the session has moved. So once the switch
+commits, nothing more is written to the old shard, and one catch-up pass
+finds every message that was.
+"""
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F
+
+from secure_messenger.routers import id_stride
+
+from .maintenance import delete_batch
+from .models import ArchivedSegment, ChangeCounter, ChatSession, Message, MessageKey
+
+DEFAULT_MOVE_CHUNK_SIZE = 1000
+
+
+def group_by_shard(sessions):
+    """Group ChatSession objects by the alias of the shard holding their messages."""
+    groups = {}
+    for chat_session in sessions:
+        groups.setdefault(chat_session.shard or DEFAULT_DB_ALIAS, []).append(chat_session)
+    return groups
+
+
+def bulk_create_messages(db, messages):
+    """
+    bulk_create copied or imported messages, keeping their timestamps. The
+    insert stamps now() through auto_now_add, so they are written back after
+    it; switching auto_now_add off would also leave concurrent writers'
+    messages unstamped.
+    """
+    timestamps = [message.timestamp for message in messages]
+    Message.objects.using(db).bulk_create(messages)
+    for message, timestamp in zip(messages, timestamps):
+        message.timestamp = timestamp
+    Message.objects.using(db).bulk_update(messages, ['timestamp'])
+
+
+def _raise_id_floor(db, message_id):
+    """Make sure ids allocated on ``db`` from now on are above ``message_id``."""
+    floor = message_id // id_stride()
+    Message.objects.allocate_ids(db, 0)
+    ChangeCounter.objects.using(db).filter(name=ChangeCounter.MESSAGE_IDS, value__lt=floor).update(value=floor)
+
+
+def _copy_messages(chat_session_id, source, target, after_id, chunk_size):
+    """Copy a session's messages above ``after_id`` and their keys; returns (copied, last id)."""
+    copied = 0
+    while True:
+        messages = list(Message.objects.using(source).filter(
+            chat_session_id=chat_session_id, id__gt=after_id
+        ).order_by('id')[:chunk_size])
+        if not messages:
+            return copied, after_id
+        keys = MessageKey.objects.using(source).filter(
+            message_id__in=[message.id for message in messages]
+        ).values_list('message_id', 'recipient_id', 'wrapped_key')
+        with transaction.atomic(using=target):
+            # Restamp in the target's sequence so delta sync serves them from there
+            first_seq = ChangeCounter.reserve(len(messages), using=target)
+            for offset, message in enumerate(messages):
+                message.change_seq = first_seq + offset
+            _raise_id_floor(target, messages[-1].id)
+            bulk_create_messages(target, messages)
+            MessageKey.objects.using(target).bulk_create(
+                MessageKey(
+                    message_id=message_id,
+                    recipient_id=recipient_id,
+                    chat_session_id=chat_session_id,
+                    wrapped_key=wrapped_key
+                )
+                for message_id, recipient_id, wrapped_key in keys
+            )
+        copied += len(messages)
+        after_id = messages[-1].id
+
+
+def _copy_segments(chat_session_id, source, target):
+    segments = ArchivedSegment.objects.using(source).filter(
+        chat_session_id=chat_session_id
+    ).order_by('last_message_id')
+    copied = 0
+    for segment in segments.iterator(chunk_size=1):
+        _raise_id_floor(target, segment.last_message_id)
+        segment.pk = None
+        segment._state.adding = True
+        segment.save(using=target)
+        copied += 1
+    return copied
+
+
+def move_session(chat_session, target, chunk_size=DEFAULT_MOVE_CHUNK_SIZE):
+    """
+    Move a session's messages, keys and archive segments to the ``target``
+    shard and point the session at it. Returns the number of messages moved.
+    """
+    source = chat_session.shard or DEFAULT_DB_ALIAS
+    if source == target:
+        return 0
+
+    _copy_segments(chat_session.id, source, target)
+    moved, last_id = _copy_messages(chat_session.id, source, target, 0, chunk_size)
+    with transaction.atomic(using=source):
+        # A no-op write takes the source's write lock, waiting out any message insert in flight
+        Message.objects.allocate_ids(source, 0)
+        with transaction.atomic():
+            ChatSession.objects.filter(pk=chat_session.pk).update(shard=target, version=F('version') + 1)
+    chat_session.shard = target
+    # Writers that committed on the source before the switch
+    caught_up, last_id = _copy_messages(chat_session.id, source, target, last_id, chunk_size)
+    moved += caught_up
+
+    for queryset in (
+        MessageKey.objects.using(source).filter(chat_session_id=chat_session.id),
+        Message.objects.using(source).filter(chat_session_id=chat_session.id),
+        ArchivedSegment.objects.using(source).filter(chat_session_id=chat_session.id),
+    ):
+        while delete_batch(queryset, chunk_size):
+            pass
+    return moved
@@ -0,0 +1,121 @@
+import base64
+import binascii
+
+from django.db import DEFAULT_DB_ALIAS
+
+from secure_messenger.routers import read_alias
+
+from .models import ChatSession, ChatParticipant, Message
+
+# Bounds for a single sync page
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# v2 cursors hold one position per shard: each shard numbers its own changes
+CURSOR_VERSION = 'v2'
+LEGACY_CURSOR_VERSION = 'v1'
+
+
+class InvalidCursor(ValueError):
+    """Raised when a client sends a cursor we did not issue."""
+
+
+def encode_cursor(positions):
+    """Wrap ``{shard alias: change sequence}`` in an opaque cursor string."""
+    value = ','.join(f"{alias}={change_seq}" for alias, change_seq in sorted(positions.items()))
+    raw = f"{CURSOR_VERSION}:{value}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('utf-8').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the ``{shard alias: change sequence}`` positions stored in a cursor."""
+    if not cursor:
+        return {}
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        version, _, value = base64.urlsafe_b64decode(padded.encode('utf-8')).decode('utf-8').partition(':')
+        if version == LEGACY_CURSOR_VERSION:
+            # Issued before sharding, when everything was numbered on default
+            positions = {DEFAULT_DB_ALIAS: int(value)}
+        else:
+            positions = {
+                alias: int(change_seq)
+                for alias, _, change_seq in (item.partition('=') for item in value.split(',') if item)
+            }
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor('Malformed sync cursor')
+    if version not in (CURSOR_VERSION, LEGACY_CURSOR_VERSION) or any(seq < 0 for seq in positions.values()):
+        raise InvalidCursor('Unsupported sync cursor')
+    return positions
+
+
+def clamp_page_size(value):
+    """Parse a requested page size and keep it within bounds."""
+    try:
+        page_size = int(value) if value is not None else DEFAULT_PAGE_SIZE
+    except (TypeError, ValueError):
+        page_size = DEFAULT_PAGE_SIZE
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def collect_changes(user, since, page_size):
+    """
+    Collect the changes visible to a user above the ``since`` positions.
+
+    Every change-tracked table is read with an indexed range scan on
+    ``change_seq``, fetching at most ``page_size + 1`` rows each. Within one
+    shard the sequence is shared by all its tables, so merging those heads and
+    keeping the lowest entries yields a gap-free page for that shard. Shards
+    are visited in turn until the page is full; each shard's position only
+    advances past what the page includes.
+    """
+    memberships = ChatParticipant.objects.filter(user=user)
+    member_session_ids = list(memberships.values_list('chat_session_id', flat=True))
+    active_by_shard = {}
+    for chat_session_id, shard in memberships.filter(is_active=True).values_list(
+        'chat_session_id', 'chat_session__shard'
+    ):
+        active_by_shard.setdefault(shard or DEFAULT_DB_ALIAS, []).append(chat_session_id)
+
+    limit = page_size + 1
+    # Sessions and participants are numbered on default, messages on their shard
+    sources = {DEFAULT_DB_ALIAS: [
+        ('sessions', ChatSession.objects.filter(
+            id__in=member_session_ids,
+            change_seq__gt=since.get(DEFAULT_DB_ALIAS, 0)
+        ).order_by('change_seq')[:limit]),
+        ('participants', ChatParticipant.objects.filter(
+            chat_session_id__in=member_session_ids,
+            change_seq__gt=since.get(DEFAULT_DB_ALIAS, 0)
+        ).select_related('user').order_by('change_seq')[:limit]),
+    ]}
+    for db, session_ids in active_by_shard.items():
+        # Senders live on default, so they are fetched separately
+        sources.setdefault(db, []).append(('messages', Message.objects.with_key_for(user).using(
+            read_alias(db)
+        ).filter(
+            chat_session_id__in=session_ids,
+            change_seq__gt=since.get(db, 0)
+        ).prefetch_related('sender').order_by('change_seq')[:limit]))
+
+    changes = {'sessions': [], 'participants': [], 'messages': []}
+    positions = dict(since)
+    has_more = False
+    remaining = page_size
+    for db in sorted(sources, key=lambda alias: alias != DEFAULT_DB_ALIAS):
+        if not remaining:
+            has_more = True
+            break
+        merged = sorted(
+            ((obj.change_seq, kind, obj) for kind, queryset in sources[db] for obj in queryset),
+            key=lambda entry: entry[0]
+        )
+        page = merged[:remaining]
+        has_more = has_more or len(merged) > len(page)
+        for _, kind, obj in page:
+            changes[kind].append(obj)
+        if page:
+            positions[db] = page[-1][0]
+        remaining -= len(page)
+
+    return changes, positions, has_more
@@ -0,0 +1,347 @@
+import asyncio
+import json
+import random
+import re
+import unittest
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from django.db import DatabaseError, connection
+from django.db.models import Count, Prefetch, Q, prefetch_related_objects
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from chat.archive import SessionArchive, archive_chunk
+from chat.counters import rebuild_session_counters
+from chat.models import ArchivedSegment, ChatParticipant, ChatSession, Message
+from chat.receipts import ReadStateCoalescer, attach_unread_counts, coalescer
+from chat.serializers import (
+    ChatSessionSerializer,
+    MessageSerializer,
+    message_rows,
+    serialize_messages,
+    serialize_sessions
+)
+from chat.views import user_sessions
+from encryption.utils import encrypt_message_for_participants, generate_key_pair
+from users.activity import active_sessions
+from users.models import CustomUser
+from users.search import usernames_with_prefix
+
+
+def make_users(*names):
+    """Create users sharing one generated key pair."""
+    key_pair = generate_key_pair()
+    return [
+        CustomUser.objects.create_user(
+            name,
+            'test-password',
+            email=f'{name}@example.com',
+            public_key=key_pair['public_key'],
+            private_key=key_pair['private_key']
+        )
+        for name in names
+    ]
+
+
+def make_session(session_id, users, messages):
+    """Create a session between ``users`` holding ``messages`` sent by them in turn."""
+    chat_session = ChatSession.objects.create(session_id=session_id)
+    for user in users:
+        ChatParticipant.objects.create(chat_session=chat_session, user=user)
+    keys = {user.username: user.public_key for user in users}
+    recipients = {user.username: user.id for user in users}
+    for n in range(messages):
+        encrypted = encrypt_message_for_participants(f'message {n}', keys)
+        Message.objects.create_encrypted(chat_session, users[n % len(users)], encrypted, recipients)
+    chat_session.refresh_from_db()
+    return chat_session
+
+
+class FastSerializerTests(TestCase):
+    """serialize_messages and serialize_sessions return what the DRF serializers do."""
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = make_users('alice', 'bob', 'carol')
+        cls.chat_session = make_session('fast-path', [cls.alice, cls.bob], 5)
+        # Carol joins afterwards, so no message holds a key wrapped for her
+        ChatParticipant.objects.create(chat_session=cls.chat_session, user=cls.carol)
+        archive_chunk(cls.chat_session.id, timezone.now(), chunk_size=2)
+
+    def request_for(self, user):
+        request = Request(APIRequestFactory().get('/'))
+        request.user = user
+        return request
+
+    def as_json(self, data):
+        return json.loads(json.dumps(data))
+
+    def test_history_matches_message_serializer(self):
+        for user in (self.alice, self.bob, self.carol):
+            with self.subTest(user=user.username):
+                hot = Message.objects.with_key_for(user).filter(chat_session=self.chat_session).order_by('timestamp', 'id')
+                archived = SessionArchive(self.chat_session).all()
+                expected = MessageSerializer(
+                    archived + list(hot.prefetch_related('sender')),
+                    many=True,
+                    context={'request': self.request_for(user)}
+                ).data
+                self.assertEqual(
+                    self.as_json(serialize_messages(archived + list(message_rows(hot)), user)),
+                    self.as_json(expected)
+                )
+
+    def test_reader_without_key_gets_no_wrapped_key(self):
+        hot = Message.objects.with_key_for(self.carol).filter(chat_session=self.chat_session)
+        data = serialize_messages(SessionArchive(self.chat_session).all() + list(message_rows(hot)), self.carol)
+        self.assertEqual(len(data), 5)
+        self.assertTrue(all(message['encrypted_keys'] == {} for message in data))
+
+    def test_session_list_matches_chat_session_serializer(self):
+        for user in (self.alice, self.carol):
+            with self.subTest(user=user.username):
+                chat_sessions = list(user_sessions(user))
+                prefetch_related_objects(chat_sessions, Prefetch(
+                    'messages', queryset=Message.objects.with_key_for(user).order_by('id').prefetch_related('sender')
+                ))
+                attach_unread_counts(chat_sessions)
+                expected = ChatSessionSerializer(
+                    chat_sessions, many=True, context={'request': self.request_for(user)}
+                ).data
+                self.assertEqual(
+                    self.as_json(serialize_sessions(user_sessions(user), user)),
+                    self.as_json(expected)
+                )
+
+
+class SessionCounterTests(TestCase):
+    databases = '__all__'
+
+    def test_rebuild_counts_archived_messages(self):
+        alice, bob = make_users('alice', 'bob')
+        chat_session = make_session('counters', [alice, bob], 6)
+        expected = (chat_session.message_count, chat_session.last_message_id, chat_session.last_message_at)
+        self.assertEqual(expected[0], 6)
+
+        self.assertEqual(archive_chunk(chat_session.id, timezone.now()), 5)
+        rebuild_session_counters(session_ids=[chat_session.id])
+
+        chat_session.refresh_from_db()
+        self.assertEqual(
+            (chat_session.message_count, chat_session.last_message_id, chat_session.last_message_at),
+            expected
+        )
+
+    def test_participants_follow_last_message_at(self):
+        alice, bob, carol = make_users('alice', 'bob', 'carol')
+        older = make_session('older', [alice, bob], 2)
+        newer = make_session('newer', [alice, carol], 1)
+        quiet = make_session('quiet', [alice], 0)
+        self.assertEqual([s.id for s in user_sessions(alice)], [newer.id, older.id, quiet.id])
+
+        make_session('unrelated', [bob, carol], 1)
+        Message.objects.create_encrypted(older, bob, encrypt_message_for_participants(
+            'reply', {user.username: user.public_key for user in (alice, bob)}
+        ), {alice.username: alice.id, bob.username: bob.id})
+        self.assertEqual([s.id for s in user_sessions(alice)], [older.id, newer.id, quiet.id])
+
+        # A participant who joins later starts from the session's position
+        dave, = make_users('dave')
+        ChatParticipant.objects.create(chat_session=older, user=dave)
+        older.refresh_from_db()
+        self.assertEqual(
+            set(ChatParticipant.objects.filter(chat_session=older).values_list('last_message_at', flat=True)),
+            {older.last_message_at}
+        )
+
+
+class ReadReceiptTests(TestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = make_users('alice', 'bob', 'carol')
+        # Only alice sends, so bob and carol both have something to read
+        cls.chat_session = make_session('receipts', [cls.alice, cls.bob, cls.carol], 1)
+
+    def setUp(self):
+        # Write buffered positions while the test database still exists
+        self.addCleanup(coalescer.flush)
+
+    def test_read_actions_share_one_fanout_batch(self):
+        channel_layer = get_channel_layer()
+        group = f'chat_{self.chat_session.id}'
+        channel = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(group, channel)
+        self.addCleanup(async_to_sync(channel_layer.group_discard), group, channel)
+        last_message_id = self.chat_session.last_message_id
+
+        def read(user):
+            client = APIClient()
+            client.force_authenticate(user)
+            return client.post(
+                f'/api/chats/{self.chat_session.id}/read/', {'message_id': last_message_id}, format='json'
+            ).status_code
+
+        async def read_both():
+            # Sync views called from a running loop, as under ASGI
+            statuses = [await sync_to_async(read)(user) for user in (self.bob, self.carol)]
+            event = await asyncio.wait_for(channel_layer.receive(channel), timeout=5)
+            return statuses, event
+
+        statuses, event = async_to_sync(read_both)()
+        self.assertEqual(statuses, [200, 200])
+        self.assertEqual(event['type'], 'read_receipts')
+        self.assertEqual(sorted(event['receipts'], key=lambda receipt: receipt['username']), [
+            {'username': 'bob', 'message_id': last_message_id},
+            {'username': 'carol', 'message_id': last_message_id},
+        ])
+
+
+    def test_failed_flush_keeps_positions(self):
+        read_state = ReadStateCoalescer()
+        # Flushed by hand below, not by the background thread
+        read_state._flusher_started = True
+        session_id = self.chat_session.id
+        read_state.mark_read(session_id, self.bob.id, 5)
+        read_state.mark_read(session_id, self.carol.id, 3)
+
+        def failing_filter(*args, **kwargs):
+            # Marks landing while the write is in flight: one older, one newer
+            read_state.mark_read(session_id, self.bob.id, 4)
+            read_state.mark_read(session_id, self.carol.id, 7)
+            raise DatabaseError('flush failed')
+
+        with mock.patch.object(ChatSession.objects, 'filter', side_effect=failing_filter):
+            with self.assertRaises(DatabaseError):
+                read_state.flush()
+        self.assertEqual(read_state.pending_for(session_id, self.bob.id), 5)
+        self.assertEqual(read_state.pending_for(session_id, self.carol.id), 7)
+
+        self.assertEqual(read_state.flush(), 2)
+        self.assertEqual(dict(ChatParticipant.objects.filter(
+            chat_session_id=session_id,
+            user__in=[self.bob, self.carol]
+        ).values_list('user__username', 'last_read_message_id')), {'bob': 5, 'carol': 7})
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'Query plans are checked on SQLite')
+class QueryPlanTests(TestCase):
+    """
+    The queries chat.views, chat.consumers and chat.sync issue on every request
+    or message are lookups on the index meant for them (EXPLAIN QUERY PLAN on
+    a seeded, analyzed database).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(4730)
+        CustomUser.objects.bulk_create(
+            CustomUser(username=f'plan{i}', email=f'plan{i}@example.com', password='!') for i in range(50)
+        )
+        user_ids = list(CustomUser.objects.values_list('id', flat=True))
+        ChatSession.objects.bulk_create(
+            ChatSession(session_id=f'plan-session-{i}', change_seq=i + 1) for i in range(200)
+        )
+        session_ids = list(ChatSession.objects.values_list('id', flat=True))
+        participants = [
+            ChatParticipant(chat_session_id=session_id, user_id=user_id, is_active=rng.random() > 0.1)
+            for session_id in session_ids
+            for user_id in rng.sample(user_ids, 3)
+        ]
+        for change_seq, participant in enumerate(participants, 1):
+            participant.change_seq = change_seq
+        ChatParticipant.objects.bulk_create(participants)
+        now = timezone.now()
+        Message.objects.bulk_create(
+            Message(
+                chat_session_id=rng.choice(session_ids),
+                sender_id=rng.choice(user_ids),
+                content=b'x', encryption_key=b'x', iv=b'x',
+                timestamp=now,
+                change_seq=i + 1
+            )
+            for i in range(5000)
+        )
+        rebuild_session_counters()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        membership = ChatParticipant.objects.filter(is_active=True).select_related('user', 'chat_session').first()
+        cls.user, cls.chat_session = membership.user, membership.chat_session
+        cls.session_ids = list(
+            ChatParticipant.objects.filter(user=cls.user).values_list('chat_session_id', flat=True)
+        )
+
+    def hot_queries(self):
+        """
+        (label, queryset, index, ordered) for each hot query, built the way
+        the views build them. ``index`` must drive the plan and, if
+        ``ordered``, also satisfy the ORDER BY without a temporary sort.
+        """
+        user, chat_session, session_ids = self.user, self.chat_session, self.session_ids
+        return [
+            ('session list', user_sessions(user), 'chat_participant_user_active', True),
+            ('unread count', Message.objects.filter(
+                chat_session=chat_session,
+                id__gt=0
+            ).values('id'), 'chat_message_chat_session_id_5366a3cd', False),
+            ('unread counts for a session list', Message.objects.filter(
+                Q(chat_session_id=session_ids[0], id__gt=0) | Q(chat_session_id=session_ids[-1], id__gt=0)
+            ).order_by().values('chat_session_id').annotate(total=Count('id')),
+                'chat_message_chat_session_id_5366a3cd', False),
+            ('session version lookup', ChatSession.objects.filter(
+                id=chat_session.id,
+                participants__user=user,
+                participants__is_active=True
+            ).values_list('version', 'change_seq'), 'chat_participant_sess_active', False),
+            ('participant check', ChatParticipant.objects.filter(
+                chat_session=chat_session,
+                user=user,
+                is_active=True
+            ), 'chat_chatparticipant_chat_session_id_user_id_2c211203_uniq', False),
+            ('user memberships', ChatParticipant.objects.filter(
+                user=user,
+                is_active=True
+            ).values_list('chat_session_id', flat=True), 'chat_participant_user_active', False),
+            ('history in time order', Message.objects.filter(
+                chat_session=chat_session
+            ).order_by('timestamp', 'id'), 'chat_message_session_time', True),
+            ('history page', Message.objects.filter(
+                chat_session=chat_session,
+                id__lt=10 ** 12
+            ).order_by('-id')[:51], 'chat_message_chat_session_id_5366a3cd', True),
+            ('archive segments before', ArchivedSegment.objects.filter(
+                chat_session=chat_session,
+                first_message_id__lt=10 ** 12
+            ).order_by('-first_message_id').values_list('id', flat=True), 'chat_segment_first_id', True),
+            ('archive segments after', ArchivedSegment.objects.filter(
+                chat_session=chat_session,
+                last_message_id__gt=0
+            ).order_by('last_message_id').values_list('id', flat=True), 'chat_segment_last_id', True),
+            ('sync messages', Message.objects.filter(
+                chat_session_id__in=session_ids,
+                change_seq__gt=0
+            ).order_by('change_seq')[:101], 'chat_message_change_seq', False),
+            ('sync participants', ChatParticipant.objects.filter(
+                chat_session_id__in=session_ids,
+                change_seq__gt=0
+            ).order_by('change_seq')[:101], 'chat_participant_change_seq', False),
+            ('active user sessions', active_sessions(), 'user_session_active_seen', True),
+            ('username prefix', usernames_with_prefix(user.username[:3])[:11], 'sqlite_autoindex_users_1', True),
+        ]
+
+    def test_hot_queries_use_their_indexes(self):
+        for label, queryset, index, ordered in self.hot_queries():
+            with self.subTest(label):
+                # Lines read "<id> <parent> <unused> <detail>"
+                plan = [re.sub(r'^[\d\s|`-]*', '', line) for line in queryset.explain().splitlines()]
+                driving = next(line for line in plan if line.startswith(('SEARCH', 'SCAN')))
+                self.assertIn(f'INDEX {index} (', driving, '\n'.join(plan))
+                if ordered:
+                    self.assertFalse([line for line in plan if 'TEMP B-TREE' in line], '\n'.join(plan))
@@ -2,27 +2,103 @@ from rest_framework import viewsets, status, permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.contrib.auth import get_user_model
-from .models import ChatSession, ChatParticipant, Message
+from django.http import StreamingHttpResponse
+from .models import ChatSession, ChatParticipant, Message, MessageKey
 from .serializers import (
     ChatSessionSerializer, 
     CreateChatSessionSerializer, 
-    MessageSerializer
+    MessageSerializer,
+    SyncChatSessionSerializer,
+    SyncParticipantSerializer,
+    SyncMessageSerializer,
+    message_rows,
+    serialize_messages,
+    serialize_sessions
 )
+from .archive import SessionArchive
+from .conditional import conditional_session_get, stats as conditional_stats
+from .export import (
+    CONTENT_TYPE as EXPORT_CONTENT_TYPE,
+    export_records,
+    ndjson_lines,
+    streaming_body
+)
+from .history import history_page, parse_page_params, wants_page
+from .receipts import (
+    advance_read,
+    coalescer as read_coalescer,
+    fanout as read_fanout,
+    unread_count,
+    with_read_state
+)
+from .sync import (
+    InvalidCursor,
+    clamp_page_size,
+    collect_changes,
+    decode_cursor,
+    encode_cursor
+)
+from secure_messenger.instrumentation import log_sampled, phase
+from secure_messenger.metrics import MESSAGES_SENT
+from secure_messenger.routers import reads_from_replica
 from encryption.utils import (
     encrypt_message_for_participants,
-    decrypt_with_private_key,
-    decrypt_with_aes
+    MessageDecryptor
 )
 import uuid
 import logging
-import json
-import base64
 
 logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
 
+def user_sessions(user):
+    """
+    The user's active chat sessions, most recently active first. Ordered on
+    the participant row's copy of last_message_at so the plan reads them in
+    order from chat_participant_user_active instead of sorting.
+    """
+    return with_read_state(ChatSession.objects.filter(
+        participants__user=user,
+        participants__is_active=True
+    )).order_by('-participants__last_message_at', '-participants__chat_session_id')
+
+
+def message_recipients(chat_session):
+    """
+    Map each active participant's username to their public key and to their
+    user id, as ``encrypt_message_for_participants`` and
+    ``Message.objects.create_encrypted`` take them.
+    """
+    participants = ChatParticipant.objects.filter(
+        chat_session=chat_session,
+        is_active=True
+    ).select_related('user')
+    public_keys = {participant.user.username: participant.user.public_key for participant in participants}
+    recipients = {participant.user.username: participant.user.id for participant in participants}
+    return public_keys, recipients
+
+
+def session_history(chat_session, request, page_params=None):
+    """
+    A session's messages as the messages action returns them: all of them,
+    or one page for ``(after, before, limit)`` from ``parse_page_params``.
+    """
+    messages = message_rows(Message.objects.with_key_for(request.user).for_session(chat_session))
+    archive = SessionArchive(chat_session)
+    if page_params is None:
+        page = archive.all() + list(messages.order_by('timestamp', 'id'))
+        with phase('serialize'):
+            return serialize_messages(page, request.user)
+    
+    after, before, limit = page_params
+    page, has_more = history_page(messages, after, before, limit, archive)
+    with phase('serialize'):
+        data = serialize_messages(page, request.user)
+    return {'results': data, 'has_more': has_more}
+
+
 class ChatSessionViewSet(viewsets.ModelViewSet):
     serializer_class = ChatSessionSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -30,27 +106,29 @@ class ChatSessionViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         """Get chat sessions where the user is an active participant."""
         user = self.request.user
-        logger.info(f"Getting chat sessions for user: {user.username}")
         
         if self.action == 'retrieve':
             # For retrieving a specific chat session, check if user is a participant
             chat_id = self.kwargs.get('pk')
-            logger.info(f"Retrieving specific chat session: {chat_id}")
             if chat_id:
-                queryset = ChatSession.objects.filter(
+                return with_read_state(ChatSession.objects.filter(
                     id=chat_id,
                     participants__user=user,
                     participants__is_active=True
-                )
-                logger.info(f"Found {queryset.count()} matching chat sessions")
-                return queryset
+                ))
         # For list view, return all active chat sessions for the user
-        queryset = ChatSession.objects.filter(
-            participants__user=user,
-            participants__is_active=True
-        )
-        logger.info(f"Found {queryset.count()} active chat sessions for user")
-        return queryset
+        return user_sessions(user)
+    
+    @reads_from_replica
+    def list(self, request, *args, **kwargs):
+        """List the user's chat sessions, most recently active first."""
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        with phase('serialize'):
+            data = serialize_sessions(queryset if page is None else page, request.user)
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
     
     def get_serializer_class(self):
         if self.action == 'create':
@@ -93,7 +171,7 @@ class ChatSessionViewSet(viewsets.ModelViewSet):
         chat_session = serializer.save()
         
         return Response(
-            ChatSessionSerializer(chat_session).data,
+            ChatSessionSerializer(chat_session, context={'request': request}).data,
             status=status.HTTP_201_CREATED
         )
     
@@ -116,7 +194,7 @@ class ChatSessionViewSet(viewsets.ModelViewSet):
             # Add user as participant
             ChatParticipant.objects.create(chat_session=chat_session, user=user)
             
-            return Response(ChatSessionSerializer(chat_session).data)
+            return Response(ChatSessionSerializer(chat_session, context={'request': request}).data)
         
         except User.DoesNotExist:
             return Response({'error': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -136,20 +214,79 @@ class ChatSessionViewSet(viewsets.ModelViewSet):
             participant.is_active = False
             participant.save()
             
-            return Response(ChatSessionSerializer(chat_session).data)
+            # Drop the removed user's wrapped keys for this session
+            MessageKey.objects.for_session(chat_session).filter(recipient=user).delete()
+            
+            return Response(ChatSessionSerializer(chat_session, context={'request': request}).data)
         
         except (User.DoesNotExist, ChatParticipant.DoesNotExist):
             return Response({'error': 'Participant not found'}, status=status.HTTP_404_NOT_FOUND)
 
+    @action(detail=True, methods=['post'])
+    def read(self, request, pk=None):
+        """Advance the current user's read position in a chat session."""
+        try:
+            message_id = int(request.data.get('message_id'))
+        except (TypeError, ValueError):
+            return Response({'error': 'message_id must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            result = advance_read(int(pk), request.user, message_id)
+        except ValueError:
+            result = None
+        if result is None:
+            return Response({'error': 'Chat session not found'}, status=status.HTTP_404_NOT_FOUND)
+        position, advanced = result
+        if advanced:
+            # Batched with the WebSocket receipts for the same session
+            read_fanout.publish_sync(f'chat_{int(pk)}', request.user.username, position)
+        
+        return Response({
+            'chat_session_id': int(pk),
+            'last_read_message_id': position,
+            'unread_count': unread_count(int(pk), position)
+        })
+    
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        """Stream the session's full history as NDJSON."""
+        # Looked up directly: get_object would prefetch every message
+        chat_session = ChatSession.objects.filter(
+            id=pk,
+            participants__user=request.user,
+            participants__is_active=True
+        ).first()
+        if chat_session is None:
+            return Response({'error': 'Chat session not found'}, status=status.HTTP_404_NOT_FOUND)
+        
+        lines = ndjson_lines(export_records(chat_session, request))
+        response = StreamingHttpResponse(
+            streaming_body(lines, request._request),
+            content_type=EXPORT_CONTENT_TYPE
+        )
+        response['Content-Disposition'] = f'attachment; filename="chat-{chat_session.id}.ndjson"'
+        return response
+    
+    @action(detail=False, methods=['get'], permission_classes=[permissions.IsAdminUser])
+    def conditional_stats(self, request):
+        """Report how often session polls were answered with 304 Not Modified."""
+        return Response(conditional_stats.snapshot())
+
     @action(detail=True, methods=['get', 'post'])
+    @reads_from_replica
+    @conditional_session_get
     def messages(self, request, pk=None):
         """Handle messages for a specific chat session."""
         chat_session = self.get_object()
         
         if request.method == 'GET':
-            messages = Message.objects.filter(chat_session=chat_session)
-            serializer = MessageSerializer(messages, many=True)
-            return Response(serializer.data)
+            page_params = None
+            if wants_page(request.query_params):
+                try:
+                    page_params = parse_page_params(request.query_params)
+                except ValueError:
+                    return Response({'error': 'Invalid page parameters'}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(session_history(chat_session, request, page_params))
         
         elif request.method == 'POST':
             # Check if user is a participant
@@ -164,53 +301,41 @@ class ChatSessionViewSet(viewsets.ModelViewSet):
                 )
             
             # Get all active participants and their public keys
-            participants = ChatParticipant.objects.filter(
-                chat_session=chat_session,
-                is_active=True
-            ).select_related('user')
-            
-            participants_public_keys = {
-                participant.user.username: participant.user.public_key
-                for participant in participants
-            }
+            participants_public_keys, recipients = message_recipients(chat_session)
             
             # Encrypt the message for all participants
-            encrypted_data = encrypt_message_for_participants(
-                request.data.get('content', ''),
-                participants_public_keys
-            )
-            
-            # Log encryption details
-            print(f"Message encryption details:")
-            print(f"Original content: {request.data.get('content', '')}")
-            print(f"Encrypted content: {encrypted_data['encrypted_content']}")
-            print(f"IV: {encrypted_data['iv']}")
-            print(f"Encrypted keys: {json.dumps(encrypted_data['encrypted_keys'], indent=2)}")
+            with phase('encrypt'):
+                encrypted_data = encrypt_message_for_participants(
+                    request.data.get('content', ''),
+                    participants_public_keys
+                )
             
             # Create encrypted message
-            message = Message.objects.create(
-                chat_session=chat_session,
-                sender=request.user,
-                content=encrypted_data['encrypted_content'],
-                encryption_key=encrypted_data['encrypted_keys'][request.user.username],
-                encrypted_keys=encrypted_data['encrypted_keys'],
-                iv=encrypted_data['iv']
-            )
+            with phase('persist'):
+                message = Message.objects.create_encrypted(
+                    chat_session, request.user, encrypted_data, recipients
+                )
+            # A sender has read everything up to their own message
+            read_coalescer.mark_read(chat_session.id, request.user.id, message.id)
+            
+            MESSAGES_SENT.labels('rest').inc()
+            log_sampled(logger, logging.DEBUG, "Message %s created in chat %s for %d recipients",
+                        message.id, chat_session.id, len(participants_public_keys))
             
-            serializer = MessageSerializer(message)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            with phase('serialize'):
+                data = MessageSerializer(message, context={'request': request}).data
+            return Response(data, status=status.HTTP_201_CREATED)
 
+    @conditional_session_get
     def retrieve(self, request, *args, **kwargs):
         """Retrieve a specific chat session."""
-        logger.info(f"Retrieve request for chat session {kwargs.get('pk')} from user {request.user.username}")
         try:
             instance = self.get_object()
-            logger.info(f"Found chat session: {instance.id}")
-            serializer = self.get_serializer(instance)
-            logger.info(f"Serialized chat session data: {serializer.data}")
-            return Response(serializer.data)
+            with phase('serialize'):
+                data = serialize_sessions([instance], request.user)[0]
+            return Response(data)
         except Exception as e:
-            logger.error(f"Error retrieving chat session: {str(e)}")
+            logger.error("Error retrieving chat session %s: %s", kwargs.get('pk'), e)
             raise
 
 
@@ -226,7 +351,7 @@ class MessageViewSet(viewsets.ModelViewSet):
                 chat_session = ChatSession.objects.get(id=chat_session_id)
                 # Check if user is a participant
                 if ChatParticipant.objects.filter(chat_session=chat_session, user=self.request.user).exists():
-                    return Message.objects.filter(chat_session=chat_session)
+                    return Message.objects.with_key_for(self.request.user).for_session(chat_session)
             except ChatSession.DoesNotExist:
                 pass
         return Message.objects.none()
@@ -250,44 +375,27 @@ class MessageViewSet(viewsets.ModelViewSet):
             content = request.data.get('content', '')
             
             # Get all active participants and their public keys
-            participants = ChatParticipant.objects.filter(
-                chat_session=chat_session,
-                is_active=True
-            ).select_related('user')
-            
-            participants_public_keys = {
-                participant.user.username: participant.user.public_key
-                for participant in participants
-            }
+            participants_public_keys, recipients = message_recipients(chat_session)
             
             # Encrypt the message for all participants
-            encrypted_data = encrypt_message_for_participants(content, participants_public_keys)
-            
-            # Log encryption details
-            logger.info(f"Message encryption details:")
-            logger.info(f"Original content: {content}")
-            logger.info(f"Encrypted content: {encrypted_data['encrypted_content']}")
-            logger.info(f"IV: {encrypted_data['iv']}")
-            logger.info(f"Encrypted keys: {json.dumps(encrypted_data['encrypted_keys'], indent=2)}")
+            with phase('encrypt'):
+                encrypted_data = encrypt_message_for_participants(content, participants_public_keys)
             
             # Create encrypted message
-            message = Message.objects.create(
-                chat_session=chat_session,
-                sender=request.user,
-                content=encrypted_data['encrypted_content'],
-                encryption_key=encrypted_data['encrypted_keys'][request.user.username],
-                encrypted_keys=encrypted_data['encrypted_keys'],
-                iv=encrypted_data['iv']
-            )
+            with phase('persist'):
+                message = Message.objects.create_encrypted(
+                    chat_session, request.user, encrypted_data, recipients
+                )
+            # A sender has read everything up to their own message
+            read_coalescer.mark_read(chat_session.id, request.user.id, message.id)
             
-            # Log message creation
-            logger.info(f"Message created:")
-            logger.info(f"Message ID: {message.id}")
-            logger.info(f"Chat Session: {chat_session.id}")
-            logger.info(f"Sender: {request.user.username}")
-            logger.info(f"Content: {message.content}")
+            MESSAGES_SENT.labels('rest').inc()
+            log_sampled(logger, logging.DEBUG, "Message %s created in chat %s by %s",
+                        message.id, chat_session.id, request.user.username)
             
-            return Response(MessageSerializer(message).data, status=status.HTTP_201_CREATED)
+            with phase('serialize'):
+                data = MessageSerializer(message, context={'request': request}).data
+            return Response(data, status=status.HTTP_201_CREATED)
         
         except ChatSession.DoesNotExist:
             return Response({'error': 'Chat session not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -295,31 +403,111 @@ class MessageViewSet(viewsets.ModelViewSet):
     def retrieve(self, request, *args, **kwargs):
         """Retrieve and decrypt a message."""
         message = self.get_object()
+        wrapped_key = message.wrapped_key_for(request.user.id)
+        if wrapped_key is None:
+            return Response(
+                {'error': 'No key was wrapped for you on this message'},
+                status=status.HTTP_403_FORBIDDEN
+            )
         
-        # Decrypt the AES key using the user's private key
+        # Decrypt the AES key using the user's private key, then the content
         try:
-            aes_key_str = decrypt_with_private_key(
-                request.user.private_key,
-                message.encryption_key
-            )
-            aes_key = base64.b64decode(aes_key_str)
-            
-            # Decrypt the message content
-            decrypted_content = decrypt_with_aes(
-                aes_key,
-                message.iv,
-                message.content
-            )
+            with phase('decrypt'):
+                decrypted_content = MessageDecryptor(request.user.private_key).decrypt(
+                    wrapped_key,
+                    message.iv,
+                    message.content
+                )
             
             # Add decrypted content to the response
-            response_data = MessageSerializer(message).data
+            with phase('serialize'):
+                response_data = MessageSerializer(message, context={'request': request}).data
             response_data['decrypted_content'] = decrypted_content
             
             return Response(response_data)
             
         except Exception as e:
-            logger.error(f"Failed to decrypt message: {str(e)}")
+            logger.error("Failed to decrypt message %s: %s", message.id, e)
             return Response(
                 {'error': 'Failed to decrypt message'},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
\ No newline at end of file
+            )
+
+    @action(detail=False, methods=['get'])
+    @reads_from_replica
+    def decrypt(self, request):
+        """Decrypt a page of messages from one chat session in a single request."""
+        chat_session_id = request.query_params.get('chat_session_id')
+        if not chat_session_id:
+            return Response({'error': 'Chat session ID is required'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            after, before, limit = parse_page_params(request.query_params)
+        except ValueError:
+            return Response({'error': 'Invalid page parameters'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        chat_session = ChatSession.objects.filter(
+            id=chat_session_id,
+            participants__user=request.user
+        ).only('id', 'shard').first()
+        if chat_session is None:
+            return Response({'error': 'Chat session not found'}, status=status.HTTP_404_NOT_FOUND)
+        
+        if not request.user.private_key:
+            return Response({'error': 'No private key available for this user'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        messages, has_more = history_page(
+            Message.objects.with_key_for(request.user).for_session(chat_session).prefetch_related('sender'),
+            after, before, limit,
+            SessionArchive(chat_session)
+        )
+        
+        # Parse the private key once for the whole page
+        decryptor = MessageDecryptor(request.user.private_key)
+        
+        def decrypted(message):
+            with phase('serialize'):
+                data = MessageSerializer(message, context={'request': request}).data
+            try:
+                with phase('decrypt'):
+                    data['decrypted_content'] = decryptor.decrypt(
+                        message.wrapped_key_for(request.user.id),
+                        message.iv,
+                        message.content
+                    )
+            except Exception as e:
+                logger.warning("Failed to decrypt message %s: %s", message.id, e)
+                data['decrypted_content'] = None
+                data['error'] = 'Failed to decrypt message'
+            return data
+        
+        # The page is already bounded by MAX_PAGE_SIZE, so it is returned whole
+        return Response({
+            'results': [decrypted(message) for message in messages],
+            'has_more': has_more
+        })
+
+
+class SyncViewSet(viewsets.ViewSet):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def list(self, request):
+        """Return changes across the user's chats since the given cursor."""
+        try:
+            since = decode_cursor(request.query_params.get('cursor'))
+        except InvalidCursor as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        page_size = clamp_page_size(request.query_params.get('limit'))
+        changes, positions, has_more = collect_changes(request.user, since, page_size)
+
+        context = {'request': request}
+        with phase('serialize'):
+            data = {
+                'sessions': SyncChatSessionSerializer(changes['sessions'], many=True).data,
+                'participants': SyncParticipantSerializer(changes['participants'], many=True).data,
+                'messages': SyncMessageSerializer(changes['messages'], many=True, context=context).data,
+                'cursor': encode_cursor(positions),
+                'has_more': has_more
+            }
+        return Response(data)
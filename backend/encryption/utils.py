@@ -1,15 +1,21 @@
 import base64
+import binascii
+import hashlib
 import os
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
-import json
+from secure_messenger.instrumentation import phase
+from secure_messenger.metrics import ENCRYPTION_SECONDS, participant_bucket
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 def generate_key_pair():
     """Generate a new RSA key pair."""
-    print("generate_key_pair: Starting key pair generation...")
+    logger.debug("generate_key_pair: Starting key pair generation")
     try:
         # Generate private key
         private_key = rsa.generate_private_key(
@@ -17,11 +23,9 @@ def generate_key_pair():
             key_size=2048,
             backend=default_backend()
         )
-        print("generate_key_pair: Private key generated successfully")
         
         # Get public key
         public_key = private_key.public_key()
-        print("generate_key_pair: Public key derived from private key")
         
         # Serialize private key
         private_pem = private_key.private_bytes(
@@ -29,24 +33,40 @@ def generate_key_pair():
             format=serialization.PrivateFormat.PKCS8,
             encryption_algorithm=serialization.NoEncryption()
         ).decode('utf-8')
-        print(f"generate_key_pair: Private key serialized, length: {len(private_pem)}")
         
         # Serialize public key
         public_pem = public_key.public_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PublicFormat.SubjectPublicKeyInfo
         ).decode('utf-8')
-        print(f"generate_key_pair: Public key serialized, length: {len(public_pem)}")
+        logger.debug("generate_key_pair: Key pair serialized, private key length %d, public key length %d",
+                     len(private_pem), len(public_pem))
         
         return {
             'private_key': private_pem,
             'public_key': public_pem
         }
     except Exception as e:
-        print(f"generate_key_pair: Error generating key pair: {str(e)}")
+        logger.error("generate_key_pair: Error generating key pair: %s", e)
         raise
 
 
+def public_key_fingerprint(public_key_pem):
+    """
+    Return a short fingerprint of a PEM public key: the first 128 bits of the
+    SHA-256 of its DER encoding, in hex. Empty for an empty key.
+    """
+    if not public_key_pem:
+        return ''
+    body = ''.join(line for line in public_key_pem.strip().splitlines() if not line.startswith('-----'))
+    try:
+        data = base64.b64decode(body, validate=True)
+    except (binascii.Error, ValueError):
+        # Not PEM; fingerprint the text so a change is still detected
+        data = public_key_pem.strip().encode('utf-8')
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
 def encrypt_with_public_key(public_key_pem, message):
     """Encrypt a message using the recipient's public key."""
     public_key = serialization.load_pem_public_key(
@@ -66,24 +86,31 @@ def encrypt_with_public_key(public_key_pem, message):
     return base64.b64encode(encrypted).decode('utf-8')
 
 
+def load_private_key(private_key_pem):
+    """Parse a PEM encoded private key."""
+    with phase('key_parse'):
+        return serialization.load_pem_private_key(
+            private_key_pem.encode('utf-8'),
+            password=None,
+            backend=default_backend()
+        )
+
+
 def decrypt_with_private_key(private_key_pem, encrypted_message):
     """Decrypt a message using the recipient's private key."""
-    private_key = serialization.load_pem_private_key(
-        private_key_pem.encode('utf-8'),
-        password=None,
-        backend=default_backend()
-    )
+    private_key = load_private_key(private_key_pem)
     
     encrypted_bytes = base64.b64decode(encrypted_message.encode('utf-8'))
     
-    decrypted = private_key.decrypt(
-        encrypted_bytes,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
+    with phase('rsa_unwrap'):
+        decrypted = private_key.decrypt(
+            encrypted_bytes,
+            padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None
+            )
         )
-    )
     
     return decrypted.decode('utf-8')
 
@@ -123,7 +150,11 @@ def decrypt_with_aes(key, iv, encrypted_content):
     """Decrypt a message using AES symmetric encryption."""
     iv_bytes = base64.b64decode(iv.encode('utf-8'))
     encrypted_bytes = base64.b64decode(encrypted_content.encode('utf-8'))
-    
+    return decrypt_aes_bytes(key, iv_bytes, encrypted_bytes)
+
+
+def decrypt_aes_bytes(key, iv_bytes, encrypted_bytes):
+    """Decrypt raw AES ciphertext given a raw IV."""
     cipher = Cipher(
         algorithms.AES(key),
         modes.CBC(iv_bytes),
@@ -142,21 +173,102 @@ def decrypt_with_aes(key, iv, encrypted_content):
 
 def encrypt_message_for_participants(message, participants_public_keys):
     """Encrypt a message for multiple participants using their public keys."""
-    # Generate a new AES key for this message
-    aes_key = generate_aes_key()
-    
-    # Encrypt the message with AES
-    encrypted_data = encrypt_with_aes(aes_key, message)
-    
-    # Encrypt the AES key for each participant
-    encrypted_keys = {}
-    for username, public_key in participants_public_keys.items():
-        # Convert AES key to string for encryption
-        key_str = base64.b64encode(aes_key).decode('utf-8')
-        encrypted_keys[username] = encrypt_with_public_key(public_key, key_str)
+    with ENCRYPTION_SECONDS.labels(participant_bucket(len(participants_public_keys))).time():
+        # Generate a new AES key for this message
+        aes_key = generate_aes_key()
+        
+        # Encrypt the message with AES
+        with phase('aes_encrypt'):
+            encrypted_data = encrypt_with_aes(aes_key, message)
+        
+        # Encrypt the AES key for each participant
+        encrypted_keys = {}
+        with phase('rsa_wrap'):
+            for username, public_key in participants_public_keys.items():
+                # Convert AES key to string for encryption
+                key_str = base64.b64encode(aes_key).decode('utf-8')
+                encrypted_keys[username] = encrypt_with_public_key(public_key, key_str)
     
     return {
         'encrypted_content': encrypted_data['content'],
         'iv': encrypted_data['iv'],
         'encrypted_keys': encrypted_keys
-    }
\ No newline at end of file
+    }
+
+
+class MessageDecryptor:
+    """
+    Decrypts many messages for a single recipient.
+
+    The private key is parsed once and every distinct wrapped AES key is
+    unwrapped once, so decrypting a page costs one PEM parse plus one RSA
+    operation per distinct key instead of one of each per message. Keys, IVs
+    and ciphertext are taken as raw bytes, as stored on ``Message``.
+    """
+
+    def __init__(self, private_key_pem):
+        self.private_key = load_private_key(private_key_pem)
+        self._aes_keys = {}
+
+    def unwrap_key(self, wrapped_key):
+        """Return the raw AES key for a wrapped key, unwrapping it at most once."""
+        wrapped_key = bytes(wrapped_key)
+        aes_key = self._aes_keys.get(wrapped_key)
+        if aes_key is None:
+            with phase('rsa_unwrap'):
+                key_str = self.private_key.decrypt(
+                    wrapped_key,
+                    padding.OAEP(
+                        mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                        algorithm=hashes.SHA256(),
+                        label=None
+                    )
+                ).decode('utf-8')
+            aes_key = base64.b64decode(key_str)
+            self._aes_keys[wrapped_key] = aes_key
+        return aes_key
+
+    def decrypt(self, wrapped_key, iv, encrypted_content):
+        """Decrypt one message given its wrapped key, IV and ciphertext."""
+        return decrypt_aes_bytes(self.unwrap_key(wrapped_key), bytes(iv), bytes(encrypted_content))
+
+
+def public_key_of(private_key_pem):
+    """Return the PEM public key that belongs to a PEM private key."""
+    return load_private_key(private_key_pem).public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode('utf-8')
+
+
+class KeyRewrapper:
+    """
+    Moves wrapped AES keys from one RSA key pair to another. Both private keys
+    are needed so a key already wrapped for the new pair can be recognized.
+    """
+
+    def __init__(self, old_private_key_pem, new_private_key_pem):
+        self.old_private_key = load_private_key(old_private_key_pem)
+        self.new_private_key = load_private_key(new_private_key_pem)
+        self.new_public_key = self.new_private_key.public_key()
+        self._padding = padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
+        )
+
+    def rewrap(self, wrapped_key):
+        """
+        Return the key re-wrapped for the new public key, or None if it is
+        already wrapped for it. Raises ValueError if neither key opens it.
+        """
+        wrapped_key = bytes(wrapped_key)
+        try:
+            with phase('rsa_unwrap'):
+                key_str = self.old_private_key.decrypt(wrapped_key, self._padding)
+        except ValueError:
+            with phase('rsa_unwrap'):
+                self.new_private_key.decrypt(wrapped_key, self._padding)
+            return None
+        with phase('rsa_wrap'):
+            return self.new_public_key.encrypt(key_str, self._padding)
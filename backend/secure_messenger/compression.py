@@ -0,0 +1,258 @@
+"""
+Negotiated compression of API responses.
+
+History pages, session lists and exports are mostly base64 text and
+repeated JSON keys, which compress several times over. ``CompressionMiddleware``
+picks the first of COMPRESSION_ENCODINGS that the request's Accept-Encoding
+allows. zstd and br are used only when the zstandard or brotli package is
+installed, and gzip is always available. The middleware compresses JSON and
+NDJSON responses of at least COMPRESSION_MIN_SIZE bytes, plus every
+streaming one. A streamed body is compressed chunk by chunk and flushed after
+each chunk, so an export still reaches the client as it is produced.
+
+Responses under COMPRESSION_EXCLUDE_PATHS are never compressed. Login and
+registration return the token and private key alongside request data, which
+is what a BREACH-style length oracle needs.
+
+WebSocket frames are compressed by the server rather than the application:
+``accept_websocket_compression`` is the permessage-deflate policy the serve
+command gives Daphne.
+"""
+import re
+import time
+import zlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.cache import patch_vary_headers
+
+from .metrics import COMPRESSION_BYTES, COMPRESSION_SECONDS
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson')
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+
+# Under ASGI, bodies and streamed chunks at least this large are compressed
+# on a worker thread; a megabyte takes tens of milliseconds to gzip, which
+# would stall every other request on the event loop
+OFFLOAD_SIZE = 64 * 1024
+
+# Server-to-client deflate state per WebSocket: a 4 KiB window and a small
+# hash table, since a connection may idle for hours holding it
+WEBSOCKET_WINDOW_BITS = 12
+WEBSOCKET_MEM_LEVEL = 5
+
+
+class _GzipStream:
+    def __init__(self):
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliStream:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def chunk(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class _ZstdStream:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def chunk(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+def _gzip(data):
+    return zlib.compress(data, GZIP_LEVEL, wbits=16 + zlib.MAX_WBITS)
+
+
+# Content-Encoding: (compress a whole body, stream class)
+CODECS = {'gzip': (_gzip, _GzipStream)}
+if brotli is not None:
+    CODECS['br'] = (lambda data: brotli.compress(data, quality=BROTLI_QUALITY), _BrotliStream)
+if zstandard is not None:
+    CODECS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data), _ZstdStream)
+
+_ACCEPT_RE = re.compile(r'\s*([^\s;,]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?[^,]*')
+
+
+def accepted_encodings(header):
+    """The content codings an Accept-Encoding header allows, as ``{coding: q}``."""
+    accepted = {}
+    for match in _ACCEPT_RE.finditer(header or ''):
+        coding, quality = match.group(1).lower(), match.group(2)
+        try:
+            accepted[coding] = float(quality) if quality is not None else 1.0
+        except ValueError:
+            continue
+    return accepted
+
+
+def negotiate(header, preferred=None):
+    """
+    The first of the ``preferred`` encodings (by default COMPRESSION_ENCODINGS)
+    that is installed and that the Accept-Encoding header allows; None if none is.
+    """
+    accepted = accepted_encodings(header)
+    wildcard = accepted.get('*', 0)
+    for encoding in preferred or getattr(settings, 'COMPRESSION_ENCODINGS', ['gzip']):
+        if encoding in CODECS and accepted.get(encoding, wildcard) > 0:
+            return encoding
+    return None
+
+
+def accept_websocket_compression(offers):
+    """Accept the client's first permessage-deflate offer, if it made one."""
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            window_bits = WEBSOCKET_WINDOW_BITS
+            if offer.request_max_window_bits:
+                window_bits = min(window_bits, offer.request_max_window_bits)
+            return PerMessageDeflateOfferAccept(offer, window_bits=window_bits, mem_level=WEBSOCKET_MEM_LEVEL)
+    return None
+
+
+def _record(encoding, original, compressed, seconds):
+    COMPRESSION_BYTES.labels(encoding, 'in').inc(original)
+    COMPRESSION_BYTES.labels(encoding, 'out').inc(compressed)
+    COMPRESSION_SECONDS.labels(encoding).observe(seconds)
+
+
+class _MeteredStream:
+    """A stream compressor that records its totals when finished."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self._stream = CODECS[encoding][1]()
+        self._original = 0
+        self._compressed = 0
+        self._seconds = 0.0
+
+    def chunk(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        start = time.thread_time()
+        compressed = self._stream.chunk(data)
+        self._seconds += time.thread_time() - start
+        self._original += len(data)
+        self._compressed += len(compressed)
+        return compressed
+
+    def finish(self):
+        compressed = self._stream.finish()
+        _record(self.encoding, self._original, self._compressed + len(compressed), self._seconds)
+        return compressed
+
+
+def _compress_stream(encoding, chunks):
+    stream = _MeteredStream(encoding)
+    for chunk in chunks:
+        data = stream.chunk(chunk)
+        if data:
+            yield data
+    yield stream.finish()
+
+
+async def _acompress_stream(encoding, chunks):
+    stream = _MeteredStream(encoding)
+    async for chunk in chunks:
+        if len(chunk) >= OFFLOAD_SIZE:
+            data = await sync_to_async(stream.chunk, thread_sensitive=False)(chunk)
+        else:
+            data = stream.chunk(chunk)
+        if data:
+            yield data
+    yield stream.finish()
+
+
+class CompressionMiddleware:
+    """
+    Compress large JSON and streaming responses with the best encoding the
+    client accepts. Removed from the chain unless COMPRESSION_ENABLED is set.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'COMPRESSION_ENABLED', False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.min_size = getattr(settings, 'COMPRESSION_MIN_SIZE', 1024)
+        self.exclude_paths = tuple(getattr(settings, 'COMPRESSION_EXCLUDE_PATHS', ()))
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if not response.streaming and len(response.content) >= OFFLOAD_SIZE:
+            return await sync_to_async(self.process_response, thread_sensitive=False)(request, response)
+        return self.process_response(request, response)
+
+    def process_response(self, request, response):
+        if request.path.startswith(self.exclude_paths) or response.has_header('Content-Encoding'):
+            return response
+        content_type = response.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type not in COMPRESSIBLE_TYPES:
+            return response
+        # The body depends on Accept-Encoding from here on, even if it is sent as is
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if not response.streaming and len(response.content) < self.min_size:
+            return response
+        encoding = negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = _acompress_stream(encoding, response.streaming_content)
+            else:
+                response.streaming_content = _compress_stream(encoding, response.streaming_content)
+        else:
+            start = time.thread_time()
+            compressed = CODECS[encoding][0](response.content)
+            seconds = time.thread_time() - start
+            if len(compressed) >= len(response.content):
+                return response
+            _record(encoding, len(response.content), len(compressed), seconds)
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        # The compressed body is a different representation of the resource
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
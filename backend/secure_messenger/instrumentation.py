@@ -0,0 +1,176 @@
+"""
+Lightweight per-request phase timing.
+
+Code on the hot paths wraps interesting work in ``phase('name')``. While a
+request (or WebSocket receive) is being timed the durations are accumulated
+on a context-local ``PhaseTimings``; otherwise ``phase`` hands back a shared
+no-op context manager, so the disabled cost is a single context variable read.
+"""
+import contextlib
+import contextvars
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('phase_timings', default=None)
+_NOOP = contextlib.nullcontext()
+
+
+def timing_enabled():
+    return getattr(settings, 'SERVER_TIMING_ENABLED', False)
+
+
+class PhaseTimings:
+    """Accumulated wall time and call counts per named phase."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def add(self, name, seconds):
+        entry = self.phases.get(name)
+        if entry is None:
+            self.phases[name] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def as_dict(self):
+        """Return ``{phase: (milliseconds, count)}`` including the total."""
+        result = {name: (seconds * 1000, count) for name, (seconds, count) in self.phases.items()}
+        result['total'] = (self.elapsed() * 1000, 1)
+        return result
+
+    def server_timing_header(self):
+        """Render the phases in ``Server-Timing`` header syntax."""
+        parts = []
+        for name, (milliseconds, count) in self.as_dict().items():
+            part = f'{name};dur={milliseconds:.2f}'
+            if count > 1:
+                part += f';desc="{count} calls"'
+            parts.append(part)
+        return ', '.join(parts)
+
+
+class _Phase:
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.timings.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def phase(name):
+    """Time the enclosed block as ``name`` if the current request is timed."""
+    timings = _current.get()
+    if timings is None:
+        return _NOOP
+    return _Phase(timings, name)
+
+
+def current_timings():
+    """Return the timings being collected for this context, if any."""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def collect_timings():
+    """Collect phase timings for the enclosed block and yield them."""
+    timings = PhaseTimings()
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+def _time_query(execute, sql, params, many, context):
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add('db', time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def timed_queries():
+    """Attribute time spent in database queries to the ``db`` phase."""
+    with contextlib.ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(_time_query))
+        yield
+
+
+class ServerTimingMiddleware:
+    """
+    Time each request by phase and report it in a ``Server-Timing`` header.
+
+    Removed from the middleware chain entirely unless SERVER_TIMING_ENABLED
+    is set, so it costs nothing when switched off.
+    """
+
+    def __init__(self, get_response):
+        if not timing_enabled():
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with collect_timings() as timings, timed_queries():
+            response = self.get_response(request)
+        response['Server-Timing'] = timings.server_timing_header()
+        return response
+
+
+def should_sample(rate=None):
+    """Decide whether a sampled hot-path log line should be emitted."""
+    if rate is None:
+        rate = getattr(settings, 'HOT_PATH_LOG_SAMPLE_RATE', 1.0)
+    return rate >= 1.0 or random.random() < rate
+
+
+def log_sampled(log, level, msg, *args, rate=None):
+    """
+    Log from a hot path only when the level is enabled and the line is sampled.
+
+    Arguments are formatted lazily by the logging module, so callers must pass
+    them separately rather than pre-formatting an f-string.
+    """
+    if log.isEnabledFor(level) and should_sample(rate):
+        log.log(level, msg, *args)
+
+
+@contextlib.contextmanager
+def event_timings(label):
+    """
+    Time one WebSocket event and log its phases at debug level.
+
+    Consumers have no response headers, so the breakdown is logged (sampled)
+    instead. Database work there runs on executor threads, so consumers time
+    it with explicit phases rather than connection wrappers.
+    """
+    if not timing_enabled():
+        yield None
+        return
+    with collect_timings() as timings:
+        yield timings
+    log_sampled(logger, logging.DEBUG, '%s timings: %s', label, timings.server_timing_header())
@@ -0,0 +1,485 @@
+"""
+In-process metrics with Prometheus text exposition.
+
+Metrics are module-level objects updated from the hot paths. Each labelled
+child has its own small lock, so updates from different requests never
+contend on a registry-wide lock. When METRICS_MULTIPROCESS_DIR is set every
+worker periodically writes a snapshot file there and the exposition view
+merges the snapshots of all workers, so any worker can be scraped.
+"""
+import bisect
+import contextlib
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class _CounterChild:
+    __slots__ = ('_lock', 'value')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ('_lock', '_upper_bounds', 'counts', 'sum')
+
+    def __init__(self, upper_bounds):
+        self._lock = threading.Lock()
+        self._upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._upper_bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _HistogramTimer(self)
+
+    def snapshot(self):
+        with self._lock:
+            return {'counts': list(self.counts), 'sum': self.sum}
+
+
+class _HistogramTimer:
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.child.observe(time.perf_counter() - self.start)
+        return False
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **kwargs):
+        """Return the child for a label combination, creating it on first use."""
+        if kwargs:
+            values = tuple(str(kwargs[name]) for name in self.labelnames)
+        else:
+            values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+            _ensure_exporter()
+        return child
+
+    def samples(self):
+        return [[list(values), child.snapshot()] for values, child in list(self._children.items())]
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    """A gauge; values are reported per worker process."""
+    type_name = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric {metric.name}")
+        self._metrics[metric.name] = metric
+
+    def collect(self):
+        """Snapshot every metric of this process as plain data."""
+        return {
+            metric.name: {
+                'type': metric.type_name,
+                'help': metric.documentation,
+                'labelnames': list(metric.labelnames),
+                'buckets': list(getattr(metric, 'upper_bounds', ())),
+                'samples': metric.samples(),
+            }
+            for metric in self._metrics.values()
+        }
+
+
+REGISTRY = Registry()
+
+
+# Multiprocess aggregation
+
+_exporter_started = False
+_exporter_lock = threading.Lock()
+
+
+def _multiprocess_dir():
+    return getattr(settings, 'METRICS_MULTIPROCESS_DIR', None)
+
+
+def write_snapshot():
+    """Write this worker's metrics to the shared directory atomically."""
+    directory = _multiprocess_dir()
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as handle:
+        json.dump({'pid': os.getpid(), 'metrics': REGISTRY.collect()}, handle)
+    os.replace(tmp_path, os.path.join(directory, f'metrics-{os.getpid()}.json'))
+
+
+def _export_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_snapshot()
+        except OSError:
+            pass
+
+
+def _ensure_exporter():
+    global _exporter_started
+    if _exporter_started or not _multiprocess_dir():
+        return
+    with _exporter_lock:
+        if _exporter_started:
+            return
+        interval = getattr(settings, 'METRICS_FLUSH_INTERVAL', 5)
+        threading.Thread(target=_export_loop, args=(interval,), name='metrics-exporter', daemon=True).start()
+        _exporter_started = True
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read_snapshots():
+    directory = _multiprocess_dir()
+    snapshots = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.startswith('metrics-'):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as handle:
+                snapshots.append(json.load(handle))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _merge(snapshots):
+    """
+    Merge worker snapshots: counters and histograms are summed, gauges gain a
+    ``worker`` label and are dropped once their process has exited.
+    """
+    merged = {}
+    for snapshot in snapshots:
+        pid = snapshot['pid']
+        alive = _pid_alive(pid)
+        for name, family in snapshot['metrics'].items():
+            target = merged.setdefault(name, dict(family, samples={}))
+            if family['type'] == 'gauge':
+                if not alive:
+                    continue
+                if 'worker' not in target['labelnames']:
+                    target['labelnames'] = family['labelnames'] + ['worker']
+                for values, value in family['samples']:
+                    target['samples'][tuple(values) + (str(pid),)] = value
+                continue
+            for values, value in family['samples']:
+                key = tuple(values)
+                current = target['samples'].get(key)
+                if current is None:
+                    target['samples'][key] = value
+                elif family['type'] == 'histogram':
+                    target['samples'][key] = {
+                        'counts': [a + b for a, b in zip(current['counts'], value['counts'])],
+                        'sum': current['sum'] + value['sum'],
+                    }
+                else:
+                    target['samples'][key] = current + value
+    for family in merged.values():
+        family['samples'] = [[list(key), value] for key, value in family['samples'].items()]
+    return merged
+
+
+def collect():
+    """Return metric families for this process or, in multiprocess mode, all workers."""
+    if not _multiprocess_dir():
+        return REGISTRY.collect()
+    write_snapshot()
+    return _merge(_read_snapshots())
+
+
+# Text exposition
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _label_string(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def render(families):
+    """Render metric families in the Prometheus text format."""
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        names = family['labelnames']
+        for values, value in family['samples']:
+            if family['type'] != 'histogram':
+                lines.append(f"{name}{_label_string(names, values)} {_format_value(value)}")
+                continue
+            cumulative = 0
+            bounds = list(family['buckets']) + [float('inf')]
+            for bound, count in zip(bounds, value['counts']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f"{name}_bucket{_label_string(names, values, [('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{_label_string(names, values)} {_format_value(value['sum'])}")
+            lines.append(f"{name}_count{_label_string(names, values)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """Expose all metrics; protected by METRICS_TOKEN when it is configured."""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token and request.META.get('HTTP_AUTHORIZATION') != f'Bearer {token}':
+        return HttpResponse(status=401)
+    return HttpResponse(render(collect()), content_type=CONTENT_TYPE)
+
+
+# Messaging metrics
+
+MESSAGES_SENT = Counter(
+    'messenger_messages_sent_total',
+    'Messages persisted, by transport.',
+    ['transport']
+)
+ENCRYPTION_SECONDS = Histogram(
+    'messenger_encryption_seconds',
+    'Time to encrypt a message for all participants, by participant count.',
+    ['participants']
+)
+WEBSOCKET_CONNECTIONS = Gauge(
+    'messenger_websocket_connections',
+    'Open WebSocket connections in this worker.'
+)
+GROUP_SEND_SECONDS = Histogram(
+    'messenger_group_send_seconds',
+    'Channel layer group_send latency, by event type.',
+    ['event']
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'messenger_http_request_seconds',
+    'HTTP request latency, by endpoint.',
+    ['endpoint']
+)
+DB_QUERIES = Histogram(
+    'messenger_db_queries_per_request',
+    'Database queries issued per HTTP request, by endpoint.',
+    ['endpoint'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+)
+COMPRESSION_BYTES = Counter(
+    'messenger_compression_bytes_total',
+    'Response body bytes before (in) and after (out) compression, by encoding.',
+    ['encoding', 'side']
+)
+COMPRESSION_SECONDS = Histogram(
+    'messenger_compression_seconds',
+    'CPU time spent compressing one response body, by encoding.',
+    ['encoding'],
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+)
+CACHE_REQUESTS = Counter(
+    'messenger_cache_requests_total',
+    'Cache lookups, by cache and result (hit or miss).',
+    ['cache', 'result']
+)
+
+
+def participant_bucket(count):
+    """Collapse a participant count into a small set of label values."""
+    if count <= 2:
+        return str(count)
+    if count <= 5:
+        return '3-5'
+    if count <= 10:
+        return '6-10'
+    return '11+'
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+class _QueryCounter:
+    __slots__ = ('count',)
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+# The current async request's counter, for queries run on other threads
+_request_counter = contextvars.ContextVar('request_query_counter', default=None)
+
+
+def count_request_queries():
+    """
+    Count queries run on this thread toward the current request. For work
+    an async view hands to a thread pool, whose threads the middleware
+    cannot see; a no-op outside an async request.
+    """
+    counter = _request_counter.get()
+    if counter is None:
+        return contextlib.nullcontext()
+    return MetricsMiddleware.count_queries(counter)
+
+
+class MetricsMiddleware:
+    """Record request latency and query counts per resolved endpoint."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        counter = _QueryCounter()
+        start = time.perf_counter()
+        with self.count_queries(counter):
+            response = self.get_response(request)
+        self.observe(request, start, counter)
+        return response
+
+    async def __acall__(self, request):
+        counter = _QueryCounter()
+        start = time.perf_counter()
+        # Under ASGI a request's database work runs on its own sync thread, so
+        # the wrappers are installed on that thread's connections
+        stack = await sync_to_async(self.count_queries)(counter)
+        token = _request_counter.set(counter)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_counter.reset(token)
+            await sync_to_async(stack.close)()
+        self.observe(request, start, counter)
+        return response
+
+    @staticmethod
+    def count_queries(counter):
+        stack = contextlib.ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(counter))
+        return stack
+
+    def observe(self, request, start, counter):
+        match = getattr(request, 'resolver_match', None)
+        endpoint = match.view_name if match else 'unresolved'
+        HTTP_REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
+        DB_QUERIES.labels(endpoint).observe(counter.count)
@@ -0,0 +1,19 @@
+"""
+Request body parsing for the plain async Django views (users.views and
+chat.async_views), which run without DRF's parsers.
+"""
+import json
+
+
+def request_data(request):
+    """
+    Parse a JSON object or form body, as DRF's default parsers would; None if
+    malformed. A JSON body that is valid but not an object counts as malformed.
+    """
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+    return request.POST
@@ -0,0 +1,172 @@
+"""
+Database routing: message shards, and reads from an optional replica.
+
+Message storage is split across the databases in ``MESSAGE_SHARDS``. Each
+chat session lives on one shard, recorded in ``ChatSession.shard`` and chosen
+when the session is created by a consistent hash of its id; the message,
+wrapped key, archive segment and change counter tables of that shard hold
+its rows. ``ShardRouter`` sends queries that carry a session or a sharded row
+as a hint to the right shard, and ``for_session()`` on the sharded models'
+querysets does the same for filtered queries. Everything else lives on
+``default``, which is also the first shard.
+
+Reads go to the ``replica`` alias only inside ``replica_reads()`` (or a view
+decorated with ``reads_from_replica``) and only when that alias is
+configured; everything else, including every write, uses ``default``. Views
+opt in explicitly because a replica lags the primary: only read-only history
+and list endpoints, where a few seconds of staleness is harmless, use it.
+The replica copies the default database, so it also serves the first shard.
+"""
+import contextlib
+import contextvars
+import functools
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS
+
+REPLICA_ALIAS = 'replica'
+
+# Tables stored per shard, as model labels
+SHARDED_MODELS = {'chat.message', 'chat.messagekey', 'chat.archivedsegment', 'chat.changecounter'}
+
+# With several shards, message ids are allocated as ``n * SHARD_ID_STRIDE +
+# shard index``, so ids stay unique when sessions move between shards; this
+# caps the shard count. A single shard allocates consecutive ids.
+SHARD_ID_STRIDE = 16
+
+_replica_reads = contextvars.ContextVar('replica_reads', default=False)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def replica_configured():
+    return REPLICA_ALIAS in settings.DATABASES
+
+
+def message_shards():
+    """Return the database aliases holding messages; the first is ``default``."""
+    return getattr(settings, 'MESSAGE_SHARDS', [DEFAULT_DB_ALIAS])
+
+
+def id_stride():
+    """Return the step between the message ids a shard allocates."""
+    return SHARD_ID_STRIDE if len(message_shards()) > 1 else 1
+
+
+def shard_index(alias):
+    """Return a shard's position in MESSAGE_SHARDS, which is part of its message ids."""
+    return message_shards().index(alias)
+
+
+def jump_hash(key, buckets):
+    """
+    Jump consistent hash (Lamping and Veach): map an integer key to one of
+    ``buckets`` so that growing the bucket count moves only 1/n of the keys.
+    """
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def home_shard(chat_session_id):
+    """Return the shard a chat session is placed on under the current shard list."""
+    shards = message_shards()
+    return shards[jump_hash(int(chat_session_id), len(shards))]
+
+
+def read_alias(alias):
+    """Return the alias to read a shard from: the replica for ``default`` inside replica_reads()."""
+    if alias == DEFAULT_DB_ALIAS and _replica_reads.get() and replica_configured():
+        return REPLICA_ALIAS
+    return alias
+
+
+@contextlib.contextmanager
+def replica_reads():
+    """Send reads in the enclosed block to the replica, if there is one."""
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def reads_from_replica(view_method):
+    """Serve safe-method requests of a view method from the replica."""
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        if request.method not in SAFE_METHODS:
+            return view_method(self, request, *args, **kwargs)
+        with replica_reads():
+            return view_method(self, request, *args, **kwargs)
+
+    return wrapper
+
+
+def is_sharded(model):
+    return model._meta.label_lower in SHARDED_MODELS
+
+
+class ShardRouter:
+    def __init__(self):
+        if len(message_shards()) > SHARD_ID_STRIDE:
+            raise ImproperlyConfigured(f'At most {SHARD_ID_STRIDE} message shards are supported')
+
+    def _shard_for(self, hints):
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if instance._meta.label_lower == 'chat.chatsession':
+            return instance.shard or DEFAULT_DB_ALIAS
+        if not is_sharded(type(instance)):
+            return None
+        if instance._state.db:
+            # A row read from a shard, or bound to one by assigning its session
+            return DEFAULT_DB_ALIAS if instance._state.db == REPLICA_ALIAS else instance._state.db
+        chat_session_id = getattr(instance, 'chat_session_id', None)
+        if chat_session_id is None:
+            return None
+        from chat.models import ChatSession
+        return ChatSession.shard_of(chat_session_id)
+
+    def db_for_read(self, model, **hints):
+        if not is_sharded(model):
+            return None
+        alias = self._shard_for(hints)
+        return read_alias(alias) if alias else None
+
+    def db_for_write(self, model, **hints):
+        if not is_sharded(model):
+            return None
+        return self._shard_for(hints)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Extra shards only carry the sharded tables
+        if db != DEFAULT_DB_ALIAS and db in message_shards():
+            return model_name is not None and f'{app_label}.{model_name}' in SHARDED_MODELS
+        return None
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get() and replica_configured():
+            return REPLICA_ALIAS
+        # Without this Django would follow a hinted row onto its shard
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica is a copy of the primary, so rows from either relate
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica gets its schema from sync_replica, never from migrate
+        if db == REPLICA_ALIAS:
+            return False
+        return None
@@ -14,6 +14,8 @@ from pathlib import Path
 import os
 from dotenv import load_dotenv
 
+from .db_profile import sqlite_database, sqlite_replica
+
 # Load environment variables
 load_dotenv()
 
@@ -56,6 +58,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'secure_messenger.instrumentation.ServerTimingMiddleware',  # No-op unless SERVER_TIMING_ENABLED
+    'secure_messenger.compression.CompressionMiddleware',  # No-op unless COMPRESSION_ENABLED
     'corsheaders.middleware.CorsMiddleware',  # Add this at the top of MIDDLEWARE
     'django.middleware.common.CommonMiddleware',
     'django.middleware.security.SecurityMiddleware',
@@ -64,8 +68,75 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'secure_messenger.metrics.MetricsMiddleware',
+    'users.activity.ActivityMiddleware',
 ]
 
+# Request instrumentation
+# Per-phase timings are collected and sent as a Server-Timing header only when enabled
+SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'False') == 'True'
+# Fraction of hot-path debug log lines (per message sent/decrypted) that are emitted
+HOT_PATH_LOG_SAMPLE_RATE = float(os.getenv('HOT_PATH_LOG_SAMPLE_RATE', '0.01'))
+
+# Response compression, see secure_messenger/compression.py: JSON responses of
+# at least COMPRESSION_MIN_SIZE bytes and streamed ones are compressed with the
+# first of COMPRESSION_ENCODINGS the client accepts (zstd and br only when the
+# zstandard or brotli package is installed). Paths under the excluded prefixes,
+# which return credentials, are never compressed
+COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_ENCODINGS = os.getenv('COMPRESSION_ENCODINGS', 'zstd,br,gzip').split(',')
+COMPRESSION_EXCLUDE_PATHS = ['/api/auth/']
+# Offer permessage-deflate on WebSockets served by the serve command
+WEBSOCKET_COMPRESSION = os.getenv('WEBSOCKET_COMPRESSION', 'true').lower() in ('1', 'true', 'yes')
+
+# Metrics exposition (served at /metrics)
+# Optional bearer token required to scrape the endpoint
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# With several worker processes, point this at a shared directory so each worker
+# writes periodic snapshots there and any worker can serve the merged metrics
+METRICS_MULTIPROCESS_DIR = os.getenv('METRICS_MULTIPROCESS_DIR') or None
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+
+# Read receipts: buffered read positions are written at most once per
+# participant per flush interval; WebSocket receipts are batched per session
+READ_RECEIPT_FLUSH_INTERVAL = float(os.getenv('READ_RECEIPT_FLUSH_INTERVAL', '2'))
+READ_RECEIPT_FANOUT_INTERVAL = float(os.getenv('READ_RECEIPT_FANOUT_INTERVAL', '0.5'))
+
+# Messages older than this are moved to compressed archive segments by the
+# archive_messages command
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv('MESSAGE_ARCHIVE_AFTER_DAYS', '90'))
+
+# Retention periods used by the purge_* maintenance commands
+PARTICIPANT_RETENTION_DAYS = int(os.getenv('PARTICIPANT_RETENTION_DAYS', '30'))
+SESSION_RETENTION_DAYS = int(os.getenv('SESSION_RETENTION_DAYS', '180'))
+USER_SESSION_INACTIVE_RETENTION_DAYS = int(os.getenv('USER_SESSION_INACTIVE_RETENTION_DAYS', '7'))
+USER_SESSION_STALE_DAYS = int(os.getenv('USER_SESSION_STALE_DAYS', '90'))
+
+# Token authentication cache, see users/authentication.py. Set
+# AUTH_TOKEN_CACHE_SHARED to a CACHES alias every worker shares to make
+# logouts and deactivations take effect across processes immediately
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_CACHE_SIZE', '10000'))
+AUTH_TOKEN_CACHE_TTL = float(os.getenv('AUTH_TOKEN_CACHE_TTL', '60'))
+AUTH_TOKEN_CACHE_SHARED = os.getenv('AUTH_TOKEN_CACHE_SHARED')
+
+# User session activity, see users/activity.py: last-seen times are buffered
+# and written once per flush interval, and only when they moved by more than
+# the granularity (both in seconds)
+USER_ACTIVITY_FLUSH_INTERVAL = float(os.getenv('USER_ACTIVITY_FLUSH_INTERVAL', '30'))
+USER_ACTIVITY_GRANULARITY = float(os.getenv('USER_ACTIVITY_GRANULARITY', '60'))
+
+# Async chat endpoints, see chat/async_views.py: whether they replace the
+# sync session list and history/send actions, and the threads they hand
+# database work and message encryption to
+ASYNC_CHAT_VIEWS = os.getenv('ASYNC_CHAT_VIEWS', 'true').lower() in ('1', 'true', 'yes')
+ASYNC_DB_WORKERS = int(os.getenv('ASYNC_DB_WORKERS', '8'))
+ASYNC_CRYPTO_WORKERS = int(os.getenv('ASYNC_CRYPTO_WORKERS', str(os.cpu_count() or 1)))
+
+# Username search, see users/search.py: seconds before the in-memory index is
+# rebuilt to pick up users changed by other processes
+USERNAME_INDEX_MAX_AGE = float(os.getenv('USERNAME_INDEX_MAX_AGE', '300'))
+
 # CORS settings
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",  # React development server
@@ -94,6 +165,12 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'x-session-id',
+]
+
+CORS_EXPOSE_HEADERS = [
+    'etag',
+    'server-timing',
 ]
 
 ROOT_URLCONF = 'secure_messenger.urls'
@@ -127,13 +204,69 @@ CHANNEL_LAYERS = {
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# Tuned SQLite profile (WAL, busy timeout, persistent connections), see
+# secure_messenger/db_profile.py; set DATABASE_TUNING=False for stock SQLite
+DATABASE_TUNING = os.getenv('DATABASE_TUNING', 'True') == 'True'
+DATABASE_CONN_MAX_AGE = int(os.getenv('DATABASE_CONN_MAX_AGE', '60'))
+
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    'default': sqlite_database(
+        BASE_DIR / 'db.sqlite3',
+        tuned=DATABASE_TUNING,
+        conn_max_age=DATABASE_CONN_MAX_AGE
+    ),
 }
 
+# Optional read replica for history and list endpoints: a second SQLite file
+# refreshed from the primary by the sync_replica command
+DATABASE_REPLICA_PATH = os.getenv('DATABASE_REPLICA_PATH')
+if DATABASE_REPLICA_PATH:
+    DATABASES['replica'] = sqlite_replica(
+        DATABASE_REPLICA_PATH,
+        tuned=DATABASE_TUNING,
+        conn_max_age=DATABASE_CONN_MAX_AGE
+    )
+
+# Message shards, see secure_messenger/routers.py: DATABASE_SHARDS SQLite
+# files including the default one, each with its own write lock. Migrate every
+# shard (manage.py migrate --database shard_N) and run rebalance_shards after
+# changing the count. Only ever append shards: a shard's position is part of
+# the message ids it allocates. A single shard allocates consecutive ids; with
+# more, ids step by 16, so new ids jump once when the first shard is added.
+DATABASE_SHARDS = int(os.getenv('DATABASE_SHARDS', '1'))
+DATABASE_SHARD_DIR = Path(os.getenv('DATABASE_SHARD_DIR', BASE_DIR))
+MESSAGE_SHARDS = ['default']
+for shard_number in range(1, DATABASE_SHARDS):
+    DATABASES[f'shard_{shard_number}'] = sqlite_database(
+        DATABASE_SHARD_DIR / f'db_shard_{shard_number}.sqlite3',
+        tuned=DATABASE_TUNING,
+        conn_max_age=DATABASE_CONN_MAX_AGE
+    )
+    MESSAGE_SHARDS.append(f'shard_{shard_number}')
+
+DATABASE_ROUTERS = [
+    'secure_messenger.routers.ShardRouter',
+    'secure_messenger.routers.ReplicaRouter',
+]
+
+
+# Password hashing, see users/hashers.py. New passwords use Argon2id with the
+# cost below; older hashes keep verifying and are upgraded on the next login.
+# One lane per hash, so AUTH_HASH_WORKERS bounds the cores spent hashing
+PASSWORD_HASHERS = [
+    'users.hashers.TunedArgon2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+ARGON2_TIME_COST = int(os.getenv('ARGON2_TIME_COST', '2'))
+ARGON2_MEMORY_COST = int(os.getenv('ARGON2_MEMORY_COST', '102400'))  # KiB
+ARGON2_PARALLELISM = int(os.getenv('ARGON2_PARALLELISM', '1'))
+# Threads that hash passwords and generate key pairs for login and register,
+# and how many such jobs may run or wait before new ones get a 503
+AUTH_HASH_WORKERS = int(os.getenv('AUTH_HASH_WORKERS', '2'))
+AUTH_HASH_QUEUE_LIMIT = int(os.getenv('AUTH_HASH_QUEUE_LIMIT', '64'))
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -156,7 +289,7 @@ AUTH_PASSWORD_VALIDATORS = [
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'users.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
@@ -14,19 +14,33 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import RedirectView
 from rest_framework.routers import DefaultRouter
-from chat.views import ChatSessionViewSet, MessageViewSet
+from chat.async_views import session_list_view, session_messages_view
+from chat.views import ChatSessionViewSet, MessageViewSet, SyncViewSet
+from secure_messenger.metrics import metrics_view
+from users.views import KeyDirectoryViewSet, UserSearchViewSet
 
 # Create a router and register our viewsets
 router = DefaultRouter()
 router.register(r'chats', ChatSessionViewSet, basename='chat')
 router.register(r'messages', MessageViewSet, basename='message')
+router.register(r'sync', SyncViewSet, basename='sync')
+router.register(r'keys', KeyDirectoryViewSet, basename='key')
+router.register(r'users/search', UserSearchViewSet, basename='user-search')
 
 # API URLs
-api_urlpatterns = [
+api_urlpatterns = []
+if settings.ASYNC_CHAT_VIEWS:
+    # Async stand-ins for the hot ChatSessionViewSet actions, see chat/async_views.py
+    api_urlpatterns += [
+        path('chats/', session_list_view, name='chat-list'),
+        path('chats/<int:pk>/messages/', session_messages_view, name='chat-messages'),
+    ]
+api_urlpatterns += [
     path('', include(router.urls)),
     path('auth/', include('users.urls')),  # Auth URLs
 ]
@@ -38,6 +52,9 @@ urlpatterns = [
     # API endpoints
     path('api/', include((api_urlpatterns, 'api'))),
     
+    # Prometheus metrics
+    path('metrics', metrics_view, name='metrics'),
+    
     # Redirect root URL to API root
     path('', RedirectView.as_view(url='/api/', permanent=False)),
 ]
@@ -0,0 +1,171 @@
+"""
+Coalesced tracking of when user sessions were last active.
+
+Clients identify their login session with the ``X-Session-ID`` header (the
+``session_id`` returned by login and register). ``ActivityMiddleware`` hands
+every authenticated request to ``ActivityTracker``, which keeps the newest
+timestamp per session in memory and a background thread writes them all in
+one UPDATE per USER_ACTIVITY_FLUSH_INTERVAL. A session seen again within
+USER_ACTIVITY_GRANULARITY of its last recorded time is not buffered at all,
+so steady traffic costs one write per session per granularity window instead
+of one per request.
+"""
+import atexit
+import functools
+import logging
+import operator
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from cachetools import TTLCache
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+
+from .models import UserSession
+
+logger = logging.getLogger(__name__)
+
+SESSION_HEADER = 'HTTP_X_SESSION_ID'
+# Sessions per UPDATE, so the OR stays well within SQLite's expression depth limit
+FLUSH_BATCH_SIZE = 100
+# Sessions remembered as recently recorded
+RECENT_SESSIONS = 100000
+
+
+def flush_interval():
+    return getattr(settings, 'USER_ACTIVITY_FLUSH_INTERVAL', 30.0)
+
+
+def granularity():
+    return getattr(settings, 'USER_ACTIVITY_GRANULARITY', 60.0)
+
+
+class ActivityTracker:
+    """Buffers last-seen times per user session and writes them in bulk."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        # Sessions recorded within the granularity window; expiry re-arms them
+        self._recent = TTLCache(RECENT_SESSIONS, granularity())
+        self._flusher_started = False
+        self.writes = 0
+
+    def touch(self, session_id, user_id, seen_at=None):
+        """
+        Record activity on a user session. Returns True if the time was
+        buffered, False if the session was recorded too recently to matter.
+        """
+        key = (session_id, user_id)
+        with self._lock:
+            if key in self._recent:
+                return False
+            self._recent[key] = True
+            self._pending[key] = seen_at or timezone.now()
+        self._ensure_flusher()
+        return True
+
+    def forget(self, session_id, user_id):
+        """Drop buffered activity, e.g. when the session is logged out."""
+        with self._lock:
+            self._pending.pop((session_id, user_id), None)
+            self._recent.pop((session_id, user_id), None)
+
+    def flush(self):
+        """Write every buffered time; returns the number of sessions updated."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        items = list(pending.items())
+        updated = 0
+        for start in range(0, len(items), FLUSH_BATCH_SIZE):
+            batch = items[start:start + FLUSH_BATCH_SIZE]
+            # The user must match so a client can only touch its own sessions,
+            # and the guard keeps a stale flush from moving a time backwards
+            newer = functools.reduce(operator.or_, (
+                Q(session_id=session_id, user_id=user_id, last_active__lt=seen_at)
+                for (session_id, user_id), seen_at in batch
+            ))
+            updated += UserSession.objects.filter(newer, is_active=True).update(last_active=Case(
+                *(
+                    When(session_id=session_id, user_id=user_id, then=Value(seen_at))
+                    for (session_id, user_id), seen_at in batch
+                ),
+                default=F('last_active')
+            ))
+        self.writes += updated
+        return updated
+
+    def _ensure_flusher(self):
+        if self._flusher_started:
+            return
+        with self._lock:
+            if self._flusher_started:
+                return
+            threading.Thread(target=self._flush_loop, name='user-activity-flusher', daemon=True).start()
+            atexit.register(self.flush)
+            self._flusher_started = True
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(flush_interval())
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to flush user session activity")
+            finally:
+                close_old_connections()
+
+
+class ActivityMiddleware:
+    """Reports authenticated requests that carry ``X-Session-ID`` to the tracker."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.get_response(request)
+        self.record(request)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if request.META.get(SESSION_HEADER):
+            # request.user may still be lazy, and loading it touches the database
+            await sync_to_async(self.record)(request)
+        return response
+
+    def record(self, request):
+        session_id = request.META.get(SESSION_HEADER)
+        # DRF copies the user it authenticated onto the Django request
+        user = getattr(request, 'user', None)
+        if session_id and user is not None and user.is_authenticated:
+            tracker.touch(session_id, user.id)
+
+
+def active_sessions(within=None):
+    """
+    Sessions that are logged in and were seen within ``within`` (a timedelta),
+    newest first; a range scan of the (is_active, last_active) index. The
+    default allows for how far behind the tracker may leave a busy session.
+    """
+    if within is None:
+        within = timedelta(seconds=granularity() + flush_interval())
+    # is_active=True would compile to a bare column test, which SQLite
+    # cannot match to the index; IN (1) is an equality it can use
+    return UserSession.objects.filter(
+        is_active__in=[True],
+        last_active__gte=timezone.now() - within
+    ).order_by('-last_active')
+
+
+tracker = ActivityTracker()
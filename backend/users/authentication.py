@@ -0,0 +1,130 @@
+"""
+Token authentication backed by a bounded in-process cache.
+
+DRF's ``TokenAuthentication`` loads the token joined to its user on every
+request. ``CachedTokenAuthentication`` keeps recently used tokens in a TTL
+cache, so a client making many calls costs one dictionary lookup per request
+instead of a query. Entries are evicted as soon as the token is deleted (as
+``AuthViewSet.logout`` does) or its user is saved, which covers deactivation;
+the model signals that do this are connected in users/models.py.
+
+Each worker process has its own cache. If ``AUTH_TOKEN_CACHE_SHARED`` names a
+cache alias that all workers share, evictions also stamp the token there and
+a hit is only trusted while its stamp is unchanged, so a logout or
+deactivation in any process takes effect everywhere at once. Only hashed
+token stamps go to the shared cache; users and their keys stay in-process.
+Without it, other processes drop the entry within ``AUTH_TOKEN_CACHE_TTL``.
+"""
+import copy
+import hashlib
+import threading
+import time
+
+from cachetools import TTLCache
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.authentication import TokenAuthentication
+
+from secure_messenger.metrics import record_cache
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 60  # Seconds
+
+
+class _TokenCache:
+    """A thread-safe TTL cache of authenticated tokens keyed by token key."""
+
+    def __init__(self, maxsize, ttl, shared_alias=None):
+        self.ttl = ttl
+        self.shared_alias = shared_alias
+        self._lock = threading.Lock()
+        self._entries = TTLCache(maxsize, ttl)
+
+    def _stamp_key(self, key):
+        return 'auth-token-stamp:' + hashlib.sha256(key.encode()).hexdigest()
+
+    def stamp(self, key):
+        """Return the token's current invalidation stamp, or None without a shared cache."""
+        if not self.shared_alias:
+            return None
+        return caches[self.shared_alias].get(self._stamp_key(key))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        token, stamp = entry
+        if self.shared_alias and self.stamp(key) != stamp:
+            # Invalidated by another process
+            self.discard([key])
+            return None
+        return token
+
+    def set(self, key, token, stamp):
+        with self._lock:
+            self._entries[key] = (token, stamp)
+
+    def discard(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def invalidate(self, keys=(), user_id=None):
+        """Drop the given tokens and every cached token of ``user_id``, here and in other processes."""
+        keys = set(keys)
+        if user_id is not None:
+            with self._lock:
+                keys.update(key for key, (token, _) in self._entries.items() if token.user_id == user_id)
+        self.discard(keys)
+        if self.shared_alias and keys:
+            # Stamps only need to outlive entries cached before them
+            caches[self.shared_alias].set_many(
+                {self._stamp_key(key): time.time_ns() for key in keys}, timeout=self.ttl + 1
+            )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = _TokenCache(
+    getattr(settings, 'AUTH_TOKEN_CACHE_SIZE', DEFAULT_CACHE_SIZE),
+    getattr(settings, 'AUTH_TOKEN_CACHE_TTL', DEFAULT_CACHE_TTL),
+    getattr(settings, 'AUTH_TOKEN_CACHE_SHARED', None)
+)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """``TokenAuthentication`` that resolves tokens through ``token_cache``."""
+
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        record_cache('auth_token', token is not None)
+        if token is None:
+            # Read the stamp first so an invalidation racing the lookup is noticed on the next hit
+            stamp = token_cache.stamp(key)
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, token, stamp)
+        return self._copies(token)
+
+    def cached_credentials(self, key):
+        """
+        ``authenticate_credentials`` for a token that can be resolved without
+        any I/O, else None; async views call it on the event loop. With a
+        shared cache every hit reads a stamp, so nothing qualifies.
+        """
+        if token_cache.shared_alias:
+            return None
+        token = token_cache.get(key)
+        if token is None:
+            return None
+        record_cache('auth_token', True)
+        return self._copies(token)
+
+    @staticmethod
+    def _copies(token):
+        # Each request gets its own copies, so views can modify request.user freely
+        token = copy.copy(token)
+        token.user = copy.copy(token.user)
+        return token.user, token
@@ -0,0 +1,81 @@
+"""
+Password hashing for the auth endpoints.
+
+``TunedArgon2PasswordHasher`` is Django's Argon2 hasher with its cost taken
+from settings (ARGON2_TIME_COST, ARGON2_MEMORY_COST, ARGON2_PARALLELISM).
+Hashes made with other parameters, or by the PBKDF2 hasher that used to be
+the default, still verify and are rehashed with the configured cost on the
+next successful login.
+
+``hashing_pool`` runs hashing and key generation for the async login and
+register views off the event loop, on at most AUTH_HASH_WORKERS threads;
+argon2 and OpenSSL release the GIL while they work. At most
+AUTH_HASH_QUEUE_LIMIT jobs may be running or waiting; beyond that
+``run`` raises ``HashingOverloaded`` at once, so a login storm is turned
+away with a 503 instead of queueing up and starving the chat endpoints.
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import Argon2PasswordHasher, check_password, make_password
+
+
+class TunedArgon2PasswordHasher(Argon2PasswordHasher):
+    """Argon2id with the cost configured in settings."""
+    time_cost = getattr(settings, 'ARGON2_TIME_COST', Argon2PasswordHasher.time_cost)
+    memory_cost = getattr(settings, 'ARGON2_MEMORY_COST', Argon2PasswordHasher.memory_cost)  # KiB
+    parallelism = getattr(settings, 'ARGON2_PARALLELISM', Argon2PasswordHasher.parallelism)
+
+
+def verify_password(password, encoded):
+    """
+    Check a password against its stored hash. Returns ``(correct, rehashed)``;
+    ``rehashed`` is a new hash with the current hasher and cost when the stored
+    one is outdated, else None. Both steps are CPU-bound; run them on the pool.
+    """
+    rehashed = []
+    correct = check_password(password, encoded, setter=lambda raw: rehashed.append(make_password(raw)))
+    return correct, (rehashed[0] if rehashed else None)
+
+
+class HashingOverloaded(Exception):
+    """Raised when too many hashing jobs are already running or queued."""
+
+
+class HashingPool:
+    """A bounded thread pool for CPU-heavy auth work, with a cap on queued jobs."""
+
+    def __init__(self, workers, queue_limit):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._lock = threading.Lock()
+        self._executor = None
+        self.in_flight = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='auth-hashing')
+            return self._executor
+
+    async def run(self, fn, *args, **kwargs):
+        """Run ``fn`` on the pool; raises HashingOverloaded if the queue is full."""
+        with self._lock:
+            if self.in_flight >= self.queue_limit:
+                raise HashingOverloaded()
+            self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), functools.partial(fn, *args, **kwargs))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+hashing_pool = HashingPool(
+    getattr(settings, 'AUTH_HASH_WORKERS', 2),
+    getattr(settings, 'AUTH_HASH_QUEUE_LIMIT', 64)
+)
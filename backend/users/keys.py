@@ -0,0 +1,126 @@
+"""
+Public-key directory.
+
+Clients that encrypt for or verify other users only need their public keys.
+``key_directory`` returns them for a set of users, each with a short
+fingerprint (see encryption.utils.public_key_fingerprint) that doubles as
+the key's ETag. ``key_updated_at`` lets a client ask only for the keys that
+changed since its last sync, so a local key cache stays warm incrementally.
+
+The directory query reads only ids, usernames, fingerprints and timestamps;
+the PEM bodies come from ``key_cache``, an LRU keyed by fingerprint. A
+fingerprint names one exact key, so entries never go stale and need no
+invalidation: a changed key simply has a new fingerprint.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from secure_messenger.metrics import record_cache
+
+from .models import CustomUser
+
+# Usernames accepted in one directory request
+MAX_USERNAMES = 500
+KEY_CACHE_SIZE = 10000
+
+
+def key_etag(fingerprint):
+    # Strong: a fingerprint identifies the exact key bytes
+    return f'"{fingerprint}"'
+
+
+def directory_etag(entries, missing=()):
+    """A validator for a whole directory response."""
+    digest = hashlib.sha256()
+    for entry in entries:
+        digest.update(f"{entry['username']}:{entry['fingerprint']}\n".encode('utf-8'))
+    for username in missing:
+        digest.update(f"{username}:\n".encode('utf-8'))
+    return f'W/"keys-{digest.hexdigest()[:32]}"'
+
+
+def if_none_match_tags(request):
+    """The opaque tags listed in a request's If-None-Match header, weak or strong."""
+    header = request.META.get('HTTP_IF_NONE_MATCH', '')
+    tags = set()
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate:
+            tags.add(candidate)
+    return tags
+
+
+class _PublicKeyCache:
+    """A small thread-safe LRU of PEM public keys keyed by fingerprint."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get_many(self, rows):
+        """
+        Return ``{fingerprint: pem}`` for ``(user id, fingerprint)`` pairs,
+        loading any misses with one primary key query.
+        """
+        found = {}
+        missing = {}
+        with self._lock:
+            for user_id, fingerprint in rows:
+                pem = self._entries.get(fingerprint)
+                if pem is None:
+                    missing[fingerprint] = user_id
+                else:
+                    self._entries.move_to_end(fingerprint)
+                    found[fingerprint] = pem
+        for fingerprint in found:
+            record_cache('public_key', True)
+        if missing:
+            loaded = CustomUser.objects.filter(id__in=missing.values()).values_list('key_fingerprint', 'public_key')
+            with self._lock:
+                for fingerprint, pem in loaded:
+                    # Skip a key that changed since the directory query; its new
+                    # fingerprint is not the one asked for
+                    if fingerprint in missing:
+                        record_cache('public_key', False)
+                        found[fingerprint] = pem
+                        self._entries[fingerprint] = pem
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return found
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+key_cache = _PublicKeyCache(KEY_CACHE_SIZE)
+
+
+def key_directory(users, changed_since=None):
+    """
+    Return directory entries, ordered by username, for the users in the
+    ``users`` queryset that have a public key, optionally only those whose
+    key changed at or after ``changed_since``.
+    """
+    if changed_since is not None:
+        users = users.filter(key_updated_at__gte=changed_since)
+    rows = list(users.exclude(key_fingerprint='').order_by('username').values_list(
+        'id', 'username', 'key_fingerprint', 'key_updated_at'
+    ))
+    keys = key_cache.get_many((user_id, fingerprint) for user_id, _, fingerprint, _ in rows)
+    return [
+        {
+            'username': username,
+            'fingerprint': fingerprint,
+            'etag': key_etag(fingerprint),
+            'updated_at': updated_at,
+            'public_key': keys[fingerprint],
+        }
+        for _, username, fingerprint, updated_at in rows
+        # A key replaced mid-request is picked up on the next sync
+        if fingerprint in keys
+    ]
@@ -0,0 +1,58 @@
+import hashlib
+import itertools
+import os
+
+from django.core.management.base import CommandError
+
+from chat.maintenance import BatchJobCommand
+from users.provisioning import UserProvisioner, read_records
+
+
+class Command(BatchJobCommand):
+    help = ('Create users in bulk from a CSV file with a header row or an NDJSON file, with the fields '
+            'username, password, email, first_name and last_name. Key pairs are generated and passwords '
+            'hashed on a process pool; an interrupted run resumes after the last committed batch.')
+    # Provisioning commits its own transaction once a batch is prepared
+    atomic_steps = False
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.set_defaults(pause=0.0)
+        parser.add_argument('path', help='CSV or NDJSON file of users')
+        parser.add_argument('--format', choices=['csv', 'ndjson'],
+                            help='Input format; by default taken from the file extension')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Processes generating key pairs and hashing passwords')
+
+    def handle(self, *args, **options):
+        path = os.path.abspath(options['path'])
+        input_format = options['format'] or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+        try:
+            lines = open(path, encoding='utf-8', newline='')
+        except OSError as e:
+            raise CommandError(str(e))
+
+        # One checkpoint per input file
+        self.job_name = f"provision_users:{hashlib.sha256(path.encode('utf-8')).hexdigest()[:16]}"
+        job = self.create_job(options)
+        batch_size = options['batch_size']
+
+        with lines, UserProvisioner(options['workers'], stderr=self.stderr) as provisioner:
+            # The position counts input records, so a resumed run skips the
+            # ones already handled; re-handling a batch would only skip its users
+            records = itertools.islice(read_records(lines, input_format), job.checkpoint.position, None)
+
+            def step(checkpoint):
+                batch = list(itertools.islice(records, batch_size))
+                if not batch:
+                    return None
+                created = provisioner.provision(batch)
+                checkpoint.position += len(batch)
+                return created
+
+            job.run(step)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {provisioner.created} users; skipped {provisioner.taken} with a taken username or email "
+            f"and {provisioner.invalid} invalid records"
+        ))
@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+
+from chat.maintenance import BatchJobCommand, delete_batch
+from users.models import UserSession
+
+
+class Command(BatchJobCommand):
+    help = 'Delete logged-out user sessions and sessions that have been idle past the retention period.'
+    job_name = 'purge_user_sessions'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--inactive-days', type=int,
+                            default=getattr(settings, 'USER_SESSION_INACTIVE_RETENTION_DAYS', 7),
+                            help='Keep logged-out sessions this long')
+        parser.add_argument('--stale-days', type=int,
+                            default=getattr(settings, 'USER_SESSION_STALE_DAYS', 90),
+                            help='Delete sessions not seen for this long even if never logged out')
+
+    def handle(self, *args, **options):
+        job = self.create_job(options)
+        as_of = job.as_of()
+        # Both branches are ranges on the (is_active, last_active) index; __in
+        # because a plain boolean filter compiles to a column test SQLite
+        # cannot match to the index
+        expired = UserSession.objects.filter(
+            Q(is_active__in=[False], last_active__lt=as_of - timedelta(days=options['inactive_days'])) |
+            Q(is_active__in=[True], last_active__lt=as_of - timedelta(days=options['stale_days']))
+        )
+
+        def step(checkpoint):
+            return delete_batch(expired, options['batch_size']) or None
+
+        job.run(step)
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-19 14:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_customuser_private_key'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='usersession',
+            index=models.Index(fields=['is_active', 'last_active'], name='user_session_active_seen'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-19 15:01
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_user_session_activity_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='usersession',
+            name='last_active',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 4.2.7 on 2026-10-19 15:10
+
+import base64
+import binascii
+import hashlib
+
+from django.db import migrations, models, transaction
+import django.utils.timezone
+
+CHUNK_SIZE = 1000
+
+
+def _fingerprint(public_key_pem):
+    # Frozen copy of encryption.utils.public_key_fingerprint
+    if not public_key_pem:
+        return ''
+    body = ''.join(line for line in public_key_pem.strip().splitlines() if not line.startswith('-----'))
+    try:
+        data = base64.b64decode(body, validate=True)
+    except (binascii.Error, ValueError):
+        data = public_key_pem.strip().encode('utf-8')
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def backfill_key_fingerprints(apps, schema_editor):
+    """Fingerprint existing keys and date them from when the user joined, one chunk per transaction."""
+    User = apps.get_model('users', 'CustomUser')
+    db_alias = schema_editor.connection.alias
+
+    last_id = 0
+    while True:
+        with transaction.atomic(using=db_alias):
+            users = list(
+                User.objects.using(db_alias)
+                .filter(id__gt=last_id)
+                .order_by('id')
+                .only('id', 'public_key', 'date_joined')[:CHUNK_SIZE]
+            )
+            if not users:
+                break
+            for user in users:
+                user.key_fingerprint = _fingerprint(user.public_key)
+                user.key_updated_at = user.date_joined
+            User.objects.using(db_alias).bulk_update(users, ['key_fingerprint', 'key_updated_at'])
+            last_id = users[-1].id
+
+
+class Migration(migrations.Migration):
+
+    # Each chunk commits on its own so the write lock is never held for long
+    atomic = False
+
+    dependencies = [
+        ('users', '0004_user_session_coalesced_activity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='key_fingerprint',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='key_updated_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.RunPython(backfill_key_fingerprints, migrations.RunPython.noop),
+    ]
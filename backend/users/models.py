@@ -1,7 +1,16 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from encryption.utils import public_key_fingerprint
+
+from .authentication import token_cache
+from .search import username_index
 
 
 class CustomUserManager(BaseUserManager):
@@ -38,9 +47,39 @@ class CustomUser(AbstractUser):
     is_staff = models.BooleanField(default=False)
     date_joined = models.DateTimeField(default=timezone.now)
     last_login = models.DateTimeField(blank=True, null=True)
+    # Maintained by save() for the key directory, see users/keys.py
+    key_fingerprint = models.CharField(max_length=32, blank=True, editable=False)
+    key_updated_at = models.DateTimeField(default=timezone.now, db_index=True, editable=False)
 
     objects = CustomUserManager()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored key and username, if loaded, so save() and the
+        # username index can tell when they change
+        instance._stored_public_key = instance.__dict__.get('public_key')
+        instance._stored_username = instance.__dict__.get('username')
+        return instance
+
+    def save(self, *args, **kwargs):
+        stored = getattr(self, '_stored_public_key', None)
+        update_fields = kwargs.get('update_fields')
+        key_loaded = 'public_key' in self.__dict__
+        key_saved = key_loaded and (update_fields is None or 'public_key' in update_fields)
+        if key_saved and (stored is None or self.public_key != stored):
+            fingerprint = public_key_fingerprint(self.public_key)
+            if fingerprint != self.key_fingerprint:
+                self.key_fingerprint = fingerprint
+                self.key_updated_at = timezone.now()
+                if update_fields is not None:
+                    kwargs['update_fields'] = {*update_fields, 'key_fingerprint', 'key_updated_at'}
+        super().save(*args, **kwargs)
+        if key_loaded:
+            self._stored_public_key = self.public_key
+        if 'username' in self.__dict__ and (update_fields is None or 'username' in update_fields):
+            self._stored_username = self.username
+
     USERNAME_FIELD = 'username'
     REQUIRED_FIELDS = []
 
@@ -55,11 +94,54 @@ class UserSession(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='sessions')
     session_id = models.CharField(max_length=100, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    last_active = models.DateTimeField(auto_now=True)
+    # Maintained in bulk by users.activity rather than on every save
+    last_active = models.DateTimeField(default=timezone.now)
     is_active = models.BooleanField(default=True)
 
     def __str__(self):
         return f"{self.user.username} - {self.session_id}"
 
     class Meta:
-        db_table = 'user_sessions' 
\ No newline at end of file
+        db_table = 'user_sessions'
+        indexes = [
+            models.Index(fields=['is_active', 'last_active'], name='user_session_active_seen'),
+        ] 
+
+
+# Keep the token cache in step with the database, see users/authentication.py.
+# Eviction waits for the commit: until then other requests still read the old rows.
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_user_tokens(sender, instance, using, **kwargs):
+    """Drop cached tokens when a user changes, e.g. is deactivated."""
+    def invalidate():
+        keys = ()
+        if token_cache.shared_alias:
+            keys = Token.objects.using(using).filter(user_id=instance.pk).values_list('key', flat=True)
+        token_cache.invalidate(keys, user_id=instance.pk)
+    transaction.on_commit(invalidate, using=using)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(sender, instance, using, **kwargs):
+    """Drop a token from the cache once it is deleted, e.g. on logout."""
+    transaction.on_commit(lambda: token_cache.invalidate([instance.key]), using=using)
+
+
+# Keep the username search index in step too, see users/search.py
+
+@receiver(post_save, sender=CustomUser)
+def index_username(sender, instance, created, using, update_fields, **kwargs):
+    """Apply a new, renamed or (de)activated user to the username index."""
+    if update_fields is not None and not {'username', 'is_active'} & set(update_fields):
+        return
+    old = None if created else getattr(instance, '_stored_username', None)
+    new = instance.username if instance.is_active else None
+    transaction.on_commit(lambda: username_index.replace(old, new), using=using)
+
+
+@receiver(post_delete, sender=CustomUser)
+def unindex_username(sender, instance, using, **kwargs):
+    """Drop a deleted user from the username index."""
+    username = instance.username
+    transaction.on_commit(lambda: username_index.replace(username, None), using=using)
@@ -0,0 +1,156 @@
+"""
+Bulk user provisioning, see the provision_users command.
+
+Key generation and password hashing dominate the cost of creating a user, so
+``UserProvisioner`` spreads both over a process pool and
+inserts each batch with a single ``bulk_create``. What ``CustomUser.save``
+and the model signals would have done per row (the key fingerprint, the
+username index) is done here for the whole batch.
+"""
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from encryption.utils import generate_key_pair, public_key_fingerprint
+
+from .models import CustomUser
+from .search import username_index
+
+PROFILE_FIELDS = ('first_name', 'last_name')
+
+
+def read_records(lines, format):
+    """Yield ``(line number, record dict)`` from CSV (with a header row) or NDJSON lines."""
+    if format == 'csv':
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield line_number, record if isinstance(record, dict) else None
+
+
+def validate_record(record):
+    """Return an error message for a record that cannot become a user, else None."""
+    if record is None:
+        return 'not a JSON object'
+    username = (record.get('username') or '').strip()
+    if not username:
+        return 'missing username'
+    if len(username) > CustomUser._meta.get_field('username').max_length:
+        return 'username too long'
+    try:
+        CustomUser.username_validator(username)
+    except ValidationError as e:
+        return e.messages[0]
+    return None
+
+
+def prepare_user(record):
+    """
+    Generate a key pair and hash the password for one record. Runs in a pool
+    worker and returns the model field values.
+    """
+    key_pair = generate_key_pair()
+    fields = {field: record.get(field) or '' for field in PROFILE_FIELDS}
+    fields.update(
+        username=record['username'].strip(),
+        # Unique but nullable, so a blank email must be stored as NULL
+        email=(record.get('email') or '').strip() or None,
+        password=make_password(record.get('password') or None),
+        public_key=key_pair['public_key'],
+        private_key=key_pair['private_key'],
+    )
+    return fields
+
+
+class UserProvisioner:
+    """Creates users from records in batches, preparing them on ``workers`` processes."""
+
+    def __init__(self, workers, stderr=None):
+        self.workers = workers
+        self.stderr = stderr
+        self.created = 0
+        self.taken = 0
+        self.invalid = 0
+        self._pool = None
+
+    def __enter__(self):
+        # Workers set Django up themselves where they are spawned rather than forked
+        self._pool = ProcessPoolExecutor(self.workers, initializer=django.setup)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._pool.shutdown(cancel_futures=True)
+
+    def provision(self, batch):
+        """
+        Create users for a list of ``(line number, record)`` pairs, skipping
+        invalid records and those whose username or email is already taken.
+        Returns the number of users created.
+        """
+        records = {}
+        emails = set()
+        for line_number, record in batch:
+            error = validate_record(record)
+            if error:
+                self.invalid += 1
+                if self.stderr is not None:
+                    self.stderr.write(f"Line {line_number}: {error}")
+                continue
+            username = record['username'].strip()
+            email = (record.get('email') or '').strip()
+            if username in records or email in emails:
+                self.taken += 1
+                continue
+            records[username] = record
+            if email:
+                emails.add(email)
+
+        taken = set(CustomUser.objects.filter(username__in=records).values_list('username', flat=True))
+        taken_emails = set(CustomUser.objects.filter(email__in=emails).values_list('email', flat=True))
+        todo = [
+            record for username, record in records.items()
+            if username not in taken and (record.get('email') or '').strip() not in taken_emails
+        ]
+        self.taken += len(records) - len(todo)
+        if not todo:
+            return 0
+
+        # Several records per task keep the pickling overhead down
+        chunksize = max(1, len(todo) // (self.workers * 4))
+        now = timezone.now()
+        users = []
+        for fields in self._pool.map(prepare_user, todo, chunksize=chunksize):
+            # bulk_create skips CustomUser.save, which maintains these
+            fields['key_fingerprint'] = public_key_fingerprint(fields['public_key'])
+            fields['key_updated_at'] = now
+            fields['date_joined'] = now
+            users.append(CustomUser(**fields))
+
+        with transaction.atomic():
+            # ignore_conflicts: a registration may have taken a name since the checks
+            CustomUser.objects.bulk_create(users, ignore_conflicts=True)
+            created = list(CustomUser.objects.filter(
+                username__in=[user.username for user in users], date_joined=now
+            ).values_list('username', flat=True))
+
+            def index_created():
+                # Nor are post_save signals sent
+                for username in created:
+                    username_index.replace(None, username)
+            transaction.on_commit(index_created)
+        self.taken += len(users) - len(created)
+        self.created += len(created)
+        return len(created)
@@ -0,0 +1,145 @@
+"""
+Username prefix search for participant pickers.
+
+``username_index`` holds the usernames of all active users in one sorted
+list, so the matches for a prefix are a binary search and a short slice
+away: microseconds even at a million users. The receivers in
+users/models.py apply creations, renames, deactivations and deletions as
+they commit. Changes made by other processes, or by queryset updates that
+send no signals, are picked up when the index is rebuilt, at most
+USERNAME_INDEX_MAX_AGE seconds after the last build.
+
+The index is built in a background thread on first use. Until then
+``search_usernames`` falls back to a range scan of the unique index on
+``username``. Matching is case-sensitive, like usernames themselves, so
+both paths return the same results.
+"""
+import bisect
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections
+
+from secure_messenger.metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+# Sorts after any character that can follow a prefix
+PREFIX_END = '\U0010ffff'
+BUILD_CHUNK_SIZE = 10000
+
+
+def max_age():
+    return getattr(settings, 'USERNAME_INDEX_MAX_AGE', 300.0)
+
+
+class UsernameIndex:
+    """A sorted in-memory list of active usernames, rebuilt periodically."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = None
+        self._built_at = 0.0
+        self._building = False
+        # Changes seen while a build reads the table, replayed onto its result
+        self._changes = None
+
+    def search(self, prefix, limit):
+        """Up to ``limit`` usernames starting with ``prefix``, in order; None until built."""
+        self._refresh_if_stale()
+        with self._lock:
+            names = self._names
+            if names is None:
+                return None
+            start = bisect.bisect_left(names, prefix)
+            matches = names[start:start + limit]
+        # Everything from the first non-match on sorts after the prefix too
+        for i, name in enumerate(matches):
+            if not name.startswith(prefix):
+                return matches[:i]
+        return matches
+
+    def replace(self, old, new):
+        """Record that username ``old`` became ``new``; either may be None."""
+        with self._lock:
+            if self._changes is not None:
+                self._changes.append((old, new))
+            if self._names is not None:
+                self._apply(self._names, old, new)
+
+    @staticmethod
+    def _apply(names, old, new):
+        if old is not None and old != new:
+            i = bisect.bisect_left(names, old)
+            if i < len(names) and names[i] == old:
+                del names[i]
+        if new is not None:
+            i = bisect.bisect_left(names, new)
+            if i == len(names) or names[i] != new:
+                names.insert(i, new)
+
+    def build(self):
+        """Load every active username; replaces the current list when done."""
+        with self._lock:
+            self._changes = []
+        try:
+            names = list(
+                get_user_model().objects.filter(is_active=True)
+                .values_list('username', flat=True)
+                .iterator(chunk_size=BUILD_CHUNK_SIZE)
+            )
+            names.sort()
+            with self._lock:
+                for old, new in self._changes:
+                    self._apply(names, old, new)
+                self._names = names
+                self._built_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._changes = None
+                self._building = False
+
+    def _refresh_if_stale(self):
+        with self._lock:
+            if self._building:
+                return
+            if self._names is not None and time.monotonic() - self._built_at < max_age():
+                return
+            self._building = True
+        threading.Thread(target=self._build_in_background, name='username-index', daemon=True).start()
+
+    def _build_in_background(self):
+        try:
+            self.build()
+        except Exception:
+            logger.exception("Failed to build the username index")
+        finally:
+            close_old_connections()
+
+    def clear(self):
+        with self._lock:
+            self._names = None
+
+
+username_index = UsernameIndex()
+
+
+def search_usernames(prefix, limit):
+    """Active usernames starting with ``prefix``, in order, at most ``limit`` of them."""
+    names = username_index.search(prefix, limit)
+    record_cache('username_index', names is not None)
+    if names is not None:
+        return names
+    return list(usernames_with_prefix(prefix)[:limit])
+
+
+def usernames_with_prefix(prefix):
+    """The database fallback: a range scan of the unique index on username."""
+    return get_user_model().objects.filter(
+        username__gte=prefix,
+        username__lt=prefix + PREFIX_END,
+        is_active=True
+    ).order_by('username').values_list('username', flat=True)
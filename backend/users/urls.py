@@ -1,10 +1,13 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import AuthViewSet
+from .views import AuthViewSet, login_view, register_view
 
 router = DefaultRouter()
 router.register(r'', AuthViewSet, basename='auth')
 
 urlpatterns = [
+    # Async views, see users/views.py; named like the router routes they replaced
+    path('login/', login_view, name='auth-login'),
+    path('register/', register_view, name='auth-register'),
     path('', include(router.urls)),
 ] 
\ No newline at end of file
@@ -4,137 +4,180 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.authtoken.models import Token
-from django.contrib.auth import authenticate, login, logout
+from asgiref.sync import sync_to_async
+from django.contrib.auth import login, logout
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.http import HttpResponseNotAllowed, JsonResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .activity import SESSION_HEADER, tracker
+from .hashers import HashingOverloaded, hashing_pool, verify_password
+from .keys import MAX_USERNAMES, directory_etag, if_none_match_tags, key_directory
+from .search import search_usernames
 from .models import CustomUser, UserSession
 from .serializers import UserSerializer, UserRegistrationSerializer, UserSessionSerializer
+import asyncio
+import logging
 import uuid
 from encryption.utils import generate_key_pair
+from chat.conditional import etag_matches
+from chat.models import ChatParticipant
+from secure_messenger.parsers import request_data
 
-class AuthViewSet(viewsets.ViewSet):
-    permission_classes = [AllowAny]
+logger = logging.getLogger(__name__)
 
-    @action(detail=False, methods=['post'])
-    def login(self, request):
-        """Log in a user."""
-        username = request.data.get('username')
-        password = request.data.get('password')
-        
-        if not username or not password:
-            return Response(
-                {'error': 'Please provide both username and password'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        user = authenticate(username=username, password=password)
+
+# Login and register are plain async Django views rather than DRF actions, so
+# under ASGI they run on the event loop: password hashing and key generation
+# go to the bounded hashing pool (users/hashers.py) and only the short
+# database steps use a worker thread. Django 4.2's csrf_exempt and
+# require_POST decorators do not support async views, hence the attribute
+# and the method checks below; like the DRF views they replace, they are
+# exempt from CSRF because they take no session credentials.
+
+def _error(message, status_code):
+    return JsonResponse({'error': message}, status=status_code)
+
+
+def _overloaded():
+    response = _error('Too many logins in progress, please retry shortly', status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = '1'
+    return response
+
+
+def _auth_response(user, token, session_id):
+    response_data = {
+        'user': UserSerializer(user).data,
+        'token': token.key,
+        'session_id': session_id
+    }
+    if user.private_key:
+        response_data['private_key'] = user.private_key
+    return response_data
+
+
+def _complete_login(request, user, session_id, rehashed):
+    """The database side of a successful login."""
+    if rehashed:
+        # Stored with an outdated hasher or cost
+        user.password = rehashed
+        user.save(update_fields=['password'])
+    login(request, user)
+    
+    # Create or get token
+    token, _ = Token.objects.get_or_create(user=user)
+    
+    # Reuse the client's session if it is still logged in, otherwise create one
+    if not session_id or not UserSession.objects.filter(
+        session_id=session_id, user=user, is_active=True
+    ).exists():
+        session_id = str(uuid.uuid4())
+        UserSession.objects.create(user=user, session_id=session_id)
+    else:
+        tracker.touch(session_id, user.id)
+    return _auth_response(user, token, session_id)
+
+
+async def login_view(request):
+    """Log in a user."""
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    data = request_data(request)
+    if data is None:
+        return _error('Malformed request body', status.HTTP_400_BAD_REQUEST)
+    username = data.get('username')
+    password = data.get('password')
+    
+    if not username or not password:
+        return _error('Please provide both username and password', status.HTTP_400_BAD_REQUEST)
+    
+    user = await sync_to_async(CustomUser.objects.filter(username=username).first)()
+    try:
+        if user is None:
+            # Hash anyway so an unknown username takes as long as a wrong password
+            await hashing_pool.run(make_password, password)
+            correct, rehashed = False, None
+        else:
+            correct, rehashed = await hashing_pool.run(verify_password, password, user.password)
+    except HashingOverloaded:
+        return _overloaded()
+    
+    if not correct or not user.is_active:
+        return _error('Invalid credentials', status.HTTP_401_UNAUTHORIZED)
+    
+    session_id = data.get('session_id') or request.META.get(SESSION_HEADER)
+    response_data = await sync_to_async(_complete_login)(request, user, session_id, rehashed)
+    logger.debug("Login: user %s logged in", username)
+    return JsonResponse(response_data)
+
+
+login_view.csrf_exempt = True
+
+
+def _create_user(request, validated_data, key_pair, encoded_password):
+    """The database side of registration."""
+    with transaction.atomic():
+        user = CustomUser(
+            username=validated_data['username'],
+            public_key=key_pair['public_key'],
+            private_key=key_pair['private_key']
+        )
+        user.password = encoded_password
+        user.save()
+        login(request, user)
         
-        if user:
-            login(request, user)
-            
-            # Create or get token
-            token, _ = Token.objects.get_or_create(user=user)
-            
-            # Create a session
-            session_id = str(uuid.uuid4())
-            UserSession.objects.create(user=user, session_id=session_id)
-            
-            # Get the user's private key
-            private_key = user.private_key
-            print(f"Login: User {username} private key length: {len(private_key) if private_key else 0}")
-            
-            # Serialize user data
-            user_data = UserSerializer(user).data
-            
-            response_data = {
-                'user': user_data,
-                'token': token.key,
-                'session_id': session_id
-            }
-            
-            if private_key:
-                response_data['private_key'] = private_key
-                print(f"Login: Private key included in response for user {username}")
-            else:
-                print(f"Login: No private key found for user {username}")
-            
-            return Response(response_data)
+        # Create token
+        token = Token.objects.create(user=user)
         
-        return Response(
-            {'error': 'Invalid credentials'}, 
-            status=status.HTTP_401_UNAUTHORIZED
+        # Create a session
+        session_id = str(uuid.uuid4())
+        UserSession.objects.create(user=user, session_id=session_id)
+    return _auth_response(user, token, session_id)
+
+
+async def register_view(request):
+    """Register a new user."""
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    data = request_data(request)
+    if data is None:
+        return _error('Malformed request body', status.HTTP_400_BAD_REQUEST)
+    
+    serializer = UserRegistrationSerializer(data=data)
+    if not await sync_to_async(serializer.is_valid)():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    # Always generate a new key pair for security, in parallel with hashing the password
+    try:
+        key_pair, encoded_password = await asyncio.gather(
+            hashing_pool.run(generate_key_pair),
+            hashing_pool.run(make_password, serializer.validated_data['password'])
         )
+    except HashingOverloaded:
+        return _overloaded()
+    
+    response_data = await sync_to_async(_create_user)(request, serializer.validated_data, key_pair, encoded_password)
+    logger.debug("Register: user %s created", response_data['user']['username'])
+    return JsonResponse(response_data, status=status.HTTP_201_CREATED)
+
+
+register_view.csrf_exempt = True
 
-    @action(detail=False, methods=['post'])
-    def register(self, request):
-        """Register a new user."""
-        print(f"Register: Starting registration process for username: {request.data.get('username')}")
-        serializer = UserRegistrationSerializer(data=request.data)
-        if serializer.is_valid():
-            print("Register: Serializer validation successful")
-            
-            # Always generate a new key pair for security
-            print("Register: Generating new key pair...")
-            key_pair = generate_key_pair()
-            print(f"Register: Key pair generated - Private key length: {len(key_pair['private_key'])}, Public key length: {len(key_pair['public_key'])}")
-            
-            # Update serializer data with keys
-            serializer.validated_data['public_key'] = key_pair['public_key']
-            serializer.validated_data['private_key'] = key_pair['private_key']
-            print("Register: Keys added to serializer validated data")
-            
-            # Create the user
-            print("Register: Saving user with serializer...")
-            user = serializer.save()
-            print(f"Register: User saved - Username: {user.username}")
-            print(f"Register: User model private key length: {len(user.private_key) if user.private_key else 0}")
-            print(f"Register: User model public key length: {len(user.public_key) if user.public_key else 0}")
-            
-            # Verify the keys were saved
-            user.refresh_from_db()
-            print(f"Register: After refresh - Private key length: {len(user.private_key) if user.private_key else 0}")
-            print(f"Register: After refresh - Public key length: {len(user.public_key) if user.public_key else 0}")
-            
-            login(request, user)
-            print("Register: User logged in")
-            
-            # Create token
-            token = Token.objects.create(user=user)
-            print("Register: Auth token created")
-            
-            # Create a session
-            session_id = str(uuid.uuid4())
-            UserSession.objects.create(user=user, session_id=session_id)
-            print(f"Register: Session created with ID: {session_id}")
-            
-            response_data = {
-                'user': UserSerializer(user).data,
-                'token': token.key,
-                'session_id': session_id
-            }
-            
-            if user.private_key:
-                response_data['private_key'] = user.private_key
-                print(f"Register: Private key included in response, length: {len(user.private_key)}")
-            else:
-                print("Register: WARNING - No private key found in user model for response")
-            
-            return Response(response_data, status=status.HTTP_201_CREATED)
-        else:
-            print(f"Register: Serializer validation failed - Errors: {serializer.errors}")
-        
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+class AuthViewSet(viewsets.ViewSet):
+    permission_classes = [AllowAny]
 
     @action(detail=False, methods=['post'])
     def logout(self, request):
         """Log out a user."""
         if request.user.is_authenticated:
-            session_id = request.data.get('session_id')
+            session_id = request.data.get('session_id') or request.META.get(SESSION_HEADER)
             if session_id:
-                try:
-                    session = UserSession.objects.get(session_id=session_id)
-                    session.is_active = False
-                    session.save()
-                except UserSession.DoesNotExist:
-                    pass
+                tracker.forget(session_id, request.user.id)
+                UserSession.objects.filter(
+                    session_id=session_id, user=request.user
+                ).update(is_active=False, last_active=timezone.now())
             
             # Delete the user's token
             Token.objects.filter(user=request.user).delete()
@@ -176,4 +219,107 @@ class UserSessionViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
     
     def get_queryset(self):
-        return UserSession.objects.filter(user=self.request.user) 
\ No newline at end of file
+        return UserSession.objects.filter(user=self.request.user) 
+
+
+class KeyDirectoryViewSet(viewsets.ViewSet):
+    """
+    Public keys for many users in one call, for ``?usernames=a,b`` or for the
+    active members of ``?chat_session_id=``. ``changed_since`` (ISO 8601)
+    returns only keys replaced at or after that time; pass back the response's
+    ``as_of``. Keys whose ETag is listed in If-None-Match are reported under
+    ``unchanged`` without their body, and a response matching its own ETag
+    is a 304.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def list(self, request):
+        as_of = timezone.now()
+        changed_since = request.query_params.get('changed_since')
+        if changed_since:
+            changed_since = parse_datetime(changed_since)
+            if changed_since is None:
+                return Response({'error': 'changed_since must be an ISO 8601 datetime'}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            changed_since = None
+        
+        usernames = request.query_params.get('usernames')
+        chat_session_id = request.query_params.get('chat_session_id')
+        if usernames:
+            usernames = list(dict.fromkeys(name.strip() for name in usernames.split(',') if name.strip()))
+            if len(usernames) > MAX_USERNAMES:
+                return Response(
+                    {'error': f'At most {MAX_USERNAMES} usernames per request'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            users = CustomUser.objects.filter(username__in=usernames)
+        elif chat_session_id:
+            if not ChatParticipant.objects.filter(
+                chat_session_id=chat_session_id, user=request.user, is_active=True
+            ).exists():
+                return Response({'error': 'Chat session not found'}, status=status.HTTP_404_NOT_FOUND)
+            users = CustomUser.objects.filter(id__in=ChatParticipant.objects.filter(
+                chat_session_id=chat_session_id, is_active=True
+            ).values('user_id'))
+        else:
+            return Response({'error': 'usernames or chat_session_id is required'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        entries = key_directory(users, changed_since)
+        missing = []
+        if usernames and changed_since is None:
+            found = {entry['username'] for entry in entries}
+            missing = [name for name in usernames if name not in found]
+        
+        etag = directory_etag(entries, missing)
+        if etag_matches(request, etag):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            response['ETag'] = etag
+            return response
+        
+        # Keys the client already holds are named but not resent
+        known = if_none_match_tags(request)
+        keys = []
+        unchanged = []
+        for entry in entries:
+            if entry['etag'] in known:
+                unchanged.append(entry['username'])
+            else:
+                keys.append(entry)
+        
+        response = Response({
+            'keys': keys,
+            'unchanged': unchanged,
+            'missing': missing,
+            'as_of': as_of
+        })
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+class UserSearchViewSet(viewsets.ViewSet):
+    """Username autocomplete: ``?q=<prefix>&limit=<n>``, excluding the requester."""
+    permission_classes = [permissions.IsAuthenticated]
+    default_limit = 10
+    max_limit = 50
+    
+    def list(self, request):
+        prefix = request.query_params.get('q', '')
+        if not prefix or len(prefix) > 150:
+            return Response({'error': 'q must be 1 to 150 characters'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = int(request.query_params.get('limit', self.default_limit))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= self.max_limit:
+            return Response(
+                {'error': f'limit must be between 1 and {self.max_limit}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # One extra in case the requester is among the matches
+        usernames = [
+            username for username in search_usernames(prefix, limit + 1)
+            if username != request.user.username
+        ]
+        return Response({'results': usernames[:limit]})